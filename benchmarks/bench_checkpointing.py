@@ -0,0 +1,97 @@
+"""Peak memory vs. step time of processor gradient checkpointing.
+
+python -m benchmarks.bench_checkpointing --nparticles=10000 --nmessage_passing_steps=1,2,4,8
+
+Every configuration trains a randomly initialized simulator in a fresh process.
+The first training step gives the size of the activations saved for backward and
+the growth of the process' peak resident set size (which also includes allocator
+overhead and the recomputation in backward); the step time is the mean of the
+following steps.
+
+glibc keeps large freed blocks once its dynamic mmap threshold has grown, which
+hides the savings in the RSS; run with e.g. MALLOC_MMAP_THRESHOLD_=1048576 to
+return them to the system.
+"""
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+from gns import learned_simulator
+
+flags.DEFINE_integer('nparticles', 10000, help='Number of particles.')
+flags.DEFINE_integer('dim', 3, help='Number of chemical dimensions.')
+flags.DEFINE_list('nmessage_passing_steps', ['1', '2', '4', '8'], help='Processor depths.')
+flags.DEFINE_integer('nsteps', 3, help='Number of timed training steps.')
+
+FLAGS = flags.FLAGS
+
+INPUT_SEQUENCE_LENGTH = 2
+
+
+def _train_steps(nparticles, dim, nmessage_passing_steps, gradient_checkpointing, nsteps):
+    """Run in a fresh process: (saved activations and peak RSS growth in MiB, seconds per step)."""
+    torch.manual_seed(0)
+    stats = {'mean': torch.zeros(dim), 'std': torch.ones(dim)}
+    simulator = learned_simulator.LearnedSimulator(
+        particle_dimensions=dim,
+        nnode_in=dim * (INPUT_SEQUENCE_LENGTH + 1) + 16,
+        nedge_in=dim + 1,
+        latent_dim=128,
+        nmessage_passing_steps=nmessage_passing_steps,
+        nmlp_layers=2,
+        mlp_hidden_dim=256,
+        boundaries=np.array([[0., 1.]] * dim),
+        normalization_stats={'acceleration': stats, 'velocity': stats},
+        nparticle_types=1,
+        particle_type_embedding_size=16,
+        nuniverse_types=9,
+        universe_number_embedding_size=16,
+        gradient_checkpointing=gradient_checkpointing)
+    positions = torch.rand(nparticles, INPUT_SEQUENCE_LENGTH, dim)
+    inputs = dict(nparticles_per_example=torch.tensor([nparticles]),
+                  particle_types=torch.zeros(nparticles, dtype=torch.long),
+                  universe_numbers=torch.randint(9, (nparticles,)))
+
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    def step():
+        predicted, target = simulator.predict_accelerations(
+            positions[:, -1] + 1e-3, torch.zeros_like(positions), positions, **inputs)
+        ((predicted - target) ** 2).mean().backward()
+        simulator.zero_grad()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    peak_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak) / 1024
+    start = time.perf_counter()
+    for _ in range(nsteps):
+        step()
+    return saved_bytes / 2 ** 20, peak_growth, (time.perf_counter() - start) / nsteps
+
+
+def main(_):
+    context = multiprocessing.get_context('spawn')
+    print(f"{'steps':>5} {'checkpointing':>13} {'saved MiB':>10} {'peak RSS MiB':>13} {'s/step':>7}")
+    for nmessage_passing_steps in map(int, FLAGS.nmessage_passing_steps):
+        for gradient_checkpointing in (False, True):
+            with context.Pool(1) as pool:
+                saved, peak, seconds = pool.apply(_train_steps, (
+                    FLAGS.nparticles, FLAGS.dim, nmessage_passing_steps,
+                    gradient_checkpointing, FLAGS.nsteps))
+            print(f"{nmessage_passing_steps:>5} {str(gradient_checkpointing):>13} "
+                  f"{saved:>10.0f} {peak:>13.0f} {seconds:>7.2f}")
+
+
+if __name__ == '__main__':
+    app.run(main)
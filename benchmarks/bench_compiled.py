@@ -0,0 +1,61 @@
+"""CPU rollout throughput of the eager simulator vs. the compiled step (gns.compiled).
+
+python -m benchmarks.bench_compiled --nparticles=1000 --knn_backend=brute_force --modes=torchscript,inductor
+
+Uses the randomly initialized simulator and the flags of benchmarks.bench_rollout_step.
+The compiled step always uses the brute-force kNN search, so --knn_backend=brute_force
+compares like with like.
+"""
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from benchmarks import bench_rollout_step
+from gns import compiled
+
+flags.DEFINE_list('modes', ['torchscript'], help='Compile modes to time against eager.')
+
+FLAGS = flags.FLAGS
+
+INPUT_SEQUENCE_LENGTH = 2
+
+
+def _steps_per_second(simulator, positions, inputs):
+    with torch.no_grad():
+        # Warm up (compilation, profiling runs of the TorchScript executor)
+        for _ in range(3):
+            simulator.predict_positions(positions, **inputs)
+        start = time.perf_counter()
+        for _ in range(FLAGS.nsteps):
+            positions = torch.cat(
+                [positions[:, 1:], simulator.predict_positions(positions, **inputs)[:, None]], dim=1)
+    return FLAGS.nsteps / (time.perf_counter() - start)
+
+
+def main(_):
+    torch.manual_seed(0)
+    n = FLAGS.nparticles
+    simulator = bench_rollout_step._simulator(FLAGS.dim, FLAGS.num_prop)
+    positions = torch.rand(n, INPUT_SEQUENCE_LENGTH, FLAGS.dim)
+    inputs = dict(
+        nparticles_per_example=torch.tensor([n]),
+        particle_types=torch.zeros(n, dtype=torch.long),
+        universe_numbers=torch.randint(bench_rollout_step.NUM_UNIVERSE_TYPES, (n,)),
+        material_property=torch.rand(n, FLAGS.num_prop) if FLAGS.num_prop else None)
+
+    eager = _steps_per_second(simulator, positions, inputs)
+    print(f"eager ({FLAGS.knn_backend} kNN): {eager:.2f} steps/sec")
+    for mode in FLAGS.modes:
+        step = compiled.compile_simulator(simulator, mode)
+        with torch.no_grad():
+            difference = (simulator.predict_positions(positions, **inputs) -
+                          step.predict_positions(positions, **inputs)).abs().max()
+        throughput = _steps_per_second(step, positions, inputs)
+        print(f"{mode}: {throughput:.2f} steps/sec ({throughput / eager:.2f}x), "
+              f"max |difference| {difference:.2e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,50 @@
+"""Scaling of CPU data-parallel training (gloo) with the number of ranks.
+
+python -m benchmarks.bench_ddp --data_path='<prepared data path>' --ranks=1,2,4,8 --ntraining_steps=200
+
+Every configuration trains a new model with `python -m gns.train --cpu_ranks=<n>`,
+each rank pinned to its share of the cores (1 rank: a single process without
+DDP). Every rank draws its own batch of --batch_size examples per step, so the
+throughput is ranks * batch_size * steps over the training time of the slowest
+rank; the efficiency compares it with the single rank.
+"""
+import re
+import subprocess
+import sys
+import tempfile
+
+from absl import app
+from absl import flags
+
+from gns import train  # noqa: F401 (defines the training flags)
+
+flags.DEFINE_list('ranks', ['1', '2', '4', '8'], help='Numbers of CPU ranks.')
+
+FLAGS = flags.FLAGS
+
+
+def _train_seconds(model_path, nranks):
+    """Training time of the slowest rank."""
+    result = subprocess.run(
+        [sys.executable, "-m", "gns.train", "--mode=train", f"--data_path={FLAGS.data_path}",
+         f"--model_path={model_path}/", f"--ntraining_steps={FLAGS.ntraining_steps}",
+         f"--nsave_steps={FLAGS.ntraining_steps}", f"--batch_size={FLAGS.batch_size}",
+         f"--cpu_ranks={nranks}"],
+        check=True, capture_output=True, text=True)
+    return max(float(seconds) for seconds in re.findall(r"Total training time: ([0-9.]+)", result.stdout))
+
+
+def main(_):
+    baseline = None
+    with tempfile.TemporaryDirectory() as path:
+        for nranks in [int(n) for n in FLAGS.ranks]:
+            seconds = _train_seconds(f"{path}/ranks{nranks}", nranks)
+            throughput = nranks * FLAGS.batch_size * FLAGS.ntraining_steps / seconds
+            if baseline is None:
+                baseline = throughput / nranks
+            print(f"{nranks} ranks: {seconds:.1f} s, {throughput:.1f} examples/s, "
+                  f"efficiency {throughput / (nranks * baseline):.0%}")
+
+
+if __name__ == '__main__':
+    app.run(main)
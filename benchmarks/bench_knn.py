@@ -0,0 +1,53 @@
+"""Benchmark of the kNN graph backends of gns.graph_builder.
+
+python -m benchmarks.bench_knn --nparticles=1000,10000,100000 --dims=3,8
+
+Times every installed backend on uniformly random positions (a batch of
+--nexamples examples of n particles each) and reports the fastest backend
+for each particle count and dimension.
+"""
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from gns import graph_builder
+
+flags.DEFINE_list('nparticles', ['1000', '10000', '100000'], help='Particle counts per example.')
+flags.DEFINE_list('dims', ['3', '8'], help='Dimensions of the composition space.')
+flags.DEFINE_integer('nexamples', 2, help='Number of examples per batch.')
+flags.DEFINE_integer('k', 2, help='Number of neighbours (self edge included).')
+flags.DEFINE_integer('nrepeats', 3, help='Number of timed repeats (best is reported).')
+flags.DEFINE_string('device', 'cpu', help='Device of the positions.')
+
+FLAGS = flags.FLAGS
+
+
+def _best_time(x, batch, backend):
+    times = []
+    for _ in range(FLAGS.nrepeats):
+        start = time.perf_counter()
+        graph_builder.knn_graph(x, FLAGS.k, batch, loop=True, backend=backend)
+        if x.device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(_):
+    torch.manual_seed(0)
+    backends = graph_builder.available_backends()
+    print(f"{'particles':>10} {'dim':>4} " + " ".join(f"{b:>14}" for b in backends) + "  fastest")
+    for n in map(int, FLAGS.nparticles):
+        for dim in map(int, FLAGS.dims):
+            x = torch.rand(FLAGS.nexamples * n, dim, device=FLAGS.device)
+            batch = torch.arange(FLAGS.nexamples, device=FLAGS.device).repeat_interleave(n)
+            times = {backend: _best_time(x, batch, backend) for backend in backends}
+            fastest = min(times, key=times.get)
+            print(f"{n:>10} {dim:>4} " + " ".join(f"{times[b] * 1e3:>12.2f}ms" for b in backends)
+                  + f"  {fastest}")
+
+
+if __name__ == '__main__':
+    app.run(main)
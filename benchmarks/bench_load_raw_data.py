@@ -0,0 +1,72 @@
+"""Benchmark raw partMC txt ingestion: serial np.loadtxt vs. parallel cold parse vs. warm cache.
+
+python -m benchmarks.bench_load_raw_data --raw_data_path='<raw-data-path>'
+
+Without --raw_data_path a synthetic scenario of --nfiles files is generated.
+"""
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from absl import app
+from absl import flags
+
+from chem_data.prepare_data import load_raw_data
+
+flags.DEFINE_string('raw_data_path', None, help='Scenario directory with partMC txt files (default: synthetic).')
+flags.DEFINE_integer('nfiles', 8, help='Number of synthetic species files.')
+flags.DEFINE_integer('ntimes', 1441, help='Number of synthetic time steps.')
+flags.DEFINE_integer('nparticles', 1000, help='Number of synthetic particles.')
+flags.DEFINE_integer('nworkers', None, help='Worker processes for the parallel parse.')
+flags.DEFINE_integer('repeats', 3, help='Timed repetitions for each path.')
+
+FLAGS = flags.FLAGS
+
+
+def _make_synthetic(path):
+    rng = np.random.default_rng(0)
+    names = ['H2O', 'SO4', 'H2SO4', 'BC', 'OC', 'aero_number', 'NH4', 'NO3']
+    for i in range(FLAGS.nfiles):
+        name = names[i] if i < len(names) else f'chem{i}'
+        np.savetxt(Path(path) / f'{name}_rep.txt',
+                   rng.random((FLAGS.ntimes, FLAGS.nparticles)) * 1e-18)
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    feats = fn()
+    # touch every value so memory-mapped caches are actually read
+    total = sum(float(np.sum(v)) for v in feats.values())
+    return time.perf_counter() - start, total
+
+
+def main(_):
+    with tempfile.TemporaryDirectory() as tmp:
+        if FLAGS.raw_data_path is None:
+            _make_synthetic(tmp)
+        else:
+            for file in Path(FLAGS.raw_data_path).glob('*.txt'):
+                shutil.copy(file, tmp)
+
+        serial = min(_timed(lambda: load_raw_data(tmp, nworkers=1, cache=False))[0]
+                     for _ in range(FLAGS.repeats))
+
+        cold = []
+        for _ in range(FLAGS.repeats):
+            for cache_file in Path(tmp).glob('*.npy'):
+                cache_file.unlink()
+            cold.append(_timed(lambda: load_raw_data(tmp, nworkers=FLAGS.nworkers))[0])
+        cold = min(cold)
+
+        warm = min(_timed(lambda: load_raw_data(tmp, nworkers=FLAGS.nworkers))[0]
+                   for _ in range(FLAGS.repeats))
+
+    print(f"serial np.loadtxt (current path): {serial:.3f} s")
+    print(f"parallel cold parse + cache write: {cold:.3f} s ({serial / cold:.1f}x)")
+    print(f"warm cache (memory-mapped):        {warm:.3f} s ({serial / warm:.1f}x)")
+
+
+if __name__ == '__main__':
+    app.run(main)
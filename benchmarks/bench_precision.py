@@ -0,0 +1,92 @@
+"""float32 vs. bfloat16 autocast: time per step, saved activation memory and rollout drift.
+
+python -m benchmarks.bench_precision --nparticles=1000 --nsteps=50
+
+Uses the randomly initialized simulator and the flags of benchmarks.bench_rollout_step;
+both precisions share the same weights. The activation memory is the size of the
+tensors saved for backward in one training step.
+"""
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from benchmarks import bench_rollout_step
+
+FLAGS = flags.FLAGS
+
+INPUT_SEQUENCE_LENGTH = 2
+
+
+def _inputs(n):
+    return dict(
+        nparticles_per_example=torch.tensor([n]),
+        particle_types=torch.zeros(n, dtype=torch.long),
+        universe_numbers=torch.randint(bench_rollout_step.NUM_UNIVERSE_TYPES, (n,)),
+        material_property=torch.rand(n, FLAGS.num_prop) if FLAGS.num_prop else None)
+
+
+def _rollout(simulator, positions, inputs):
+    """Roll out FLAGS.nsteps steps, returning the trajectory and seconds per step."""
+    trajectory = []
+    with torch.no_grad():
+        simulator.predict_positions(positions, **inputs)
+        start = time.perf_counter()
+        for _ in range(FLAGS.nsteps):
+            next_position = simulator.predict_positions(positions, **inputs)
+            trajectory.append(next_position)
+            positions = torch.cat([positions[:, 1:], next_position[:, None]], dim=1)
+    return torch.stack(trajectory), (time.perf_counter() - start) / FLAGS.nsteps
+
+
+def _train_step(simulator, positions, inputs):
+    """Seconds and saved activation bytes of one forward/backward pass."""
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    simulator.train()
+    next_positions = positions[:, -1] + 1e-3
+    noise = torch.zeros_like(positions)
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        predicted, target = simulator.predict_accelerations(
+            next_positions, noise, positions, **inputs)
+        loss = ((predicted - target) ** 2).mean()
+    loss.backward()
+    seconds = time.perf_counter() - start
+    simulator.zero_grad()
+    simulator.eval()
+    return seconds, saved_bytes
+
+
+def main(_):
+    torch.manual_seed(0)
+    n = FLAGS.nparticles
+    simulators = {precision: bench_rollout_step._simulator(FLAGS.dim, FLAGS.num_prop, precision)
+                  for precision in ("float32", "bfloat16")}
+    simulators["bfloat16"].load_state_dict(simulators["float32"].state_dict())
+    positions = torch.rand(n, INPUT_SEQUENCE_LENGTH, FLAGS.dim)
+    inputs = _inputs(n)
+
+    trajectories = {}
+    for precision, simulator in simulators.items():
+        trajectories[precision], step_seconds = _rollout(simulator, positions, inputs)
+        _train_step(simulator, positions, inputs)
+        train_seconds, saved_bytes = _train_step(simulator, positions, inputs)
+        print(f"{precision:>8}: rollout {step_seconds * 1e3:.2f} ms/step, "
+              f"training {train_seconds * 1e3:.2f} ms/step, "
+              f"saved activations {saved_bytes / 2 ** 20:.1f} MiB")
+
+    reference = trajectories["float32"]
+    drift = (trajectories["bfloat16"] - reference).abs()
+    print(f"bfloat16 drift after {FLAGS.nsteps} steps: max |dx| {drift[-1].max():.2e}, "
+          f"nMAE {drift.sum() / reference.abs().sum():.2e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,85 @@
+"""Rollout drift and speedup of the dynamically int8-quantized simulator (gns.quantize).
+
+python -m benchmarks.bench_quantize --data_path='<prepared data path>' --model_path='<model storage path>'
+       --model_file='model-<step>.pt'
+
+Rolls out the trajectories of --split with the float32 model and its int8
+copy. The model flags (--knn_k, --interaction_network, ...) are those of gns.train.
+"""
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from gns import data_loader
+from gns import quantize
+from gns import reading_utils
+from gns import train
+
+flags.DEFINE_string('split', 'valid', help='Split used to measure the drift and speedup.')
+flags.DEFINE_integer('max_examples', None, help='Maximum number of trajectories to roll out.')
+
+FLAGS = flags.FLAGS
+
+
+def _rollout_features(features, device):
+    """Unpack one trajectory of a TrajectoriesDataset like `train.predict`."""
+    positions = features[0].to(device)
+    particle_type = features[1].to(device)
+    universe_number = features[2].to(device)
+    if len(features) == 5:
+        material_property = features[3].to(device)
+    else:
+        material_property = None
+    n_particles_per_example = torch.tensor([int(features[-1])], dtype=torch.int32).to(device)
+    return positions, particle_type, universe_number, material_property, n_particles_per_example
+
+
+def main(_):
+    device = torch.device('cpu')
+    ds = data_loader.get_data_loader_by_trajectories(
+        path=data_loader.get_split_path(FLAGS.data_path, FLAGS.split))
+    n_features = len(ds.dataset._data[0])
+    metadata = reading_utils.read_metadata(FLAGS.data_path, "rollout")
+    simulator = train._get_simulator(
+        metadata, FLAGS.noise_std, FLAGS.noise_std, n_features, device,
+        FLAGS.knn_k, FLAGS.knn_radius, FLAGS.knn_backend, FLAGS.interaction_network,
+        'float32', FLAGS.nmessage_passing_steps, temporal_stride=FLAGS.temporal_stride)
+    simulator.load(FLAGS.model_path + FLAGS.model_file)
+    simulator.eval()
+    models = {"float32": simulator, "int8": quantize.quantize_simulator(simulator)}
+
+    seconds = {name: 0. for name in models}
+    # Sum and number of the squared errors of all examples
+    loss_sums = {name: 0. for name in models}
+    loss_count = 0
+    absolute_difference, absolute_reference = 0., 0.
+    with torch.no_grad():
+        for example_i, features in enumerate(ds):
+            if FLAGS.max_examples is not None and example_i == FLAGS.max_examples:
+                break
+            positions, *inputs = _rollout_features(features, device)
+            nsteps = train.rollout_nsteps(positions.shape[1], FLAGS.temporal_stride)
+            positions = positions[:, ::FLAGS.temporal_stride]
+            predictions = {}
+            for name, model in models.items():
+                start = time.perf_counter()
+                example_rollout, loss = train.rollout(
+                    model, positions, *inputs, nsteps, device)
+                seconds[name] += time.perf_counter() - start
+                loss_sums[name] += loss.sum().item() * positions.shape[0] * positions.shape[2]
+                predictions[name] = example_rollout['predicted_rollout']
+            loss_count += nsteps * positions.shape[0] * positions.shape[2]
+            absolute_difference += abs(predictions["int8"] - predictions["float32"]).sum()
+            absolute_reference += abs(predictions["float32"]).sum()
+
+    for name in models:
+        print(f"{name}: rollout loss {loss_sums[name] / loss_count:.6e}, "
+              f"rollout time {seconds[name]:.2f} s")
+    print(f"int8 rollout nMAE drift: {absolute_difference / absolute_reference:.3e}")
+    print(f"int8 speedup: {seconds['float32'] / seconds['int8']:.2f}x")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,86 @@
+"""Peak memory and time of the list + torch.stack rollout loop vs. gns.rollout_engine.
+
+python -m benchmarks.bench_rollout_engine --nparticles=10000 --nsteps=1000
+
+A constant-velocity stand-in for the simulator keeps the model cost out of the
+comparison, so long horizons run quickly. Every loop runs in a fresh process and
+reports the growth of its peak resident set size (run with e.g.
+MALLOC_MMAP_THRESHOLD_=1048576 so that glibc returns large freed blocks).
+"""
+import multiprocessing
+import resource
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from gns import rollout_engine
+
+flags.DEFINE_integer('nparticles', 10000, help='Number of particles.')
+flags.DEFINE_integer('dim', 3, help='Number of chemical dimensions.')
+flags.DEFINE_integer('nsteps', 1000, help='Rollout horizon.')
+
+FLAGS = flags.FLAGS
+
+
+class ConstantVelocity:
+    """Stand-in simulator: x_{t+1} = 2 x_t - x_{t-1}."""
+
+    def predict_positions(self, current_positions, **kwargs):
+        return 2 * current_positions[:, -1] - current_positions[:, -2]
+
+    def rollout_context(self, *args):
+        return None
+
+    def reset_graph_cache(self):
+        pass
+
+
+def _list_stack_rollout(simulator, position, nsteps):
+    """The former train.rollout loop."""
+    initial_positions = position[:, :2]
+    ground_truth_positions = position[:, 2:]
+    current_positions = initial_positions
+    predictions = []
+    for _ in range(nsteps):
+        next_position = simulator.predict_positions(current_positions)
+        predictions.append(next_position)
+        current_positions = torch.cat(
+            [current_positions[:, 1:], next_position[:, None, :]], dim=1)
+    predictions = torch.stack(predictions)
+    loss = (predictions - ground_truth_positions.permute(1, 0, 2)) ** 2
+    return predictions, loss
+
+
+def _engine_rollout(simulator, position, nsteps):
+    return rollout_engine.rollout(
+        simulator, position[:, :2], nsteps, None, None,
+        ground_truth_positions=position[:, 2:], progress=False)
+
+
+def _run(loop, nparticles, dim, nsteps):
+    """Run in a fresh process: (peak RSS growth in MiB, seconds, mean loss)."""
+    torch.manual_seed(0)
+    position = torch.rand(nparticles, nsteps + 2, dim)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    _, loss = loop(ConstantVelocity(), position, nsteps)
+    seconds = time.perf_counter() - start
+    peak_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak) / 1024
+    return peak_growth, seconds, loss.mean().item()
+
+
+def main(_):
+    context = multiprocessing.get_context('spawn')
+    output_mib = FLAGS.nsteps * FLAGS.nparticles * FLAGS.dim * 4 / 2 ** 20
+    print(f"rollout output: {output_mib:.0f} MiB")
+    for name, loop in (("list + stack", _list_stack_rollout), ("rollout_engine", _engine_rollout)):
+        with context.Pool(1) as pool:
+            peak, seconds, loss = pool.apply(
+                _run, (loop, FLAGS.nparticles, FLAGS.dim, FLAGS.nsteps))
+        print(f"{name:>14}: peak RSS growth {peak:.0f} MiB, {seconds:.2f} s, loss {loss:.6e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,82 @@
+"""Per-step rollout latency with and without a precomputed RolloutContext.
+
+python -m benchmarks.bench_rollout_step --nparticles=1000 --dim=3 --num_prop=3
+
+Uses a randomly initialized simulator with the architecture of gns.train.
+"""
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+from gns import learned_simulator
+
+flags.DEFINE_integer('nparticles', 1000, help='Number of particles.')
+flags.DEFINE_integer('dim', 3, help='Number of chemical dimensions.')
+flags.DEFINE_integer('num_prop', 3, help='Number of material properties.')
+flags.DEFINE_integer('nsteps', 50, help='Number of timed rollout steps.')
+flags.DEFINE_string('knn_backend', 'auto', help='kNN graph backend.')
+
+FLAGS = flags.FLAGS
+
+INPUT_SEQUENCE_LENGTH = 2
+NUM_UNIVERSE_TYPES = 9
+
+
+def _simulator(dim, num_prop, precision='float32'):
+    stats = {'mean': torch.zeros(dim), 'std': torch.ones(dim)}
+    return learned_simulator.LearnedSimulator(
+        particle_dimensions=dim,
+        nnode_in=dim * (INPUT_SEQUENCE_LENGTH + 1) + 16 + num_prop,
+        nedge_in=dim + 1,
+        latent_dim=128,
+        nmessage_passing_steps=1,
+        nmlp_layers=2,
+        mlp_hidden_dim=256,
+        boundaries=np.array([[0., 1.]] * dim),
+        normalization_stats={'acceleration': stats, 'velocity': stats},
+        nparticle_types=1,
+        particle_type_embedding_size=16,
+        nuniverse_types=NUM_UNIVERSE_TYPES,
+        universe_number_embedding_size=16,
+        knn_backend=FLAGS.knn_backend,
+        precision=precision).eval()
+
+
+def _step_time(simulator, positions, inputs, context):
+    with torch.no_grad():
+        simulator.predict_positions(positions, **inputs, context=context)
+        start = time.perf_counter()
+        for _ in range(FLAGS.nsteps):
+            simulator.predict_positions(positions, **inputs, context=context)
+    return (time.perf_counter() - start) / FLAGS.nsteps
+
+
+def main(_):
+    torch.manual_seed(0)
+    n = FLAGS.nparticles
+    simulator = _simulator(FLAGS.dim, FLAGS.num_prop)
+    positions = torch.rand(n, INPUT_SEQUENCE_LENGTH, FLAGS.dim)
+    inputs = dict(
+        nparticles_per_example=torch.tensor([n]),
+        particle_types=torch.zeros(n, dtype=torch.long),
+        universe_numbers=torch.randint(NUM_UNIVERSE_TYPES, (n,)),
+        material_property=torch.rand(n, FLAGS.num_prop) if FLAGS.num_prop else None)
+
+    with torch.no_grad():
+        context = simulator.rollout_context(
+            inputs['particle_types'], inputs['universe_numbers'], inputs['material_property'])
+        difference = (simulator.predict_positions(positions, **inputs) -
+                      simulator.predict_positions(positions, **inputs, context=context)).abs().max()
+
+    before = _step_time(simulator, positions, inputs, None)
+    after = _step_time(simulator, positions, inputs, context)
+    print(f"without context: {before * 1e3:.2f} ms/step")
+    print(f"with context:    {after * 1e3:.2f} ms/step ({before / after:.2f}x)")
+    print(f"max |difference| of predicted positions: {difference:.2e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
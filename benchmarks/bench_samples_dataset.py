@@ -0,0 +1,68 @@
+"""Micro-benchmark of SamplesDataset batching: per-sample __getitem__ + collate_fn vs. vectorized get_batch.
+
+python -m benchmarks.bench_samples_dataset --data_path='<prepared data path>'
+
+Without --data_path a synthetic train.npz is generated.
+"""
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+from gns import data_loader
+
+flags.DEFINE_string('data_path', None, help='Prepared data directory (default: synthetic).')
+flags.DEFINE_integer('ntimes', 1440, help='Number of synthetic time steps.')
+flags.DEFINE_integer('nparticles', 1000, help='Number of synthetic particles.')
+flags.DEFINE_integer('dim', 3, help='Number of synthetic chemical dimensions.')
+flags.DEFINE_integer('batch_size', 3, help='The batch size.')
+flags.DEFINE_integer('nbatches', 200, help='Number of batches timed per path.')
+
+FLAGS = flags.FLAGS
+
+INPUT_SEQUENCE_LENGTH = 2
+
+
+def _make_synthetic(path):
+    rng = np.random.default_rng(0)
+    n = FLAGS.nparticles
+    data = np.array([rng.random((FLAGS.ntimes, n, FLAGS.dim)), np.ones(n, dtype=int),
+                     np.zeros(n, dtype=int), rng.random((n, 3))], dtype="object")
+    np.savez(os.path.join(path, "train.npz"), x=data)
+
+
+def _samples_per_second(loader):
+    nsamples = 0
+    start = time.perf_counter()
+    for i, example in enumerate(loader):
+        nsamples += len(example[0][-1])
+        if i + 1 == FLAGS.nbatches:
+            break
+    return nsamples / (time.perf_counter() - start)
+
+
+def main(_):
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = FLAGS.data_path
+        if data_path is None:
+            _make_synthetic(tmp)
+            data_path = tmp
+        path = data_loader.get_split_path(data_path, "train")
+
+        torch.manual_seed(0)
+        current = _samples_per_second(data_loader.get_data_loader_by_samples(
+            path, INPUT_SEQUENCE_LENGTH, FLAGS.batch_size, vectorized=False))
+        torch.manual_seed(0)
+        vectorized = _samples_per_second(data_loader.get_data_loader_by_samples(
+            path, INPUT_SEQUENCE_LENGTH, FLAGS.batch_size, vectorized=True))
+
+    print(f"__getitem__ + collate_fn: {current:.1f} samples/sec")
+    print(f"vectorized get_batch:     {vectorized:.1f} samples/sec ({vectorized / current:.2f}x)")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,82 @@
+"""Job throughput of gns.serve against one gns.train process per job.
+
+python -m benchmarks.bench_serve --data_path='<prepared data path>' --model_path='<model storage path>'
+       --model_file='model-<step>.pt' --njobs=64 --nclients=16
+
+Every job rolls out the first trajectory of the test split. The baseline runs
+`python -m gns.train --mode=rollout` once per job (--nbaseline_jobs of them);
+the server is started once, warmed up with one job, and then receives --njobs
+jobs from --nclients concurrent clients over a Unix socket.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from absl import app
+from absl import flags
+
+from gns import data_loader
+from gns import serve
+
+flags.DEFINE_integer('njobs', 64, help='Number of jobs sent to the server.')
+flags.DEFINE_integer('nclients', 16, help='Number of concurrent clients.')
+flags.DEFINE_integer('nbaseline_jobs', 4, help='Number of process-per-job runs.')
+
+FLAGS = flags.FLAGS
+
+
+def _baseline(output_path):
+    start = time.perf_counter()
+    for _ in range(FLAGS.nbaseline_jobs):
+        subprocess.run(
+            [sys.executable, "-m", "gns.train", "--mode=rollout", f"--data_path={FLAGS.data_path}",
+             f"--model_path={FLAGS.model_path}", f"--model_file={FLAGS.model_file}",
+             f"--output_path={output_path}/"],
+            check=True, capture_output=True)
+    return FLAGS.nbaseline_jobs / (time.perf_counter() - start)
+
+
+def _serve(socket_path, example):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gns.serve", f"--socket_path={socket_path}",
+         f"--data_path={FLAGS.data_path}", f"--model_path={FLAGS.model_path}",
+         f"--max_batch_size={FLAGS.nclients}"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        client = serve.Client(socket_path)
+        while not os.path.exists(socket_path):
+            time.sleep(0.1)
+        start = time.perf_counter()
+        client.rollout(*example, model_file=FLAGS.model_file)
+        first = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(FLAGS.nclients) as executor:
+            list(executor.map(lambda _: client.rollout(*example, model_file=FLAGS.model_file),
+                              range(FLAGS.njobs)))
+        return first, FLAGS.njobs / (time.perf_counter() - start)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(_):
+    trajectory = data_loader.load_data(data_loader.get_split_path(FLAGS.data_path, 'test'))[0]
+    positions, *features = [np.asarray(array) for array in trajectory]
+    # Stored as (timesteps, nparticles, dim)
+    example = (positions.transpose(1, 0, 2), *features)
+
+    with tempfile.TemporaryDirectory() as path:
+        baseline = _baseline(path)
+        first, served = _serve(os.path.join(path, "gns.sock"), example)
+    print(f"process per job: {baseline:.2f} jobs/s")
+    print(f"gns.serve:       {served:.2f} jobs/s ({served / baseline:.1f}x), "
+          f"first job incl. model load {first:.2f} s")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,77 @@
+"""Model evaluations and time saved by steady state detection.
+
+python -m benchmarks.bench_steady_state --nparticles=10000 --nsteps=1000 --steady_state_tol=1e-4
+
+A stand-in simulator relaxes every particle towards a fixed composition (its
+velocity decays by --decay per step) and runs an MLP of the size of the GNS
+node MLPs on every particle per step, so the model cost dominates. The full
+rollout is compared with a steady state monitor that stops the rollout or
+extrapolates the remaining steps; the error is the largest deviation from the
+full rollout over the steps both have.
+"""
+import time
+
+import torch
+from absl import app
+from absl import flags
+
+from gns import rollout_engine
+
+flags.DEFINE_integer('nparticles', 10000, help='Number of particles.')
+flags.DEFINE_integer('dim', 3, help='Number of chemical dimensions.')
+flags.DEFINE_integer('nsteps', 1000, help='Rollout horizon.')
+flags.DEFINE_float('decay', 0.95, help='Velocity decay per step of the stand-in simulator.')
+flags.DEFINE_float('steady_state_tol', 1e-4, help='RMS velocity per species of a steady state.')
+flags.DEFINE_integer('steady_state_window', 10, help='Steps below the tolerance before stopping.')
+
+FLAGS = flags.FLAGS
+
+
+class Relaxation:
+    """Stand-in simulator: x_{t+1} = x_t + decay * (x_t - x_{t-1}), at the cost of an MLP."""
+
+    def __init__(self, dim, decay):
+        self.decay = decay
+        self.mlp = torch.nn.Sequential(
+            torch.nn.Linear(dim, 256), torch.nn.ReLU(), torch.nn.Linear(256, 256), torch.nn.ReLU(),
+            torch.nn.Linear(256, 128))
+        self.nevaluations = 0
+
+    def predict_positions(self, current_positions, **kwargs):
+        self.nevaluations += 1
+        self.mlp(current_positions[:, -1])
+        return current_positions[:, -1] + self.decay * (current_positions[:, -1] - current_positions[:, -2])
+
+    def rollout_context(self, *args):
+        return None
+
+    def reset_graph_cache(self):
+        pass
+
+
+def _rollout(initial_positions, monitor):
+    """(predictions, model evaluations, seconds)"""
+    simulator = Relaxation(FLAGS.dim, FLAGS.decay)
+    start = time.perf_counter()
+    with torch.no_grad():
+        predictions, _ = rollout_engine.rollout(
+            simulator, initial_positions, FLAGS.nsteps, None, None, progress=False, monitor=monitor)
+    return predictions, simulator.nevaluations, time.perf_counter() - start
+
+
+def main(_):
+    torch.manual_seed(0)
+    initial_positions = torch.rand(FLAGS.nparticles, 2, FLAGS.dim)
+    full, nevaluations, seconds = _rollout(initial_positions, None)
+    print(f"{'full':>11}: {nevaluations} model evaluations, {seconds:.2f} s")
+    for action in rollout_engine.SteadyStateMonitor.ACTIONS:
+        monitor = rollout_engine.SteadyStateMonitor(
+            FLAGS.steady_state_tol, FLAGS.steady_state_window, action)
+        predictions, nevaluations, seconds = _rollout(initial_positions, monitor)
+        error = (predictions - full[:len(predictions)]).abs().max().item()
+        print(f"{action:>11}: {nevaluations} model evaluations, {seconds:.2f} s, {len(predictions)} steps, "
+              f"steady after {monitor.stop_step}, max deviation {error:.2e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,93 @@
+"""Accuracy vs. speed of multi-step (strided) prediction.
+
+python -m benchmarks.bench_stride --data_path='<prepared data path>' --strides=1,2,4 --ntraining_steps=2000
+
+For every stride k a model is trained from scratch with
+`python -m gns.train --temporal_stride=k` (same number of training steps for all
+strides) and rolls out the test split, taking k dataset steps per model step.
+Reported per stride: model evaluations and time of the rollouts, the MSE over
+the predicted (every k-th) frames and the MSE at the last frame that every
+stride reaches.
+"""
+import math
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+from gns import data_loader
+from gns import reading_utils
+from gns import train
+
+flags.DEFINE_list('strides', ['1', '2', '4'], help='Temporal strides to compare.')
+
+FLAGS = flags.FLAGS
+
+
+def _train(model_path, stride):
+    subprocess.run(
+        [sys.executable, "-m", "gns.train", "--mode=train", f"--data_path={FLAGS.data_path}",
+         f"--model_path={model_path}/", f"--ntraining_steps={FLAGS.ntraining_steps}",
+         f"--nsave_steps={FLAGS.ntraining_steps}", f"--temporal_stride={stride}",
+         f"--nmessage_passing_steps={FLAGS.nmessage_passing_steps}"],
+        check=True, capture_output=True)
+    return f"{model_path}/model-{FLAGS.ntraining_steps}.pt"
+
+
+def _rollouts(model_file, stride, trajectories, final_frame):
+    """(model evaluations, seconds, MSE over the strided frames, MSE at `final_frame`)."""
+    FLAGS.temporal_stride = stride
+    metadata = reading_utils.read_metadata(FLAGS.data_path, "rollout")
+    n_features = 3 if trajectories[0][3] is None else 4
+    simulator = train.load_rollout_simulator(metadata, n_features, model_file, 'cpu')
+    nevaluations = 0
+    seconds = 0.
+    losses = []
+    final_errors = []
+    with torch.no_grad():
+        for positions, particle_type, universe_number, material_property in trajectories:
+            nsteps = train.rollout_nsteps(positions.shape[1], stride)
+            example = (positions[:, ::stride], particle_type, universe_number, material_property,
+                       torch.tensor([positions.shape[0]]))
+            start = time.perf_counter()
+            output_dict, loss = train.rollout_batch(simulator, [example], nsteps, progress=False)[0]
+            seconds += time.perf_counter() - start
+            nevaluations += nsteps
+            losses.append(loss.mean().item())
+            # Strided frame j is dataset frame j * stride
+            predicted = output_dict['predicted_rollout'][final_frame // stride - train.INPUT_SEQUENCE_LENGTH]
+            final_errors.append(np.mean((predicted - positions[:, final_frame].numpy()) ** 2))
+    return nevaluations, seconds, np.mean(losses), np.mean(final_errors)
+
+
+def main(_):
+    strides = [int(stride) for stride in FLAGS.strides]
+    trajectories = []
+    for trajectory in data_loader.load_data(data_loader.get_split_path(FLAGS.data_path, 'test')):
+        positions, particle_type, universe_number, *material_property = [
+            torch.as_tensor(np.asarray(array)) for array in trajectory]
+        # Stored as (timesteps, nparticles, dim)
+        trajectories.append((positions.permute(1, 0, 2).float(), particle_type.long(),
+                             universe_number.long(),
+                             material_property[0].float() if material_property else None))
+    sequence_length = min(positions.shape[1] for positions, *_ in trajectories)
+    # Last dataset frame that every stride predicts
+    period = math.lcm(*strides)
+    final_frame = (sequence_length - 1) // period * period
+
+    print(f"{len(trajectories)} test trajectories, final frame {final_frame}")
+    with tempfile.TemporaryDirectory() as path:
+        for stride in strides:
+            model_file = _train(f"{path}/stride{stride}", stride)
+            nevaluations, seconds, loss, final_loss = _rollouts(model_file, stride, trajectories, final_frame)
+            print(f"stride {stride}: {nevaluations} model evaluations, {seconds:.3f} s, "
+                  f"rollout MSE {loss:.4e}, MSE at frame {final_frame} {final_loss:.4e}")
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -5,6 +5,8 @@ from glob import glob
 from pathlib import Path
 import os
 
+from gns import rollout_store
+
 density_dict = {'SO4': 1800,
                 'BC': 1700,
                 'OC': 1000,
@@ -13,16 +15,20 @@ density_dict = {'SO4': 1800,
                     
                     
 def load_rollout_data(path):
-    ''' Load pickle rollout files output by GNS.
+    ''' Load pickle rollout files or chunked rollout stores output by GNS.
     Args:
     path: path to the pickle files (default gns/output/), where each file corresponds to a rollout.
     
     Returns:
-    dictionary: keys are string names of the rollout files.
+    dictionary: keys are string names of the rollout files. The arrays of chunked
+    stores (--rollout_format=chunked) are memory-mapped and only read when sliced.
     '''
     rollouts = {}
     for file in Path(path).glob("*.pkl"):
         rollouts[file.name] = pickle.load(open(file, "rb"))
+    for directory in Path(path).iterdir():
+        if rollout_store.is_rollout_store(directory):
+            rollouts[directory.name] = rollout_store.load_rollout(directory)
     return rollouts
 
 def volume(chem, mass):
@@ -4,10 +4,13 @@ import pickle
 import matplotlib.pyplot as plt
 from chem_data.prepare_data import *
 from chem_data.analyze_results import *
+from gns import data_loader
+from pathlib import Path
 
 
-flags.DEFINE_enum('action', None, ['prepare', 'analyze', 'predict'],
-    help='Prepare raw data for training or analyze rollout results.')
+flags.DEFINE_enum('action', None, ['prepare', 'prepare-all', 'analyze', 'predict', 'convert'],
+    help='Prepare raw data for training (one scenario or all of them with a shared normalization), '
+         'analyze rollout results or convert npz splits to the columnar format.')
 
 flags.DEFINE_string('raw_data_path', 'chem_data/raw_data/', help='The raw dataset directory.')
 flags.DEFINE_string('preped_data_path', 'gns/data/', help='The path for saving the prepared data for training.')
@@ -20,11 +23,17 @@ flags.DEFINE_list('particle_chem', ['H2O', 'SO4'], help='List of particle phase
 flags.DEFINE_list('gases', ['H2SO4'], help='List of gas phase chemicals.')
 
 flags.DEFINE_integer('universe', 0, help='Example number to track differences in environmental conditions')
+flags.DEFINE_list('scenarios', None, help='prepare-all: scenario subdirectories of raw_data_path (default: all of them).')
+flags.DEFINE_list('universes', None, help='prepare-all: universe number of each scenario (default: 0, 1, ...).')
+flags.DEFINE_bool('reuse_unnorm', False, help='prepare/predict: normalize with the existing share_path/unnorm.pkl instead of overwriting it.')
+flags.DEFINE_integer('nworkers', None, help='Number of processes parsing raw txt files, or preparing scenarios for prepare-all (default: up to the cpu count).')
+flags.DEFINE_bool('raw_cache', True, help='Cache parsed raw txt files as float32 .npy sidecars keyed by size and mtime.')
+flags.DEFINE_enum('dataset_format', 'npz', ['npz', 'columnar'],
+    help='On-disk format of the prepared splits: object-dtype npz or memory-mappable columnar directories.')
 
 FLAGS = flags.FLAGS
 
 
-
 def main(_):
     myflags = {}
     myflags["raw_data_path"] = FLAGS.raw_data_path
@@ -36,65 +45,70 @@ def main(_):
     myflags["particle_chem"] = FLAGS.particle_chem
     myflags["gases"] = FLAGS.gases
     myflags["universe"] = FLAGS.universe
+    myflags["nworkers"] = FLAGS.nworkers
+    myflags["raw_cache"] = FLAGS.raw_cache
+    myflags["dataset_format"] = FLAGS.dataset_format
+    myflags["scenarios"] = FLAGS.scenarios
+    myflags["universes"] = None if FLAGS.universes is None else [int(u) for u in FLAGS.universes]
+    myflags["reuse_unnorm"] = FLAGS.reuse_unnorm
     
     mol_mass = {'H2SO4': 0.09808,
                 'OH': 0.01701,
                 'SO2': 0.064}
         
     if FLAGS.action in ['prepare', 'predict']:
-        feats_dict = load_raw_data(myflags["raw_data_path"])
-
-        # material properties don't change over time
-        # shape[0] must equal the number of particles
-        mat_prop = []
-        for prop in myflags["material_properties"]:
-            mat_prop += [feats_dict[prop][0]]
-        MP = np.vstack(mat_prop)
-        MP = MP.transpose()
-        
-        
-        ptype = [np.array([1]*feats_dict['H2O'].shape[1])]
-        unumber = [np.array([myflags["universe"]]*feats_dict['H2O'].shape[1])]
+        filename = os.path.join(myflags["share_path"], f'unnorm.pkl')
+        unnorm = None
+        if myflags["reuse_unnorm"]:
+            with open(filename, 'rb') as f:
+                unnorm = pickle.load(f)
 
-        # these make up the dimensions of the gns
-        time_changing_features = []
-        
-        for i, chem in enumerate(myflags["particle_chem"] + myflags["gases"]):
-            if i < len(myflags["particle_chem"]):
-                time_changing_features += [feats_dict[chem]]
-            else:
-                time_changing_features += [np.log10(feats_dict[chem])] #[mol_mass[chem]*feats_dict[chem]*4.09e-11]
-        
-        X = np.stack(time_changing_features, axis=-1)
-        X = X[1:,:,:] # data for time step 0 is too different
-        ptype = np.concatenate(ptype)
-        unumber = np.concatenate(unumber)
-
-        # normalize values to be in the 0-1 interval
-        norm_X, min_x, max_x = normalize(X)
-        norm_MP, min_mp, max_mp = normalize(MP)
-        
-        unnorm = [min_x, max_x, min_mp, max_mp]
+        new_unnorm = prepare_example(myflags["raw_data_path"], myflags["preped_data_path"], myflags["universe"],
+                                     myflags["material_properties"], myflags["particle_chem"], myflags["gases"],
+                                     action=FLAGS.action, dataset_format=myflags["dataset_format"], unnorm=unnorm,
+                                     nworkers=myflags["nworkers"], raw_cache=myflags["raw_cache"])
+
+        if unnorm is None:
+            with open(filename, 'wb') as f:
+                pickle.dump(new_unnorm, f)
+
+    elif FLAGS.action == 'prepare-all':
+        scenarios = myflags["scenarios"]
+        if scenarios is None:
+            scenarios = sorted(d.name for d in Path(myflags["raw_data_path"]).iterdir()
+                               if d.is_dir() and not d.name.startswith("."))
+        universes = myflags["universes"]
+        if universes is None:
+            universes = list(range(len(scenarios)))
+        if len(universes) != len(scenarios):
+            raise ValueError("--universes must give one universe number per scenario.")
+        raw_paths = [os.path.join(myflags["raw_data_path"], scenario) for scenario in scenarios]
+
+        # pass 1: global min/max, one scenario in memory at a time
+        unnorm = global_extrema(raw_paths, myflags["material_properties"], myflags["particle_chem"],
+                                myflags["gases"], nworkers=myflags["nworkers"], raw_cache=myflags["raw_cache"])
         filename = os.path.join(myflags["share_path"], f'unnorm.pkl')
         with open(filename, 'wb') as f:
             pickle.dump(unnorm, f)
-        
 
-        if FLAGS.action == 'prepare':
-            split_dict, idxs, train_cutoff, test_cutoff = data_splits(norm_X, ptype, unumber, norm_MP, traincut=0.6, testcut=0.9)
-            train_pre = np.array(split_dict["train_data"], dtype="object")
-            test_pre = np.array(split_dict["test_data"], dtype="object")
-            np.savez(os.path.join(myflags["preped_data_path"], "train.npz"), x=train_pre)
-            np.savez(os.path.join(myflags["preped_data_path"], "test.npz"), x=test_pre)
-
-            if "val_data" in split_dict:
-                val_pre = np.array(split_dict["val_data"], dtype="object")
-                np.savez(os.path.join(myflags["preped_data_path"], "valid.npz"), x=val_pre)
-
-            make_metadata_file(myflags["preped_data_path"], split_dict["train_data"])
-        else:
-            pred_pre = np.array([norm_X, ptype, unumber, norm_MP], dtype="object")
-            np.savez(os.path.join(myflags["preped_data_path"], "predict.npz"), x=pred_pre)
+        # pass 2: write every example folder with the shared normalization
+        jobs = []
+        for example_number, (raw_path, universe) in enumerate(zip(raw_paths, universes)):
+            example_folder = os.path.join(myflags["preped_data_path"], f"example{example_number}")
+            os.makedirs(example_folder, exist_ok=True)
+            print(f"{raw_path} -> {example_folder} (universe {universe})")
+            jobs.append(dict(raw_data_path=raw_path, preped_data_path=example_folder, universe=universe,
+                             material_properties=myflags["material_properties"],
+                             particle_chem=myflags["particle_chem"], gases=myflags["gases"],
+                             dataset_format=myflags["dataset_format"], unnorm=unnorm,
+                             nworkers=1, raw_cache=myflags["raw_cache"]))
+        prepare_examples(jobs, nworkers=myflags["nworkers"])
+
+    elif FLAGS.action == 'convert':
+        for split in ["train", "test", "valid", "predict"]:
+            npz_file = os.path.join(myflags["preped_data_path"], f"{split}.npz")
+            if os.path.exists(npz_file):
+                print(f"Converted {npz_file} to {data_loader.convert_npz_to_columnar(npz_file)}")
     
     elif FLAGS.action == 'analyze':
         rollout_dict = load_rollout_data(myflags["rollout_data_path"])
@@ -133,7 +147,7 @@ def main(_):
             for j in range(reshaped_mat_prop.shape[-1]):
                 outdata_dict['mat_prop'][mp_names[j]] = reshaped_mat_prop[:,:,j]
                 
-            filename = os.path.join(myflags["proc_data_path"], f'{rollout_name[:-4]}{name_i}_dict.pkl')
+            filename = os.path.join(myflags["proc_data_path"], f'{os.path.splitext(rollout_name)[0]}{name_i}_dict.pkl')
             with open(filename, 'wb') as f:
                 pickle.dump(outdata_dict, f)
             name_i += 1
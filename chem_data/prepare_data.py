@@ -1,117 +1,482 @@
-from glob import glob
+from glob import glob, escape as glob_escape
 import re
 import numpy as np
 from pathlib import Path
 from random import shuffle
 import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from gns import columnar
 
-def load_raw_data(path):
+def _feature_name(file):
+    l = re.split("_", file.name)[:-1]
+    if len(l) > 1:
+        return "_".join(l)
+    return l[0]
+
+def _cache_file(file):
+    ''' Sidecar cache path for a raw txt file, keyed by the file size and mtime.'''
+    stat = file.stat()
+    return file.with_name(f"{file.name}.{stat.st_size}-{stat.st_mtime_ns}.npy")
+
+def _write_cache(file, data):
+    ''' Write the float32 sidecar cache of a raw txt file.
+
+    Returns:
+    path of the cache, or None when it cannot be written (e.g. a read-only raw directory)
+    '''
+    cache_file = _cache_file(file)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        # drop caches written for older versions of the text file
+        for stale in file.parent.glob(f"{glob_escape(file.name)}.*.npy"):
+            stale.unlink(missing_ok=True)
+        with open(tmp_file, "wb") as f:
+            np.save(f, data.astype(np.float32))
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        tmp_file.unlink(missing_ok=True)
+        print(f"Not caching {file}: {e}")
+        return None
+    return cache_file
+
+def _parse_raw_file(file, cache=True):
+    ''' Parse one partMC txt file, reusing (or writing) its float32 npy sidecar cache.
+    Args:
+    file: pathlib.Path of the text file.
+    cache: when True, memory-map a valid cache or write one after parsing. When the cache
+    cannot be written, the file is parsed without caching (float64).
+
+    Returns:
+    np.array of shape (number of time steps, number of particles)
+    '''
+    if cache:
+        cache_file = _cache_file(file)
+        if cache_file.exists():
+            return np.load(cache_file, mmap_mode="r")
+
+    data = np.loadtxt(file)
+    if cache and _write_cache(file, data) is not None:
+        return data.astype(np.float32)
+    return data
+
+def _parse_raw_file_to_cache(file):
+    # Runs in a worker process: only the cache path travels back to the parent,
+    # which memory-maps it instead of receiving the pickled array. Without a
+    # cache the parsed array itself is returned.
+    data = np.loadtxt(file)
+    return _write_cache(file, data) or data
+
+def load_raw_data(path, nworkers=None, cache=True):
     ''' Load txt files output by partMC.
     Args:
     path: path to the text files, where each file has the masses of particles over time
     corresponding to one chemical.
+    nworkers: number of processes parsing files at the same time (default: one per file,
+    up to the cpu count). Use 1 to parse serially.
+    cache: keep a float32 .npy sidecar next to each txt file, keyed by file size and mtime,
+    and memory-map it on later calls instead of parsing the text again.
+    Set to False for the original float64 np.loadtxt behaviour. Files whose cache cannot be
+    written (read-only raw directory) are parsed without caching.
     
     Returns:
     dictionary: keys are string names of chemicals and values are np.arrays of shape
     (number of time steps, number of particles)
     '''
-    feats = {}
-    for file in Path(path).glob("*.txt"):
-        l = re.split("_", file.name)[:-1]
-        if len(l) > 1:
-            feats["_".join(l)] = np.loadtxt(file)
+    files = sorted(Path(path).glob("*.txt"))
+    if nworkers is None:
+        nworkers = min(len(files), os.cpu_count() or 1)
+
+    loaded = {}
+    todo = []
+    for file in files:
+        if cache and _cache_file(file).exists():
+            loaded[file] = _parse_raw_file(file)
         else:
-            feats[l[0]] = np.loadtxt(file)
-    return feats
+            todo.append(file)
 
-def normalize(X):
+    if nworkers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            if cache:
+                for file, result in zip(todo, pool.map(_parse_raw_file_to_cache, todo)):
+                    loaded[file] = result if isinstance(result, np.ndarray) else np.load(result, mmap_mode="r")
+            else:
+                for file, data in zip(todo, pool.map(np.loadtxt, todo)):
+                    loaded[file] = data
+    else:
+        for file in todo:
+            loaded[file] = _parse_raw_file(file, cache=cache)
+
+    return {_feature_name(file): loaded[file] for file in files}
+
+def feature_extrema(X):
+    ''' Min and max used by normalize: per feature for (time, particles, dim) arrays,
+    global for (particles, props) arrays and per column for 1-D arrays.'''
     if len(X.shape) > 1:
         x_min = X.min(axis=1).min(axis=0)
         x_max = X.max(axis=1).max(axis=0)
     else:
         x_min = X.min(axis=0)
         x_max = X.max(axis=0)
-    return (X - x_min) / (x_max - x_min), x_min, x_max
+    return x_min, x_max
 
+def apply_normalization(X, x_min, x_max):
+    return (X - x_min) / (x_max - x_min)
 
-def data_splits(ts_chems, ptypes, unumbers, mat_props, traincut=0.6, testcut=1.0):
-    splits = {}
-    idxs = list(range(ts_chems.shape[1]))
-    shuffle(idxs)
-    
-    train_cutoff = int(ts_chems.shape[1]*traincut)
-    test_cutoff = int(ts_chems.shape[1]*testcut)
-    
-    train_X = ts_chems[:,idxs[:train_cutoff],:] 
-    test_X = ts_chems[:,idxs[train_cutoff:test_cutoff],:]
-    val_X = ts_chems[:,idxs[test_cutoff:],:]
-    
-    train_ptype = ptypes[idxs[:train_cutoff]]
-    test_ptype = ptypes[idxs[train_cutoff:test_cutoff]]
-    val_ptype = ptypes[idxs[test_cutoff:]]
-    
-    train_unumber = unumbers[idxs[:train_cutoff]]
-    test_unumber = unumbers[idxs[train_cutoff:test_cutoff]]
-    val_unumber = unumbers[idxs[test_cutoff:]]
-    
-    if len(mat_props.shape) > 1:
-        train_MP = mat_props[idxs[:train_cutoff],:]
-        test_MP = mat_props[idxs[train_cutoff:test_cutoff],:]
-        val_MP = mat_props[idxs[test_cutoff:],:]
+def normalize(X):
+    x_min, x_max = feature_extrema(X)
+    return apply_normalization(X, x_min, x_max), x_min, x_max
+
+def build_features(feats_dict, material_properties, particle_chem, gases, universe):
+    ''' Assemble the gns inputs from the raw partMC features of one scenario.
+    Args:
+    feats_dict: output of load_raw_data.
+    material_properties: names of the properties that don't change over time.
+    particle_chem: names of the particle phase chemicals.
+    gases: names of the gas phase chemicals (log10 transformed).
+    universe: example number to track differences in environmental conditions.
+
+    Returns:
+    X (time steps - 1, particles, dim), ptype (particles), unumber (particles), MP (particles, props)
+    '''
+    # material properties don't change over time
+    # shape[0] must equal the number of particles
+    mat_prop = []
+    for prop in material_properties:
+        mat_prop += [feats_dict[prop][0]]
+    MP = np.vstack(mat_prop)
+    MP = MP.transpose()
+
+    ptype = np.array([1]*feats_dict['H2O'].shape[1])
+    unumber = np.array([universe]*feats_dict['H2O'].shape[1])
+
+    # these make up the dimensions of the gns
+    time_changing_features = []
+    for i, chem in enumerate(particle_chem + gases):
+        if i < len(particle_chem):
+            time_changing_features += [feats_dict[chem]]
+        else:
+            time_changing_features += [np.log10(feats_dict[chem])] #[mol_mass[chem]*feats_dict[chem]*4.09e-11]
+
+    X = np.stack(time_changing_features, axis=-1)
+    X = X[1:,:,:] # data for time step 0 is too different
+    return X, ptype, unumber, MP
+
+def remove_other_format(path, split, dataset_format):
+    ''' Remove the split in the format other than dataset_format, so that a stale copy never shadows
+    the new one (data_loader.get_split_path prefers the columnar split/ directory over split.npz).'''
+    if dataset_format == 'columnar':
+        npz_path = os.path.join(path, f"{split}.npz")
+        if os.path.exists(npz_path):
+            os.remove(npz_path)
+    elif columnar.is_columnar(os.path.join(path, split)):
+        shutil.rmtree(os.path.join(path, split))
+
+def save_split(path, split, data, dataset_format):
+    ''' Save one prepared split [X, ptype, unumber, MP] as split.npz or as a columnar split/ directory,
+    replacing the split in the other format.'''
+    if dataset_format == 'columnar':
+        columnar.save_columnar_data(os.path.join(path, split), [data])
     else:
-        train_MP = mat_props[idxs[:train_cutoff]]
-        test_MP = mat_props[idxs[train_cutoff:test_cutoff]]
-        val_MP = mat_props[idxs[test_cutoff:]]
-        
-    splits["train_data"] = [train_X, train_ptype, train_unumber, train_MP]
-    splits["test_data"] = [test_X, test_ptype, test_unumber, test_MP]
-    
-    
+        pre = np.array(data, dtype="object")
+        np.savez(os.path.join(path, f"{split}.npz"), x=pre)
+    remove_other_format(path, split, dataset_format)
+
+def prepare_example(raw_data_path, preped_data_path, universe, material_properties, particle_chem, gases,
+                    action='prepare', dataset_format='npz', unnorm=None, nworkers=None, raw_cache=True):
+    ''' Prepare the train/test/valid (or predict) data of one scenario.
+    Args:
+    raw_data_path: directory with the partMC txt files of the scenario.
+    preped_data_path: output directory.
+    unnorm: [min_x, max_x, min_mp, max_mp] to normalize with. If None, the scenario's own
+    min/max are used.
+    (other arguments as in build_features, save_split and load_raw_data)
+
+    Returns:
+    unnorm: the normalization values used.
+    '''
+    feats_dict = load_raw_data(raw_data_path, nworkers=nworkers, cache=raw_cache)
+    X, ptype, unumber, MP = build_features(feats_dict, material_properties, particle_chem, gases, universe)
+
+    # normalize values to be in the 0-1 interval
+    if unnorm is None:
+        unnorm = list(feature_extrema(X) + feature_extrema(MP))
+    min_x, max_x, min_mp, max_mp = unnorm
+    norm_X = apply_normalization(X, min_x, max_x)
+    norm_MP = apply_normalization(MP, min_mp, max_mp)
+
+    split_names = {"train_data": "train", "test_data": "test", "val_data": "valid"}
+    if action == 'prepare' and dataset_format == 'columnar':
+        # one shuffled copy of the particles on disk, splits are particle ranges of it
+        canonical, ranges, idxs = canonical_splits(norm_X, ptype, unumber, norm_MP, traincut=0.6, testcut=0.9)
+        columnar.save_columnar_splits(preped_data_path, canonical,
+                                      {split_names[key]: ranges[key] for key in ranges})
+        for split in split_names.values():
+            remove_other_format(preped_data_path, split, dataset_format)
+        make_metadata_file(preped_data_path, split_views(canonical, *ranges["train_data"]))
+    elif action == 'prepare':
+        split_dict, idxs, train_cutoff, test_cutoff = data_splits(norm_X, ptype, unumber, norm_MP, traincut=0.6, testcut=0.9)
+        for key in split_dict:
+            save_split(preped_data_path, split_names[key], split_dict[key], dataset_format)
+        # particle arrays of a former columnar preparation, no longer referenced
+        shared_path = os.path.join(preped_data_path, "particles")
+        if dataset_format == 'npz' and os.path.isdir(shared_path):
+            shutil.rmtree(shared_path)
+
+        make_metadata_file(preped_data_path, split_dict["train_data"])
+    else:
+        save_split(preped_data_path, "predict", [norm_X, ptype, unumber, norm_MP], dataset_format)
+    return unnorm
+
+def global_extrema(raw_data_paths, material_properties, particle_chem, gases, nworkers=None, raw_cache=True):
+    ''' Stream over scenarios, one at a time, and reduce their normalization min/max.
+
+    Returns:
+    unnorm: [min_x, max_x, min_mp, max_mp] covering every scenario.
+    '''
+    unnorm = None
+    for path in raw_data_paths:
+        feats_dict = load_raw_data(path, nworkers=nworkers, cache=raw_cache)
+        X, _, _, MP = build_features(feats_dict, material_properties, particle_chem, gases, 0)
+        extrema = feature_extrema(X) + feature_extrema(MP)
+        if unnorm is None:
+            unnorm = list(extrema)
+        else:
+            unnorm = [np.minimum(unnorm[0], extrema[0]), np.maximum(unnorm[1], extrema[1]),
+                      np.minimum(unnorm[2], extrema[2]), np.maximum(unnorm[3], extrema[3])]
+        del feats_dict, X, MP
+    return unnorm
+
+def _prepare_example_job(kwargs):
+    return prepare_example(**kwargs)
+
+def prepare_examples(jobs, nworkers=None):
+    ''' Run prepare_example for several scenarios in a process pool.
+    Args:
+    jobs: list of keyword argument dicts for prepare_example.
+    nworkers: number of processes (default: one per scenario, up to the cpu count).
+    '''
+    if nworkers is None:
+        nworkers = min(len(jobs), os.cpu_count() or 1)
+    if nworkers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            list(pool.map(_prepare_example_job, jobs))
+    else:
+        for job in jobs:
+            _prepare_example_job(job)
+
+
+def canonical_splits(ts_chems, ptypes, unumbers, mat_props, traincut=0.6, testcut=1.0):
+    ''' Reorder the particles once by a shuffled permutation, so that every split is a
+    contiguous particle range of the same arrays.
+
+    Returns:
+    canonical: [X, ptype, unumber, MP] with particles in shuffled order.
+    ranges: dictionary of (start, stop) particle ranges for "train_data", "test_data"
+    and, if testcut < 1.0, "val_data".
+    idxs: the permutation.
+    '''
+    nparticles = ts_chems.shape[1]
+    idxs = list(range(nparticles))
+    shuffle(idxs)
+
+    train_cutoff = int(nparticles*traincut)
+    test_cutoff = int(nparticles*testcut)
+
+    order = np.asarray(idxs)
+    canonical = [ts_chems[:,order,:], ptypes[order], unumbers[order], mat_props[order]]
+    ranges = {"train_data": (0, train_cutoff),
+              "test_data": (train_cutoff, test_cutoff)}
     if testcut < 1.0:
-        splits["val_data"] = [val_X, val_ptype, val_unumber, val_MP]
-        
-    return splits, idxs, train_cutoff, test_cutoff  
+        ranges["val_data"] = (test_cutoff, nparticles)
+    return canonical, ranges, idxs
+
+def split_views(canonical, start, stop):
+    ''' Zero-copy [X, ptype, unumber, MP] view of a particle range of the canonical arrays.'''
+    X, ptype, unumber, MP = canonical
+    return [X[:,start:stop,:], ptype[start:stop], unumber[start:stop], MP[start:stop]]
+
+def data_splits(ts_chems, ptypes, unumbers, mat_props, traincut=0.6, testcut=1.0):
+    ''' Shuffle particles into train/test(/valid) splits.
+    The particles are reordered once (see canonical_splits) and each split is a view of that
+    single copy instead of a separately fancy-indexed array.
+
+    Returns:
+    splits: dictionary of [X, ptype, unumber, MP] for "train_data", "test_data" and, if
+    testcut < 1.0, "val_data".
+    idxs, train_cutoff, test_cutoff: the permutation and the split boundaries.
+    '''
+    canonical, ranges, idxs = canonical_splits(ts_chems, ptypes, unumbers, mat_props, traincut, testcut)
+    splits = {key: split_views(canonical, *ranges[key]) for key in ranges}
+    return splits, idxs, ranges["train_data"][1], ranges["test_data"][1]
+
+class MomentAccumulator:
+    ''' Running per-(particle, dim) mean and variance over time, updated with blocks of shape
+    (time, particles, dim) (Welford/Chan). Accumulators over different time blocks of the same
+    particles combine with merge; accumulators over different particles combine with extend.
+    '''
+    def __init__(self):
+        self.count = None # (particles, 1)
+        self.mean = None # (particles, dim)
+        self.m2 = None # (particles, dim)
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] == 0:
+            return
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean)**2).sum(axis=0)
+        block_count = np.full((block.shape[1], 1), block.shape[0], dtype=np.float64)
+        self._combine(block_count, block_mean, block_m2)
 
-def make_metadata_file(path, training_data):
+    def merge(self, other):
+        if other.count is not None:
+            self._combine(other.count, other.mean, other.m2)
+
+    def extend(self, other):
+        if self.count is None:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+        elif other.count is not None:
+            self.count = np.concatenate([self.count, other.count])
+            self.mean = np.concatenate([self.mean, other.mean])
+            self.m2 = np.concatenate([self.m2, other.m2])
+
+    def _combine(self, count, mean, m2):
+        if self.count is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+class MetadataAccumulator:
+    ''' Single-pass statistics for metadata.json over consecutive time blocks of a
+    (time, particles, dim) array. Peak memory depends on the block size, not on the sequence length.
+
+    Accumulators over consecutive time ranges of the same particles (e.g. worker processes,
+    each given at least 2 time steps) combine with merge, in time order. Accumulators over
+    different particles (e.g. scenarios) combine with extend.
+    '''
+    def __init__(self):
+        self.vel = MomentAccumulator()
+        self.acc = MomentAccumulator()
+        self.x_min = None
+        self.x_max = None
+        self.sequence_length = 0
+        self.dim = None
+        # first/last two time steps, to difference across block boundaries
+        self._head = None
+        self._tail = None
+
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] == 0:
+            return
+        if self._head is None:
+            self._head = block[:2]
+        elif self._head.shape[0] < 2:
+            self._head = np.concatenate([self._head, block[:1]])
+        self._count_new_differences(self._tail, block)
+        self._update_bounds(block.min(axis=(0, 1)), block.max(axis=(0, 1)))
+        self.sequence_length += block.shape[0]
+        self.dim = block.shape[-1]
+
+    def merge(self, other):
+        ''' Add the statistics of `other`, which covers the time steps right after this one.'''
+        if other.sequence_length == 0:
+            return
+        if other._head is None or (self.sequence_length > 0 and self._tail is None):
+            raise ValueError("merge combines time ranges of the same particles, "
+                             "accumulators combined with extend cannot be merged")
+        if self.sequence_length == 0:
+            self._head = other._head
+            self.dim = other.dim
+        self._count_new_differences(self._tail, other._head, tail_only=other._tail)
+        self.vel.merge(other.vel)
+        self.acc.merge(other.acc)
+        self._update_bounds(other.x_min, other.x_max)
+        self.sequence_length += other.sequence_length
+
+    def extend(self, other):
+        ''' Add the statistics of `other`, which covers different particles.'''
+        if other.sequence_length == 0:
+            return
+        self.vel.extend(other.vel)
+        self.acc.extend(other.acc)
+        self._update_bounds(other.x_min, other.x_max)
+        self.sequence_length = max(self.sequence_length, other.sequence_length)
+        self.dim = other.dim
+        # the boundary time steps no longer cover every particle, so no more merges
+        self._head = self._tail = None
+
+    def _count_new_differences(self, tail, block, tail_only=None):
+        # velocities and accelerations that involve at least one time step of `block`
+        ntail = 0 if tail is None else tail.shape[0]
+        frames = block if tail is None else np.concatenate([tail, block])
+        vel = frames[1:] - frames[:-1]
+        acc = vel[1:] - vel[:-1]
+        if tail_only is None:
+            self.vel.update(vel[max(ntail - 1, 0):])
+            self.acc.update(acc[max(ntail - 2, 0):])
+            self._tail = frames[-2:]
+        else:
+            # merging: only the differences spanning the boundary are new
+            self.vel.update(vel[max(ntail - 1, 0):ntail])
+            self.acc.update(acc[max(ntail - 2, 0):ntail])
+            self._tail = tail_only
+
+    def _update_bounds(self, x_min, x_max):
+        self.x_min = x_min if self.x_min is None else np.minimum(self.x_min, x_min)
+        self.x_max = x_max if self.x_max is None else np.maximum(self.x_max, x_max)
+
+    def metadata(self, num_prop):
+        ''' The metadata.json dictionary.'''
+        # tolist() gives python floats, so float32 inputs (e.g. the raw data cache) serialize too
+        vel_mean = np.max(self.vel.mean, axis=0).tolist()
+        vel_std = np.max(self.vel.std(), axis=0)
+        acc_mean = np.max(self.acc.mean, axis=0).tolist()
+        acc_std = np.max(self.acc.std(), axis=0)
+
+        # in case of zeros
+        vel_std = np.where(np.abs(vel_std) <= 1e-22, 1e-22, vel_std).tolist()
+        acc_std = np.where(np.abs(acc_std) <= 1e-22, 1e-22, acc_std).tolist()
+
+        bounds = [list(t) for t in zip(self.x_min.round().tolist(), self.x_max.round().tolist())]
+
+        return {
+            "bounds": bounds,
+            "sequence_length": self.sequence_length,
+            "dim": self.dim,
+            "num_prop": num_prop,
+            "dt": 1,
+            "vel_mean": vel_mean,
+            "vel_std": vel_std,
+            "acc_mean": acc_mean,
+            "acc_std": acc_std
+        }
+
+
+def make_metadata_file(path, training_data, chunk_size=64):
     train_X = training_data[0]
-    train_ptype = training_data[1]
-    train_unumber = training_data[2]
     train_MP = training_data[3] if len(training_data) > 3 else None
-    
-    train_vel = train_X[1:,:,:] - train_X[:-1,:,:]
-    train_acc = train_vel[1:,:,:] - train_vel[:-1,:,:]
-    
-    vel_mean = list(np.max(np.mean(train_vel, axis=0), axis=0))
-    vel_std = list(np.max(np.std(train_vel, axis=0), axis=0))
-    acc_mean = list(np.max(np.mean(train_acc, axis=0), axis=0))
-    acc_std = list(np.max(np.std(train_acc, axis=0), axis=0))
 
-    # in case of zeros
-    vel_std = list(np.where(np.abs(vel_std) <= 1e-22, 1e-22, vel_std))
-    acc_std = list(np.where(np.abs(acc_std) <= 1e-22, 1e-22, acc_std))
+    # one pass over blocks of time steps instead of materializing velocities and accelerations
+    stats = MetadataAccumulator()
+    for start in range(0, train_X.shape[0], chunk_size):
+        stats.update(train_X[start:start + chunk_size])
 
-    stack_min = np.min(np.min(train_X, axis=0), axis=0).round() 
-    stack_max = np.max(np.max(train_X, axis=0), axis=0).round() 
-    
-    bounds = [list(t) for t in zip(stack_min, stack_max)]
-    
     # Data to be written
-    dictionary = {
-        "bounds": bounds,
-        "sequence_length": train_X.shape[0],
-        "dim": train_X.shape[-1],
-        "num_prop": train_MP.shape[-1],
-        "dt": 1,
-        "vel_mean": vel_mean,
-        "vel_std": vel_std,
-        "acc_mean": acc_mean,
-        "acc_std": acc_std
-    }
+    dictionary = stats.metadata(train_MP.shape[-1])
     # Serializing json
     json_object = json.dumps(dictionary, indent=4)
  
     # Writing to sample.json
     with open(os.path.join(path, "metadata.json"), "w") as outfile:
         outfile.write(json_object)
-    
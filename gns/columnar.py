@@ -0,0 +1,134 @@
+import json
+import os
+
+import numpy as np
+
+HEADER_FILE = "header.json"
+FORMAT_NAME = "glad-columnar"
+FORMAT_VERSION = 1
+# Order matches the tuples stored in the object-dtype npz files:
+# (positions, particle_type, universe_number, material_property (optional))
+FIELDS = ("positions", "particle_type", "universe_number", "material_property")
+
+
+def is_columnar(path: str) -> bool:
+    """Whether `path` is a columnar dataset directory.
+
+    Args:
+        path (str): Path to check.
+
+    Returns:
+        bool: True if `path` holds a columnar header file.
+    """
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def _write_array(path, name, array):
+    """Write `array` as a raw C-ordered file and return its header entry."""
+    array = np.ascontiguousarray(array)
+    array.tofile(os.path.join(path, name))
+    return {"file": name, "dtype": array.dtype.str, "shape": list(array.shape)}
+
+
+def _open_array(path, entry):
+    """Memory-map one array described by a header entry (read only)."""
+    dtype = np.dtype(entry["dtype"])
+    shape = tuple(entry["shape"])
+    if int(np.prod(shape)) == 0:
+        # np.memmap refuses empty files
+        array = np.empty(shape, dtype=dtype)
+    else:
+        array = np.memmap(os.path.join(path, entry["file"]), dtype=dtype,
+                          mode="r", shape=shape)
+    if "particle_range" in entry:
+        # split stored as a particle range of a shared file: zero-copy view
+        index = [slice(None)] * array.ndim
+        index[entry["particle_axis"]] = slice(*entry["particle_range"])
+        array = array[tuple(index)]
+    return array
+
+
+def _write_header(path, header):
+    """Replace the header atomically, so readers never see a partial one."""
+    filename = os.path.join(path, HEADER_FILE)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(header, f, indent=4)
+    os.replace(filename + ".tmp", filename)
+
+
+def save_columnar_data(path: str, data):
+    """Save trajectories as one raw array file per field plus a JSON header.
+
+    Args:
+        path (str): Output directory, created if missing.
+        data (list): List of tuples of the form
+          (positions, particle_type, universe_number, material_property (optional)).
+    """
+    os.makedirs(path, exist_ok=True)
+    trajectories = []
+    for i, trajectory in enumerate(data):
+        trajectories.append({
+            field: _write_array(path, f"{i}_{field}.bin", np.asarray(array))
+            for field, array in zip(FIELDS, trajectory)})
+
+    header = {"format": FORMAT_NAME,
+              "version": FORMAT_VERSION,
+              "trajectories": trajectories}
+    _write_header(path, header)
+
+
+def save_columnar_splits(path: str, data, ranges, shared_dir: str = "particles"):
+    """Save one trajectory once and describe each split as a particle range of it.
+
+    The arrays are written a single time to `path/shared_dir`; every split
+    directory `path/<split>` only holds a header pointing at those files, so the
+    splits are zero-copy views and the disk footprint is that of one copy.
+
+    Args:
+        path (str): Dataset directory (e.g. the prepared data path).
+        data (tuple): (positions, particle_type, universe_number, material_property (optional)),
+          with particles already ordered so that each split is contiguous.
+        ranges (dict): Split name to (start, stop) particle range.
+        shared_dir (str): Directory name, inside `path`, for the shared arrays.
+    """
+    shared_path = os.path.join(path, shared_dir)
+    os.makedirs(shared_path, exist_ok=True)
+    entries = {field: _write_array(shared_path, f"0_{field}.bin", np.asarray(array))
+               for field, array in zip(FIELDS, data)}
+
+    for split, (start, stop) in ranges.items():
+        split_path = os.path.join(path, split)
+        os.makedirs(split_path, exist_ok=True)
+        trajectory = {}
+        for field, entry in entries.items():
+            trajectory[field] = dict(entry,
+                                     file=os.path.join("..", shared_dir, entry["file"]),
+                                     particle_axis=1 if field == "positions" else 0,
+                                     particle_range=[int(start), int(stop)])
+        header = {"format": FORMAT_NAME,
+                  "version": FORMAT_VERSION,
+                  "trajectories": [trajectory]}
+        _write_header(split_path, header)
+
+
+def load_columnar_data(path: str):
+    """Open a columnar dataset with np.memmap.
+
+    Only the header is read here, so this is O(1) in the dataset size; the
+    pages of each array are loaded when they are touched.
+
+    Args:
+        path (str): Columnar dataset directory.
+
+    Returns:
+        data (list): List of tuples of the form
+          (positions, particle_type, universe_number, material_property (optional)).
+    """
+    with open(os.path.join(path, HEADER_FILE), "rt") as f:
+        header = json.load(f)
+    if header.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a {FORMAT_NAME} dataset")
+
+    return [tuple(_open_array(path, trajectory[field])
+                  for field in FIELDS if field in trajectory)
+            for trajectory in header["trajectories"]]
@@ -0,0 +1,222 @@
+"""Compiled inference step of a LearnedSimulator (TorchScript / torch.compile).
+
+`SimulatorStep` re-expresses one `LearnedSimulator.predict_positions` call
+(preprocessing, kNN graph, EncodeProcessDecode and Euler integration) with
+plain torch ops on the simulator's own modules, so that it can be scripted and
+saved as a standalone TorchScript file that loads without torch_geometric:
+
+    step = torch.jit.load("simulator_step.pt")
+    next_positions = step(position_sequence, nparticles_per_example,
+                          particle_types, universe_numbers, material_property)
+"""
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from gns import graph_builder
+from gns import learned_simulator
+
+MODES = ("none", "torchscript", "inductor")
+
+
+class _InteractionBlock(nn.Module):
+    """Scriptable interaction network block sharing the parameters of an
+    `InteractionNetwork` / `FusedInteractionNetwork`."""
+
+    def __init__(self, block: nn.Module):
+        super(_InteractionBlock, self).__init__()
+        self.node_fn = block.node_fn
+        self.edge_fn = block.edge_fn
+
+    def forward(self,
+                x: torch.Tensor,
+                senders: torch.Tensor,
+                receivers: torch.Tensor,
+                edge_features: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        messages = self.edge_fn(torch.cat([x[receivers], x[senders], edge_features], dim=-1))
+        x_updated = torch.zeros(
+            x.shape[0], messages.shape[-1], dtype=messages.dtype, device=messages.device)
+        x_updated.index_add_(0, receivers, messages)
+        x_updated = self.node_fn(torch.cat([x_updated, x], dim=-1))
+        # The messages only update the nodes (see `InteractionNetwork.update`)
+        return x_updated + x, edge_features + edge_features
+
+
+class SimulatorStep(nn.Module):
+    """One rollout step of a `LearnedSimulator`, TorchScript compatible.
+
+    The kNN graph is always built with the brute-force backend
+    (`graph_builder.knn_brute_force`), the one that needs no extension module.
+    """
+
+    def __init__(
+            self,
+            simulator: learned_simulator.LearnedSimulator,
+            chunk_size: int = 4096):
+        """Wrap the modules of a loaded simulator (parameters are shared).
+
+        Args:
+          simulator: Learned simulator, with its weights loaded.
+          chunk_size: Number of particles per distance block of the kNN search.
+        """
+        super(SimulatorStep, self).__init__()
+        self.particle_type_embedding = simulator._particle_type_embedding
+        self.universe_number_embedding = simulator._universe_number_embedding
+        self.nparticle_types = simulator._nparticle_types
+        self.nuniverse_types = simulator._nuniverse_types
+        self.knn_k = simulator._knn_k
+        self.dt: float = simulator._dt
+        self.knn_radius: Optional[float] = simulator._knn_radius
+        self.chunk_size = chunk_size
+
+        encode_process_decode = simulator._encode_process_decode
+        self.encoder_node_fn = encode_process_decode._encoder.node_fn
+        self.encoder_edge_fn = encode_process_decode._encoder.edge_fn
+        self.blocks = nn.ModuleList([
+            _InteractionBlock(block) for block in encode_process_decode._processor.gnn_stacks])
+        self.decoder_node_fn = encode_process_decode._decoder.node_fn
+
+        stats = simulator._normalization_stats
+        device = stats['velocity']['mean'].device
+        self.register_buffer('boundaries', torch.tensor(
+            simulator._boundaries).float().to(device))
+        self.register_buffer('velocity_mean', stats['velocity']['mean'].clone())
+        self.register_buffer('velocity_std', stats['velocity']['std'].clone())
+        self.register_buffer('acceleration_mean', stats['acceleration']['mean'].clone())
+        self.register_buffer('acceleration_std', stats['acceleration']['std'].clone())
+
+    def forward(self,
+                position_sequence: torch.Tensor,
+                nparticles_per_example: torch.Tensor,
+                particle_types: torch.Tensor,
+                universe_numbers: torch.Tensor,
+                material_property: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """Predict the next positions, see `LearnedSimulator.predict_positions`.
+
+        Args:
+          position_sequence: Positions with shape (nparticles, 2, dim).
+          nparticles_per_example: Number of particles per example, shape (nexamples, ).
+          particle_types: Particle types with shape (nparticles).
+          universe_numbers: Universe numbers with shape (nparticles).
+          material_property: Material properties with shape (nparticles, nprop), or None.
+
+        Returns:
+          torch.Tensor: Next positions with shape (nparticles, dim).
+        """
+        nparticles = position_sequence.shape[0]
+        most_recent_position = position_sequence[:, -1]
+        velocity_sequence = (position_sequence[:, 1:] - position_sequence[:, :-1]) / self.dt
+
+        # Graph connectivity, as in `LearnedSimulator._compute_graph_connectivity`
+        counts: List[int] = nparticles_per_example.reshape(-1).long().tolist()
+        segments: List[Tuple[int, int]] = []
+        start = 0
+        for count in counts:
+            segments.append((start, start + count))
+            start += count
+        edge_index = graph_builder.knn_brute_force(
+            most_recent_position.detach(), self.knn_k, segments, True,
+            self.knn_radius, self.chunk_size)
+        senders = edge_index[0]
+        receivers = edge_index[1]
+
+        # Node features
+        normalized_velocity_sequence = (
+            velocity_sequence - self.velocity_mean) / self.velocity_std
+        node_features = [
+            normalized_velocity_sequence.reshape(nparticles, -1),
+            most_recent_position - self.boundaries[:, 0][None],
+            self.boundaries[:, 1][None] - most_recent_position]
+        if self.nparticle_types > 1:
+            node_features.append(self.particle_type_embedding(particle_types))
+        if self.nuniverse_types > 1:
+            node_features.append(self.universe_number_embedding(universe_numbers))
+        if material_property is not None:
+            node_features.append(material_property)
+
+        # Edge features
+        relative_displacements = (
+            most_recent_position[senders] - most_recent_position[receivers])
+        relative_distances = torch.norm(relative_displacements, dim=-1, keepdim=True)
+
+        # EncodeProcessDecode
+        x = self.encoder_node_fn(torch.cat(node_features, dim=-1))
+        edge_features = self.encoder_edge_fn(
+            torch.cat([relative_displacements, relative_distances], dim=-1))
+        for block in self.blocks:
+            x, edge_features = block(x, senders, receivers, edge_features)
+        normalized_acceleration = self.decoder_node_fn(x)
+
+        # Euler integration
+        acceleration = (normalized_acceleration * self.acceleration_std
+                        ) + self.acceleration_mean
+        most_recent_velocity = (most_recent_position - position_sequence[:, -2]) / self.dt
+        return most_recent_position + (most_recent_velocity + acceleration * self.dt) * self.dt
+
+
+class CompiledSimulator:
+    """Drop-in for the parts of `LearnedSimulator` used by the rollout loops
+    (`predict_positions`, `rollout_context`, `reset_graph_cache`), running a
+    compiled `SimulatorStep`."""
+
+    def __init__(self, step):
+        self.step = step
+
+    def predict_positions(
+            self,
+            current_positions: torch.tensor,
+            nparticles_per_example,
+            particle_types: torch.tensor,
+            universe_numbers: torch.tensor,
+            material_property: torch.tensor = None,
+            context=None) -> torch.tensor:
+        if isinstance(nparticles_per_example, (list, tuple)):
+            nparticles_per_example = torch.cat(
+                [torch.as_tensor(n).reshape(-1) for n in nparticles_per_example])
+        return self.step(current_positions, nparticles_per_example,
+                         particle_types, universe_numbers, material_property)
+
+    def rollout_context(self, *args, **kwargs):
+        return None
+
+    def reset_graph_cache(self):
+        pass
+
+
+def script_step(
+        simulator: learned_simulator.LearnedSimulator,
+        chunk_size: int = 4096) -> torch.jit.ScriptModule:
+    """TorchScript-compiled `SimulatorStep` of an eval-mode simulator."""
+    return torch.jit.script(SimulatorStep(simulator, chunk_size).eval())
+
+
+def compile_simulator(
+        simulator: learned_simulator.LearnedSimulator,
+        mode: str = "torchscript") -> CompiledSimulator:
+    """Compile the rollout step of a loaded simulator.
+
+    Args:
+      simulator: Learned simulator, with its weights loaded.
+      mode: "torchscript" (torch.jit.script) or "inductor" (torch.compile).
+    """
+    if mode == "torchscript":
+        step = script_step(simulator)
+    elif mode == "inductor":
+        step = torch.compile(SimulatorStep(simulator).eval(), dynamic=True)
+    else:
+        raise ValueError(f"Unknown compile mode {mode}, expected one of {MODES[1:]}")
+    return CompiledSimulator(step)
+
+
+def export_torchscript(
+        simulator: learned_simulator.LearnedSimulator,
+        path: str):
+    """Save the scripted rollout step as a standalone TorchScript file, which
+    `torch.jit.load` can load without gns or torch_geometric installed.
+
+    Args:
+      simulator: Learned simulator, with its weights loaded.
+      path: Output file (e.g. simulator_step.pt).
+    """
+    script_step(simulator).save(path)
@@ -1,6 +1,14 @@
+import functools
+import os
+import queue
+import threading
+
 import torch
 import numpy as np
 
+from gns import columnar
+from gns import noise_utils
+
 
 def load_npz_data(path):
     """Load data stored in npz format.
@@ -22,6 +30,52 @@ def load_npz_data(path):
     return data
 
 
+def convert_npz_to_columnar(npz_path, path=None):
+    """Convert an object-dtype npz split (e.g. train.npz) to the columnar format.
+
+    Args:
+        npz_path (str): Path to the npz file.
+        path (str): Output directory. Defaults to the npz path without extension.
+
+    Returns:
+        str: Output directory.
+    """
+    if path is None:
+        path = os.path.splitext(npz_path)[0]
+    columnar.save_columnar_data(path, load_npz_data(npz_path))
+    return path
+
+
+def load_data(path):
+    """Load a dataset split stored either as npz or in the columnar format.
+
+    Args:
+        path (str): Path to an npz file or to a columnar dataset directory.
+
+    Returns:
+        data (list): List of tuples of the form (positions, particle_type, ...).
+    """
+    if columnar.is_columnar(path):
+        return columnar.load_columnar_data(path)
+    return load_npz_data(path)
+
+
+def get_split_path(data_path, split):
+    """Returns the path of a dataset split, preferring the columnar format.
+
+    Args:
+        data_path (str): The dataset directory.
+        split (str): Split name, e.g. "train", "test", "valid" or "predict".
+
+    Returns:
+        str: `data_path/split` if it is a columnar dataset, else `data_path/split.npz`.
+    """
+    path = os.path.join(data_path, split)
+    if columnar.is_columnar(path):
+        return path
+    return os.path.join(data_path, f"{split}.npz")
+
+
 class SamplesDataset(torch.utils.data.Dataset):
     """Dataset of samples of trajectories.
 
@@ -30,40 +84,46 @@ class SamplesDataset(torch.utils.data.Dataset):
     particle_type is an integer.
 
     Args:
-        path (str): Path to dataset.
+        path (str): Path to dataset (npz file or columnar directory).
         input_length_sequence (int): Length of input sequence.
+        temporal_stride (int): Number of dataset steps between the positions of
+          the input sequence and the label.
 
     Attributes:
         _data (list): List of tuples of the form (positions, particle_type).
         _dimension (int): Dimension of the data.
         _input_length_sequence (int): Length of input sequence.
+        _temporal_stride (int): Dataset steps between consecutive positions of a sample.
+        _window_span (int): Dataset steps from the first input position to the label.
         _data_lengths (list): List of lengths of trajectories in the dataset.
         _length (int): Total number of samples in the dataset.
         _precompute_cumlengths (np.array): Precomputed cumulative lengths of trajectories in the dataset.
     """
 
-    def __init__(self, path, input_length_sequence):
+    def __init__(self, path, input_length_sequence, temporal_stride=1):
         super().__init__()
-        # load dataset stored in npz format
+        # load dataset stored in npz format (or memory-map the columnar format)
         # data is loaded as dict of tuples
         # of the form (positions, particle_type)
         # convert to list of tuples
         # TODO: allow_pickle=True is potential security risk. See docs.
-        self._data = load_npz_data(path)
+        self._data = load_data(path)
 
         # length of each trajectory in the dataset
         # excluding the input_length_sequence
         # may (and likely is) variable between data
         self._dimension = self._data[0][0].shape[-1]
         self._input_length_sequence = input_length_sequence
+        self._temporal_stride = temporal_stride
+        self._window_span = input_length_sequence * temporal_stride
         self._material_property_as_feature = True if len(
             self._data[0]) >= 4 else False
         if self._material_property_as_feature:  # if raw data includes material_property
             self._data_lengths = [
-                x.shape[0] - self._input_length_sequence for x, _, _, _ in self._data]
+                x.shape[0] - self._window_span for x, _, _, _ in self._data]
         else:
             self._data_lengths = [
-                x.shape[0] - self._input_length_sequence for x, _, _ in self._data]
+                x.shape[0] - self._window_span for x, _, _ in self._data]
         self._length = sum(self._data_lengths)
 
         # pre-compute cumulative lengths
@@ -72,6 +132,14 @@ class SamplesDataset(torch.utils.data.Dataset):
             sum(self._data_lengths[:x]) for x in range(1, len(self._data_lengths) + 1)]
         self._precompute_cumlengths = np.array(
             self._precompute_cumlengths, dtype=int)
+        self._precompute_starts = np.concatenate(
+            [[0], self._precompute_cumlengths[:-1]]).astype(int)
+        self._nparticles = np.array([x[0].shape[1] for x in self._data], dtype=int)
+        self._static_features = {}
+        # batches built by `get_batch` go straight into page-locked memory
+        self.pin_memory = torch.cuda.is_available()
+        # if set, `get_batch` also samples the random-walk training noise
+        self.noise_std = None
 
     def __len__(self):
         """Return length of dataset.
@@ -90,6 +158,10 @@ class SamplesDataset(torch.utils.data.Dataset):
         Returns:
             tuple: Tuple of the form ((positions, particle_type, n_particles_per_example), label).
         """
+        if not np.isscalar(idx):
+            # a whole batch of indices from a BatchSampler
+            return self.get_batch(idx)
+
         # Select the trajectory immediately before
         # the one that exceeds the idx
         # (i.e., the one in which idx resides).
@@ -99,12 +171,12 @@ class SamplesDataset(torch.utils.data.Dataset):
         # Compute index of pick along time-dimension of trajectory.
         start_of_selected_trajectory = self._precompute_cumlengths[
             trajectory_idx - 1] if trajectory_idx != 0 else 0
-        time_idx = self._input_length_sequence + \
+        time_idx = self._window_span + \
             (idx - start_of_selected_trajectory)
 
         # Prepare training data.
         positions = self._data[trajectory_idx][0][time_idx -
-                                                  self._input_length_sequence:time_idx]
+                                                  self._window_span:time_idx:self._temporal_stride]
         # nparticles, input_sequence_length, dimension
         positions = np.transpose(positions, (1, 0, 2))
         particle_type = np.full(
@@ -124,15 +196,133 @@ class SamplesDataset(torch.utils.data.Dataset):
 
         return training_example
 
+    def _get_static_features(self, trajectory):
+        """Per-particle arrays of a trajectory that do not change over time, built once."""
+        if trajectory not in self._static_features:
+            data = self._data[trajectory]
+            n = self._nparticles[trajectory]
+            static_features = [
+                np.broadcast_to(np.asarray(data[1], dtype=np.int64), n),
+                np.broadcast_to(np.asarray(data[2], dtype=np.int64), n)]
+            if self._material_property_as_feature:
+                static_features.append(np.asarray(data[3], dtype=np.float32).reshape(n, -1))
+            self._static_features[trajectory] = static_features
+        return self._static_features[trajectory]
+
+    def get_batch(self, indices):
+        """Returns a collated batch of training examples.
+
+        Equivalent to `collate_fn([self[i] for i in indices])`, but all indices are
+        resolved with one vectorized searchsorted and the position windows and labels
+        are gathered straight into preallocated (pinned, when CUDA is available) tensors.
+
+        Args:
+            indices (list): Indices of training examples.
+
+        Returns:
+            tuple: Tuple of the form ((positions, particle_type, n_particles_per_example), label),
+              followed by the sampled noise when `noise_std` is set.
+        """
+        indices = np.asarray(indices, dtype=int)
+        trajectory_idx = np.searchsorted(
+            self._precompute_cumlengths - 1, indices, side="left")
+        time_idx = self._window_span + \
+            (indices - self._precompute_starts[trajectory_idx])
+
+        # Rows of each example in the batch (examples are stacked along particles)
+        nparticles = self._nparticles[trajectory_idx]
+        offsets = np.concatenate([[0], np.cumsum(nparticles)])
+        total = int(offsets[-1])
+
+        positions = torch.empty(
+            (total, self._input_length_sequence, self._dimension),
+            dtype=torch.float32, pin_memory=self.pin_memory)
+        labels = torch.empty((total, self._dimension), dtype=torch.float32,
+                             pin_memory=self.pin_memory)
+        particle_type = torch.empty(total, dtype=torch.int64, pin_memory=self.pin_memory)
+        universe_number = torch.empty(total, dtype=torch.int64, pin_memory=self.pin_memory)
+        if self._material_property_as_feature:
+            nprop = self._data[0][3].shape[-1] if self._data[0][3].ndim > 1 else 1
+            material_property = torch.empty((total, nprop), dtype=torch.float32,
+                                            pin_memory=self.pin_memory)
+
+        # Input window and label of every example in one gather per trajectory,
+        # copied (with the float32 cast and transpose) into the batch tensors
+        batch = [positions.numpy(), labels.numpy(), particle_type.numpy(), universe_number.numpy()]
+        if self._material_property_as_feature:
+            batch.append(material_property.numpy())
+        window = np.arange(-self._input_length_sequence, 1) * self._temporal_stride
+        for trajectory in np.unique(trajectory_idx):
+            examples = np.nonzero(trajectory_idx == trajectory)[0]
+            n = self._nparticles[trajectory]
+            # (examples, input_length_sequence + 1, nparticles, dimension)
+            frames = self._data[trajectory][0][time_idx[examples][:, None] + window]
+            static_features = self._get_static_features(trajectory)
+
+            # examples next to each other in the batch occupy one block of rows
+            first = 0
+            for run in np.split(examples, np.nonzero(np.diff(examples) != 1)[0] + 1):
+                rows = slice(offsets[run[0]], offsets[run[-1] + 1])
+                run_frames = frames[first:first + len(run)]
+                first += len(run)
+                np.copyto(batch[0][rows].reshape(len(run), n, self._input_length_sequence, self._dimension),
+                          run_frames[:, :-1].transpose(0, 2, 1, 3), casting="same_kind")
+                np.copyto(batch[1][rows].reshape(len(run), n, self._dimension),
+                          run_frames[:, -1], casting="same_kind")
+                for out, feature in zip(batch[2:], static_features):
+                    np.copyto(out[rows].reshape((len(run),) + feature.shape), feature)
+
+        n_particles_per_example = torch.from_numpy(nparticles.astype(np.int64))
+        if self._material_property_as_feature:
+            batch = ((positions, particle_type, universe_number, material_property,
+                      n_particles_per_example), labels)
+        else:
+            batch = ((positions, particle_type, universe_number, n_particles_per_example), labels)
+        return add_noise(batch, self.noise_std)
+
+
+def add_noise(batch, noise_std):
+    """Append the random-walk noise of `noise_utils` for the batch positions.
+
+    Sampling the noise where the batch is built (e.g. in DataLoader workers)
+    takes it off the training loop.
+
+    Args:
+        batch (tuple): Collated batch ((positions, ...), label).
+        noise_std (float): Standard deviation of the noise in the last step, or None.
+
+    Returns:
+        tuple: `batch` if `noise_std` is None, else (*batch, position_sequence_noise).
+    """
+    if noise_std is None:
+        return batch
+    return (*batch, noise_utils.get_random_walk_noise_for_position_sequence(
+        batch[0][0], noise_std_last_step=noise_std))
+
+
+def batch_collate_fn(data):
+    """Collate function for batches already collated by `SamplesDataset.get_batch`.
+
+    Args:
+        data (tuple): Output of `SamplesDataset.get_batch`.
+
+    Returns:
+        tuple: `data` unchanged.
+    """
+    return data
+
 
-def collate_fn(data):
+def collate_fn(data, noise_std=None):
     """Collate function for SamplesDataset.
 
     Args:
         data (list): List of tuples of the form ((positions, particle_type, n_particles_per_example), label).
+        noise_std (float): If given, also sample the random-walk training noise
+          for the collated positions (see `add_noise`).
 
     Returns:
-        tuple: Tuple of the form ((positions, particle_type, n_particles_per_example), label).    
+        tuple: Tuple of the form ((positions, particle_type, n_particles_per_example), label),
+          followed by the sampled noise when `noise_std` is given.
     """
     material_property_as_feature = True if len(data[0][0]) >= 5 else False
     position_list = []
@@ -184,7 +374,7 @@ def collate_fn(data):
             torch.tensor(np.vstack(label_list)).to(torch.float32).contiguous()
         )
 
-    return collated_data
+    return add_noise(collated_data, noise_std)
 
 
 class TrajectoriesDataset(torch.utils.data.Dataset):
@@ -196,12 +386,12 @@ class TrajectoriesDataset(torch.utils.data.Dataset):
 
     def __init__(self, path):
         super().__init__()
-        # load dataset stored in npz format
+        # load dataset stored in npz format (or memory-map the columnar format)
         # data is loaded as dict of tuples
         # of the form (positions, particle_type)
         # convert to list of tuples
         # TODO (jpv): allow_pickle=True is potential security risk. See docs.
-        self._data = load_npz_data(path)
+        self._data = load_data(path)
         self._dimension = self._data[0][0].shape[-1]
         self._length = len(self._data)
         self._material_property_as_feature = True if len(
@@ -261,7 +451,41 @@ class TrajectoriesDataset(torch.utils.data.Dataset):
         return trajectory
 
 
-def get_data_loader_by_samples(path, input_length_sequence, batch_size, shuffle=True):
+def make_samples_data_loader(dataset, sampler, batch_size, vectorized=True, num_workers=0, noise_std=None):
+    """Returns a data loader over `dataset` drawing example indices from `sampler`.
+
+    Args:
+        dataset (SamplesDataset): Dataset of samples.
+        sampler (torch.utils.data.Sampler): Sampler of example indices.
+        batch_size (int): Batch size.
+        vectorized (bool): Gather whole batches with `SamplesDataset.get_batch`
+          through a BatchSampler instead of per-sample `__getitem__` + `collate_fn`.
+        num_workers (int): Number of (persistent) loading worker processes.
+          Batches come back from the workers through shared memory.
+        noise_std (float): If given, the random-walk training noise is sampled
+          while building each batch (i.e. on the workers) and appended to it.
+
+    Returns:
+        torch.utils.data.DataLoader: Data loader for the dataset.
+    """
+    pin_memory = torch.cuda.is_available()
+    worker_kwargs = dict(num_workers=num_workers, persistent_workers=num_workers > 0)
+    if vectorized:
+        dataset.noise_std = noise_std
+        # pinning inside the workers would be lost when the batch crosses processes,
+        # so with workers the DataLoader pins the received batches instead
+        dataset.pin_memory = pin_memory and num_workers == 0
+        return torch.utils.data.DataLoader(
+            dataset, sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False),
+            batch_size=None, collate_fn=batch_collate_fn,
+            pin_memory=pin_memory and num_workers > 0, **worker_kwargs)
+    return torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=batch_size,
+                                       pin_memory=True, collate_fn=functools.partial(collate_fn, noise_std=noise_std),
+                                       **worker_kwargs)
+
+
+def get_data_loader_by_samples(path, input_length_sequence, batch_size, shuffle=True, vectorized=True,
+                               num_workers=0, noise_std=None, temporal_stride=1):
     """Returns a data loader for the dataset.
 
     Args:
@@ -269,13 +493,189 @@ def get_data_loader_by_samples(path, input_length_sequence, batch_size, shuffle=
         input_length_sequence (int): Length of input sequence.
         batch_size (int): Batch size.
         shuffle (bool, optional): Whether to shuffle the dataset. Defaults to True.
+        vectorized (bool, optional): Gather whole batches with `SamplesDataset.get_batch`
+          through a BatchSampler instead of per-sample `__getitem__` + `collate_fn`.
+          Defaults to True.
+        num_workers (int, optional): Number of loading worker processes. Defaults to 0.
+        noise_std (float, optional): Sample the training noise with each batch. Defaults to None.
+        temporal_stride (int, optional): Dataset steps between the positions of a sample. Defaults to 1.
 
     Returns:
         torch.utils.data.DataLoader: Data loader for the dataset.
     """
-    dataset = SamplesDataset(path, input_length_sequence)
-    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                                       pin_memory=True, collate_fn=collate_fn)
+    dataset = SamplesDataset(path, input_length_sequence, temporal_stride)
+    sampler = torch.utils.data.RandomSampler(dataset) if shuffle else \
+        torch.utils.data.SequentialSampler(dataset)
+    return make_samples_data_loader(dataset, sampler, batch_size, vectorized=vectorized,
+                                    num_workers=num_workers, noise_std=noise_std)
+
+
+class PrefetchLoader:
+    """Iterates over `loader` in a background thread, keeping a bounded queue
+    of batches that are already on `device`.
+
+    Loading (and the noise sampling carried by the batches) then overlaps with
+    the forward/backward pass of the training loop.
+
+    Args:
+        loader (iterable): Loader of batches (nested tuples of tensors).
+        device (torch.device): Device to move the batches to.
+        depth (int): Maximum number of batches waiting in the queue.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self._device = device
+        self._depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, torch.Tensor):
+            return batch.to(self._device, non_blocking=True)
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(self._to_device(item) for item in batch)
+        return batch
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.loader:
+                item = self._to_device(batch)
+                while not stop.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            batches.put(StopIteration)
+        except Exception as error:
+            batches.put(error)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self._depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is StopIteration:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # also reached when the consumer stops early (e.g. the last training step)
+            stop.set()
+
+
+class DeviceSamplesLoader:
+    """Batches of a SamplesDataset drawn from tensors resident on the training device.
+
+    The whole dataset is copied once into contiguous torch tensors on `device`;
+    each batch is then built by tensor indexing, without a DataLoader, a
+    collate_fn or host-to-device copies of the data. Batches have the same
+    layout as `collate_fn`.
+
+    Args:
+        dataset (SamplesDataset): Dataset to hold on the device.
+        batch_size (int): Batch size.
+        device (torch.device): Training device.
+        shuffle (bool): Whether to shuffle the dataset every epoch.
+        sampler (torch.utils.data.Sampler): Optional sampler of example indices
+          (e.g. a DistributedSampler); overrides `shuffle`.
+    """
+
+    def __init__(self, dataset, batch_size, device, shuffle=True, sampler=None):
+        self.dataset = dataset
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self.sampler = sampler
+        self._positions = [torch.tensor(np.asarray(data[0]), dtype=torch.float32, device=device)
+                           for data in dataset._data]
+        self._static_features = [[torch.tensor(feature, device=device)
+                                  for feature in dataset._get_static_features(trajectory)]
+                                 for trajectory in range(len(dataset._data))]
+        self._window = torch.arange(
+            -dataset._input_length_sequence, 1, device=device) * dataset._temporal_stride
+
+    def __len__(self):
+        nexamples = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        return (nexamples + self._batch_size - 1) // self._batch_size
+
+    def __iter__(self):
+        if self.sampler is not None:
+            order = np.fromiter(iter(self.sampler), dtype=int)
+        elif self._shuffle:
+            order = torch.randperm(len(self.dataset)).numpy()
+        else:
+            order = np.arange(len(self.dataset))
+        for start in range(0, len(order), self._batch_size):
+            yield self.get_batch(order[start:start + self._batch_size])
+
+    def get_batch(self, indices):
+        """Returns a batch of training examples, as tensors on the device.
+
+        Args:
+            indices (list): Indices of training examples.
+
+        Returns:
+            tuple: Tuple of the form ((positions, particle_type, n_particles_per_example), label).
+        """
+        dataset = self.dataset
+        indices = np.asarray(indices, dtype=int)
+        trajectory_idx = np.searchsorted(
+            dataset._precompute_cumlengths - 1, indices, side="left")
+        time_idx = dataset._window_span + \
+            (indices - dataset._precompute_starts[trajectory_idx])
+
+        # one gather for every run of examples from the same trajectory
+        runs = np.split(np.arange(len(indices)),
+                        np.nonzero(np.diff(trajectory_idx) != 0)[0] + 1)
+        frames, static_features = [], []
+        for run in runs:
+            trajectory = trajectory_idx[run[0]]
+            times = torch.as_tensor(time_idx[run], device=self._window.device)
+            # (examples, nparticles, input_length_sequence + 1, dimension)
+            frames.append(self._positions[trajectory][times[:, None] + self._window].permute(0, 2, 1, 3)
+                          .reshape(-1, dataset._input_length_sequence + 1, dataset._dimension))
+            static_features.append([feature.repeat((len(run),) + (1,) * (feature.dim() - 1))
+                                    for feature in self._static_features[trajectory]])
+        frames = torch.cat(frames)
+        static_features = [torch.cat(feature) for feature in zip(*static_features)]
+
+        positions = frames[:, :-1]
+        labels = frames[:, -1]
+        n_particles_per_example = torch.as_tensor(
+            dataset._nparticles[trajectory_idx], device=self._window.device)
+        return ((positions, *static_features, n_particles_per_example), labels)
+
+
+def get_device_data_loader_by_samples(path, input_length_sequence, batch_size, device,
+                                      shuffle=True, distributed=False, temporal_stride=1):
+    """Returns a loader whose dataset is resident on the training device.
+
+    Args:
+        path (str): Path to dataset.
+        input_length_sequence (int): Length of input sequence.
+        batch_size (int): Batch size.
+        device (torch.device): Training device.
+        shuffle (bool, optional): Whether to shuffle the dataset. Defaults to True.
+        distributed (bool, optional): Draw this rank's share of the examples
+          with a DistributedSampler. Defaults to False.
+        temporal_stride (int, optional): Dataset steps between the positions of a sample. Defaults to 1.
+
+    Returns:
+        DeviceSamplesLoader: Loader over device-resident tensors.
+    """
+    dataset = SamplesDataset(path, input_length_sequence, temporal_stride)
+    sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle) \
+        if distributed else None
+    return DeviceSamplesLoader(dataset, batch_size, device, shuffle=shuffle, sampler=sampler)
 
 
 def get_data_loader_by_trajectories(path):
@@ -1,21 +1,105 @@
+import os
+
 import torch
 from torch.utils.data.distributed import DistributedSampler
 
 from gns import data_loader
 
+DEFAULT_MASTER_ADDR = "localhost"
+DEFAULT_MASTER_PORT = "29500"
+
+
+def backend(device):
+    """The process group backend of a device type: nccl on GPUs, gloo on CPUs."""
+    return "nccl" if torch.device(device).type == "cuda" else "gloo"
+
+
+def launched_ranks():
+    """Ranks given by a launcher such as torchrun through the environment.
+
+    Returns:
+        tuple: (global rank, local rank, world size, local world size), or None
+          if the process was not started by a launcher.
+    """
+    if "RANK" not in os.environ or "WORLD_SIZE" not in os.environ:
+        return None
+    world_size = int(os.environ["WORLD_SIZE"])
+    return (int(os.environ["RANK"]), int(os.environ.get("LOCAL_RANK", 0)), world_size,
+            int(os.environ.get("LOCAL_WORLD_SIZE", world_size)))
+
+
+def set_rendezvous_defaults():
+    """Rendezvous on this host unless MASTER_ADDR/MASTER_PORT are already set."""
+    os.environ.setdefault("MASTER_ADDR", DEFAULT_MASTER_ADDR)
+    os.environ.setdefault("MASTER_PORT", DEFAULT_MASTER_PORT)
+
 
 def setup(rank, world_size, device):
     """Initializes distributed training.
 
+    The rendezvous goes through the MASTER_ADDR/MASTER_PORT environment
+    variables (env://), as set by torchrun or `set_rendezvous_defaults`.
+
     Args:
-        rank (int): Rank of current process.
+        rank (int): Rank of current process on this host.
         world_size (int): Number of processes.
+        device (torch.device): torch device type, which selects the backend.
+
+    Returns:
+        int: Global rank of the process (RANK if set by a launcher, else `rank`).
     """
+    rank = int(os.environ.get("RANK", rank))
     # Initialize group, blocks until all processes join.
-    torch.distributed.init_process_group(backend="nccl",
+    torch.distributed.init_process_group(backend=backend(device),
+                                         init_method="env://",
                                          rank=rank,
                                          world_size=world_size,
                                          )
+    return rank
+
+
+def pin_threads(local_rank, local_world_size):
+    """Pins a CPU rank to its own group of cores and sizes its thread pools to it.
+
+    The cores available to the process are split into `local_world_size`
+    contiguous groups, which follow the sockets / core complexes on the usual
+    core numbering, so the ranks of a host do not compete for cores.
+
+    Args:
+        local_rank (int): Rank of current process on this host.
+        local_world_size (int): Number of processes on this host.
+
+    Returns:
+        list: The cores of the rank, or None where the platform cannot pin
+        threads (no `os.sched_setaffinity`, e.g. macOS and Windows); the
+        thread pools are then only sized to the rank's share of the cores.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    group_size = max(len(cores) // local_world_size, 1)
+    start = (local_rank * group_size) % len(cores)
+    group = cores[start:start + group_size]
+    os.sched_setaffinity(0, group)
+    torch.set_num_threads(len(group))
+    return group
+
+
+def set_epoch(loader, epoch):
+    """Starts pass `epoch` over the data, reshuffling the ranks' shares of a
+    distributed loader; other loaders are left as they are.
+
+    Args:
+        loader: Data loader, possibly wrapped in a `data_loader.PrefetchLoader`.
+        epoch (int): Number of the pass.
+    """
+    loader = getattr(loader, "loader", loader)
+    sampler = getattr(loader, "sampler", None)
+    if isinstance(sampler, torch.utils.data.BatchSampler):
+        sampler = sampler.sampler
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
 
 
 def cleanup():
@@ -41,7 +125,9 @@ def spawn_train(train_fxn, flags, world_size, device):
                                 )
 
 
-def get_data_distributed_dataloader_by_samples(path, input_length_sequence, batch_size, shuffle=True):
+def get_data_distributed_dataloader_by_samples(path, input_length_sequence, batch_size, shuffle=True,
+                                               vectorized=True, num_workers=0, noise_std=None,
+                                               temporal_stride=1):
     """Returns a distributed dataloader.
 
     Args:
@@ -49,8 +135,12 @@ def get_data_distributed_dataloader_by_samples(path, input_length_sequence, batc
         input_length_sequence (int): Length of input sequence.
         batch_size (int): Batch size.
         shuffle (bool): Whether to shuffle dataset.
+        vectorized (bool): Gather whole batches with `SamplesDataset.get_batch`.
+        num_workers (int): Number of loading worker processes.
+        noise_std (float): Sample the training noise with each batch.
+        temporal_stride (int): Dataset steps between the positions of a sample.
     """
-    dataset = data_loader.SamplesDataset(path, input_length_sequence)
+    dataset = data_loader.SamplesDataset(path, input_length_sequence, temporal_stride)
     sampler = DistributedSampler(dataset, shuffle=shuffle)
-    return torch.utils.data.DataLoader(dataset=dataset, sampler=sampler, batch_size=batch_size,
-                                       pin_memory=True, collate_fn=data_loader.collate_fn)
+    return data_loader.make_samples_data_loader(dataset, sampler, batch_size, vectorized=vectorized,
+                                                num_workers=num_workers, noise_std=noise_std)
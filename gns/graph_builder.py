@@ -0,0 +1,168 @@
+"""k-nearest-neighbour graph construction with interchangeable backends.
+
+All backends return the same edge convention as `torch_geometric.nn.knn_graph`
+with flow "source_to_target": `edge_index[0]` holds the neighbours (sources)
+and `edge_index[1]` the particles they are neighbours of (targets).
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+try:
+    import torch_cluster
+except ImportError:
+    torch_cluster = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+BACKENDS = ("auto", "torch_cluster", "kdtree", "brute_force")
+
+
+def available_backends():
+    """Backends that can run in the current environment (without "auto")."""
+    backends = []
+    if torch_cluster is not None:
+        backends.append("torch_cluster")
+    if cKDTree is not None:
+        backends.append("kdtree")
+    backends.append("brute_force")
+    return backends
+
+
+def resolve_backend(backend: str, device) -> str:
+    """Pick the backend to use for `backend="auto"` and check availability.
+
+    "auto" prefers torch-cluster, then the SciPy KD-tree for CPU tensors and
+    the brute-force search otherwise.
+
+    Args:
+      backend: One of `BACKENDS`.
+      device: Device of the positions.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown kNN backend {backend}, expected one of {BACKENDS}")
+    if backend == "auto":
+        if torch_cluster is not None:
+            return "torch_cluster"
+        if cKDTree is not None and torch.device(device).type == "cpu":
+            return "kdtree"
+        return "brute_force"
+    if backend not in available_backends():
+        raise ImportError(f"kNN backend {backend} is not installed")
+    return backend
+
+
+def _segments(batch: torch.tensor, nnodes: int):
+    """(start, stop) node ranges of the examples of a sorted batch vector."""
+    if batch is None:
+        return [(0, nnodes)]
+    counts = torch.bincount(batch).tolist()
+    stops = np.cumsum(counts)
+    return [(int(stop - count), int(stop)) for count, stop in zip(counts, stops) if count > 0]
+
+
+def _knn_torch_cluster(x, k, batch, loop):
+    return torch_cluster.knn_graph(x, k, batch, loop, flow="source_to_target")
+
+
+def _knn_kdtree(x, k, batch, loop, radius):
+    points = x.detach().cpu().numpy()
+    upper_bound = np.inf if radius is None else radius
+    sources, targets = [], []
+    for start, stop in _segments(batch, len(points)):
+        segment = points[start:stop]
+        n = len(segment)
+        # Query one more neighbour to be able to drop the particle itself
+        nquery = min(k if loop else k + 1, n)
+        _, idx = cKDTree(segment).query(
+            segment, k=list(range(1, nquery + 1)), distance_upper_bound=upper_bound)
+        valid = idx < n
+        if not loop:
+            valid &= idx != np.arange(n)[:, None]
+        # Keep the k nearest valid neighbours of every particle
+        valid &= np.cumsum(valid, axis=1) <= k
+        rows, cols = np.nonzero(valid)
+        sources.append(idx[rows, cols] + start)
+        targets.append(rows + start)
+    edge_index = np.stack([np.concatenate(sources), np.concatenate(targets)])
+    return torch.from_numpy(edge_index).to(device=x.device, dtype=torch.long)
+
+
+def knn_brute_force(
+        x: torch.Tensor,
+        k: int,
+        segments: List[Tuple[int, int]],
+        loop: bool,
+        radius: Optional[float],
+        chunk_size: int) -> torch.Tensor:
+    """Chunked `torch.cdist` top-k search, kept TorchScript compatible so that
+    `gns.compiled` can script it.
+
+    Args:
+      x: Positions with shape (nnodes, dim).
+      k: Number of neighbours per particle.
+      segments: (start, stop) node range of every example.
+      loop: Whether a particle is its own neighbour.
+      radius: Optional cutoff distance.
+      chunk_size: Number of particles per distance block.
+    """
+    sources: List[torch.Tensor] = []
+    targets: List[torch.Tensor] = []
+    for start, stop in segments:
+        segment = x[start:stop]
+        n = stop - start
+        kk = min(k, n)
+        for chunk_start in range(0, n, chunk_size):
+            chunk = segment[chunk_start:chunk_start + chunk_size]
+            distance = torch.cdist(chunk, segment)
+            if not loop:
+                # chunk row i is particle chunk_start + i
+                distance.diagonal(offset=chunk_start).fill_(float("inf"))
+            if radius is not None:
+                distance.masked_fill_(distance > radius, float("inf"))
+            values, idx = distance.topk(kk, dim=1, largest=False)
+            found = torch.nonzero(torch.isfinite(values))
+            rows, cols = found[:, 0], found[:, 1]
+            sources.append(idx[rows, cols] + start)
+            targets.append(rows + chunk_start + start)
+    return torch.stack([torch.cat(sources), torch.cat(targets)])
+
+
+def knn_graph(
+        x: torch.tensor,
+        k: int,
+        batch: torch.tensor = None,
+        loop: bool = False,
+        radius: float = None,
+        backend: str = "auto",
+        chunk_size: int = 4096) -> torch.tensor:
+    """Connect every particle to its k nearest neighbours within its example.
+
+    Args:
+      x: Positions with shape (nnodes, dim).
+      k: Number of neighbours per particle (the particle itself included if `loop`).
+      batch: Sorted example id of every particle with shape (nnodes, ). None for
+        a single example.
+      loop: Whether a particle is its own neighbour.
+      radius: Optional cutoff; neighbours further away than `radius` are dropped.
+      backend: One of `BACKENDS`.
+      chunk_size: Number of particles per distance block of the brute-force backend.
+
+    Returns:
+      torch.tensor: Edge index with shape (2, nedges).
+    """
+    backend = resolve_backend(backend, x.device)
+    with torch.no_grad():
+        if backend == "torch_cluster":
+            edge_index = _knn_torch_cluster(x, k, batch, loop)
+            if radius is not None:
+                distance = torch.linalg.vector_norm(x[edge_index[0]] - x[edge_index[1]], dim=-1)
+                edge_index = edge_index[:, distance <= radius]
+            return edge_index
+        if backend == "kdtree":
+            return _knn_kdtree(x, k, batch, loop, radius)
+        return knn_brute_force(x, k, _segments(batch, len(x)), loop, radius, chunk_size)
@@ -1,6 +1,7 @@
 from typing import List
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch_geometric.nn import MessagePassing
 
 
@@ -130,10 +131,32 @@ class Encoder(nn.Module):
                                                  nedge_out_features),
                                        nn.LayerNorm(nedge_out_features)])
 
+    def node_static_term(
+            self,
+            static_features: torch.tensor):
+        """Part of the first node layer acting on the trailing, time-invariant
+        node features, i.e. `static_features @ W_static^T + b`.
+
+        Args:
+          static_features: Time-invariant node features with shape
+            (nparticles, nstatic_features), the last columns of the node input.
+
+        Returns:
+          torch.tensor: Static term with shape (nparticles, mlp_hidden_dim), or
+            None if the first node layer is not a linear layer.
+        """
+        first_layer = self.node_fn[0][0]
+        if not isinstance(first_layer, nn.Linear):
+            return None
+        nstatic = static_features.shape[-1]
+        weight = first_layer.weight[:, first_layer.in_features - nstatic:]
+        return nn.functional.linear(static_features, weight, first_layer.bias)
+
     def forward(
             self,
             x: torch.tensor,
-            edge_features: torch.tensor):
+            edge_features: torch.tensor,
+            node_static_term: torch.tensor = None):
         """The forward hook runs when the Encoder class is instantiated
 
         Args:
@@ -141,9 +164,20 @@ class Encoder(nn.Module):
             (nparticles, nnode_input_features)
           edge_features: Edge features as a torch tensor with shape
             (nparticles, nedge_input_features)
+          node_static_term: Optional output of `node_static_term`. If given, `x`
+            only holds the leading, time-dependent node features.
 
         """
-        return self.node_fn(x), self.edge_fn(edge_features)
+        if node_static_term is None:
+            return self.node_fn(x), self.edge_fn(edge_features)
+
+        node_mlp, layer_norm = self.node_fn
+        first_layer = node_mlp[0]
+        x = nn.functional.linear(
+            x, first_layer.weight[:, :x.shape[-1]]) + node_static_term
+        for layer in list(node_mlp)[1:]:
+            x = layer(x)
+        return layer_norm(x), self.edge_fn(edge_features)
 
 
 class InteractionNetwork(MessagePassing):
@@ -257,6 +291,106 @@ class InteractionNetwork(MessagePassing):
         return x_updated, edge_features
 
 
+class FusedInteractionNetwork(nn.Module):
+    def __init__(
+        self,
+        nnode_in: int,
+        nnode_out: int,
+        nedge_in: int,
+        nedge_out: int,
+        nmlp_layers: int,
+        mlp_hidden_dim: int,
+    ):
+        """InteractionNetwork with a decomposed first edge layer and a fused
+        scatter-add (index_add_) aggregation, computing the same function as `InteractionNetwork` with the
+        same parameters (so checkpoints load into either).
+
+        The first edge layer acts on `[x_i, x_j, e_ij]`, so it is split into
+        `W_i x_i + W_j x_j + W_e e_ij + b`: the node terms are computed once per
+        node and gathered per edge, instead of concatenating 3 latents per edge.
+
+        Args:
+          nnode_in: Number of node inputs (latent dimension of size 128).
+          nnode_out: Number of node outputs (latent dimension of size 128).
+          nedge_in: Number of edge inputs (latent dimension of size 128).
+          nedge_out: Number of edge output features (latent dimension of size 128).
+          nmlp_layer: Number of hidden layers in the MLP (typically of size 2).
+          mlp_hidden_dim: Size of the hidden layer (latent dimension of size 256).
+
+        """
+        super(FusedInteractionNetwork, self).__init__()
+        # Node MLP
+        self.node_fn = nn.Sequential(*[build_mlp(nnode_in + nedge_out,
+                                                 [mlp_hidden_dim
+                                                  for _ in range(nmlp_layers)],
+                                                 nnode_out),
+                                       nn.LayerNorm(nnode_out)])
+        # Edge MLP
+        self.edge_fn = nn.Sequential(*[build_mlp(nnode_in + nnode_in + nedge_in,
+                                                 [mlp_hidden_dim
+                                                  for _ in range(nmlp_layers)],
+                                                 nedge_out),
+                                      nn.LayerNorm(nedge_out)])
+
+    def forward(self,
+                x: torch.tensor,
+                edge_index: torch.tensor,
+                edge_features: torch.tensor):
+        """The forward hook runs when the FusedInteractionNetwork class is instantiated
+
+        Args:
+          x: Particle state representation as a torch tensor with shape
+            (nparticles, nnode_input_features)
+          edge_index: A torch tensor list of source (j) and target (i) nodes with
+            shape (2, nedges)
+          edge_features: Edge features as a torch tensor with shape
+            (nedges, nedge_in=latent_dim of 128)
+
+        Returns:
+          tuple: Updated node and edge features
+        """
+        senders, receivers = edge_index[0], edge_index[1]
+        edge_mlp, edge_layer_norm = self.edge_fn
+        first_layer = edge_mlp[0]
+        nnode_in = x.shape[-1]
+
+        if isinstance(first_layer, nn.Linear):
+            # First edge layer on [x_i, x_j, edge_features]: the node terms are
+            # computed once per node, then gathered and summed per edge in a single
+            # embedding_bag over the stacked (x_i term, x_j term) table.
+            weight = first_layer.weight
+            node_terms = torch.cat([x @ weight[:, :nnode_in].t(),
+                                    x @ weight[:, nnode_in:2 * nnode_in].t()])
+            node_term_index = torch.stack([receivers, senders + x.shape[0]], dim=1)
+            messages = torch.addmm(
+                first_layer.bias, edge_features, weight[:, 2 * nnode_in:].t())
+            messages = messages + nn.functional.embedding_bag(
+                node_term_index, node_terms, mode='sum')
+            for layer in list(edge_mlp)[1:]:
+                messages = layer(messages)
+            messages = edge_layer_norm(messages)
+        else:
+            # e.g. quantized layers, whose weight cannot be split
+            messages = self.edge_fn(
+                torch.cat([x[receivers], x[senders], edge_features], dim=-1))
+
+        # Sum the messages at their target node
+        x_updated = torch.zeros(
+            x.shape[0], messages.shape[-1], dtype=messages.dtype, device=messages.device)
+        x_updated.index_add_(0, receivers, messages)
+        x_updated = self.node_fn(torch.cat([x_updated, x], dim=-1))
+
+        # Like `InteractionNetwork`, whose `update` passes the input edge
+        # features through, the messages only update the nodes.
+        return x_updated + x, edge_features + edge_features
+
+
+INTERACTION_NETWORKS = {
+    "message_passing": InteractionNetwork,
+    "fused": FusedInteractionNetwork,
+}
+
+
 class Processor(MessagePassing):
     """The Processor: :math: `\mathcal{G} \rightarrow \mathcal{G}` computes 
     interactions among nodes via :math: `M` steps of learned message-passing, to 
@@ -277,6 +411,8 @@ class Processor(MessagePassing):
         nmessage_passing_steps: int,
         nmlp_layers: int,
         mlp_hidden_dim: int,
+        interaction_network: str = "message_passing",
+        gradient_checkpointing: bool = False,
     ):
         """Processor derived from torch_geometric MessagePassing class. The 
         processor uses a stack of :math: `M GNs` (where :math: `M` is a 
@@ -294,12 +430,17 @@ class Processor(MessagePassing):
           nmessage_passing_steps: Number of message passing steps.
           nmlp_layer: Number of hidden layers in the MLP (typically of size 2).
           mlp_hidden_dim: Size of the hidden layer (latent dimension of size 256).
+          interaction_network: Implementation of the GN blocks, a key of
+            `INTERACTION_NETWORKS` ("message_passing" or "fused").
+          gradient_checkpointing: Recompute the activations of each GN block
+            in the backward pass instead of storing them (training only).
 
         """
         super(Processor, self).__init__(aggr='max')
+        self._gradient_checkpointing = gradient_checkpointing
         # Create a stack of M Graph Networks GNs.
         self.gnn_stacks = nn.ModuleList([
-            InteractionNetwork(
+            INTERACTION_NETWORKS[interaction_network](
                 nnode_in=nnode_in,
                 nnode_out=nnode_out,
                 nedge_in=nedge_in,
@@ -323,8 +464,15 @@ class Processor(MessagePassing):
             (nparticles, latent_dim)
 
         """
+        checkpointing = (self._gradient_checkpointing and self.training
+                         and torch.is_grad_enabled())
         for gnn in self.gnn_stacks:
-            x, edge_features = gnn(x, edge_index, edge_features)
+            if checkpointing:
+                # Only the block inputs are kept for backward
+                x, edge_features = torch.utils.checkpoint.checkpoint(
+                    gnn, x, edge_index, edge_features, use_reentrant=False)
+            else:
+                x, edge_features = gnn(x, edge_index, edge_features)
         return x, edge_features
 
 
@@ -378,6 +526,8 @@ class EncodeProcessDecode(nn.Module):
         nmessage_passing_steps: int,
         nmlp_layers: int,
         mlp_hidden_dim: int,
+        interaction_network: str = "message_passing",
+        gradient_checkpointing: bool = False,
     ):
         """Encode-Process-Decode function approximator for learnable simulator.
 
@@ -388,6 +538,9 @@ class EncodeProcessDecode(nn.Module):
           latent_dim: Size of latent dimension (128).
           nmlp_layer: Number of hidden layers in the MLP (typically of size 2).
           mlp_hidden_dim: Size of the hidden layer (latent dimension of size 256).
+          interaction_network: Implementation of the processor's GN blocks,
+            "message_passing" or "fused".
+          gradient_checkpointing: Checkpoint the processor's GN blocks.
 
         """
         super(EncodeProcessDecode, self).__init__()
@@ -407,6 +560,8 @@ class EncodeProcessDecode(nn.Module):
             nmessage_passing_steps=nmessage_passing_steps,
             nmlp_layers=nmlp_layers,
             mlp_hidden_dim=mlp_hidden_dim,
+            interaction_network=interaction_network,
+            gradient_checkpointing=gradient_checkpointing,
         )
         self._decoder = Decoder(
             nnode_in=latent_dim,
@@ -418,7 +573,8 @@ class EncodeProcessDecode(nn.Module):
     def forward(self,
                 x: torch.tensor,
                 edge_index: torch.tensor,
-                edge_features: torch.tensor):
+                edge_features: torch.tensor,
+                node_static_term: torch.tensor = None):
         """The forward hook runs at instatiation of EncodeProcessorDecode class.
 
           Args:
@@ -428,12 +584,14 @@ class EncodeProcessDecode(nn.Module):
               (2, nedges)
             edge_features: Edge features as a torch tensor with shape 
               (nedges, nedge_in_features)
+            node_static_term: Optional precomputed first-layer term of the
+              time-invariant node features (see `Encoder.node_static_term`).
 
           Returns:
             x: Particle state representation as a torch tensor with shape
               (nparticles, nnode_out_features)
         """
-        x, edge_features = self._encoder(x, edge_features)
+        x, edge_features = self._encoder(x, edge_features, node_static_term)
         x, edge_features = self._processor(x, edge_index, edge_features)
         x = self._decoder(x)
         return x
@@ -2,10 +2,39 @@ import torch
 import torch.nn as nn
 import numpy as np
 from gns import graph_network
-from torch_geometric.nn import knn_graph
+from gns import graph_builder
 from typing import Dict
 
 
+# Autocast dtype of EncodeProcessDecode per precision (None: no autocast)
+PRECISIONS = {"float32": None, "bfloat16": torch.bfloat16}
+
+# Checkpoint entry holding the dt (temporal stride) the model was trained with
+DT_KEY = "_dt"
+
+
+class RolloutContext:
+    """Time-invariant node inputs of one rollout, computed once by
+    `LearnedSimulator.rollout_context` and reused at every step.
+
+    Attributes:
+      boundaries: Boundaries tensor with shape (dim, 2) on the runtime device.
+      static_features: Time-invariant node features (embeddings and material
+        properties) with shape (nparticles, nstatic_features), or None.
+      node_static_term: The encoder's first node layer applied to
+        `static_features` (bias included), or None if it could not be split.
+    """
+
+    def __init__(
+            self,
+            boundaries: torch.tensor,
+            static_features: torch.tensor = None,
+            node_static_term: torch.tensor = None):
+        self.boundaries = boundaries
+        self.static_features = static_features
+        self.node_static_term = node_static_term
+
+
 class LearnedSimulator(nn.Module):
     """Learned simulator from https://arxiv.org/pdf/2002.09405.pdf."""
 
@@ -24,7 +53,14 @@ class LearnedSimulator(nn.Module):
             particle_type_embedding_size: int,
             nuniverse_types: int,
             universe_number_embedding_size: int,
-            device="cpu"
+            device="cpu",
+            knn_k: int = 2,
+            knn_radius: float = None,
+            knn_backend: str = "auto",
+            interaction_network: str = "message_passing",
+            precision: str = "float32",
+            gradient_checkpointing: bool = False,
+            dt: float = 1.
     ):
         """Initializes the model.
 
@@ -46,6 +82,18 @@ class LearnedSimulator(nn.Module):
           nuniverse_types: Number of different universe types.
           universe_number_embedding_size: Embedding size for the universe number.
           device: Runtime device (cuda or cpu).
+          knn_k: Number of nearest neighbours per particle (self edge included).
+          knn_radius: Optional cutoff distance for the nearest neighbours.
+          knn_backend: kNN graph backend, one of `graph_builder.BACKENDS`.
+          interaction_network: Processor GN block, "message_passing" or "fused".
+          precision: "float32", or "bfloat16" to run EncodeProcessDecode under
+            bfloat16 autocast (normalization and integration stay in float32).
+          gradient_checkpointing: Recompute the processor's activations in the
+            backward pass instead of storing them.
+          dt: Time between the positions of the input window and the predicted
+            one, in the time unit of the normalization statistics (dataset
+            steps, so the temporal stride). Velocities and accelerations are
+            finite differences divided by dt.
 
         """
         super(LearnedSimulator, self).__init__()
@@ -53,6 +101,7 @@ class LearnedSimulator(nn.Module):
         self._normalization_stats = normalization_stats
         self._nparticle_types = nparticle_types
         self._nuniverse_types = nuniverse_types
+        self._dt = dt
 
         # Particle type embedding has shape (num_ptypes, 16)
         self._particle_type_embedding = nn.Embedding(
@@ -69,20 +118,77 @@ class LearnedSimulator(nn.Module):
             latent_dim=latent_dim,
             nmessage_passing_steps=nmessage_passing_steps,
             nmlp_layers=nmlp_layers,
-            mlp_hidden_dim=mlp_hidden_dim)
+            mlp_hidden_dim=mlp_hidden_dim,
+            interaction_network=interaction_network,
+            gradient_checkpointing=gradient_checkpointing)
 
         self._device = device
 
-    def forward(self):
-        """Forward hook runs on class instantiation"""
-        pass
+        self._knn_k = knn_k
+        self._knn_radius = knn_radius
+        self._knn_backend = knn_backend
+
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {list(PRECISIONS)}")
+        self._autocast_dtype = PRECISIONS[precision]
+
+        # Opt-in reuse of the kNN graph across rollout steps (see `set_graph_reuse`)
+        self._graph_skin = None
+        self._graph_cache = None
+
+    def forward(self, *args, **kwargs):
+        """Training forward pass, see `predict_accelerations`.
+
+        Calling the module (rather than the method) lets a
+        DistributedDataParallel wrapper all-reduce the gradients.
+        """
+        return self.predict_accelerations(*args, **kwargs)
+
+    def set_graph_reuse(
+            self,
+            skin: float = None):
+        """Reuse the previous kNN graph while particles move little (Verlet-list style).
+
+        When enabled, and the simulator is in eval mode, the graph is only rebuilt
+        once some particle has moved more than `skin / 2` in composition space
+        since the last build. Since the graph is a kNN graph, the reused edges are
+        an approximation of the exact neighbours; a smaller skin is more exact.
+
+        Args:
+          skin: Skin distance in (normalized) composition space. None disables reuse.
+        """
+        self._graph_skin = skin
+        self._graph_cache = None
+
+    def reset_graph_cache(self):
+        """Forget the cached graph, e.g. at the start of a new rollout."""
+        self._graph_cache = None
+
+    def _batch_ids(
+            self,
+            nparticles_per_example,
+            nparticles: int) -> torch.tensor:
+        """Example id of every particle, e.g. [0, 0, 0, 1, 1] for (3, 2) particles.
+
+        Args:
+          nparticles_per_example: Number of particles per example, as a tensor or
+            a list of ints/tensors.
+          nparticles: Total number of particles.
+        """
+        if isinstance(nparticles_per_example, (list, tuple)):
+            counts = torch.cat([torch.as_tensor(n).reshape(-1) for n in nparticles_per_example])
+        else:
+            counts = torch.as_tensor(nparticles_per_example).reshape(-1)
+        counts = counts.to(device=self._device, dtype=torch.long)
+        return torch.repeat_interleave(
+            torch.arange(len(counts), device=counts.device), counts, output_size=nparticles)
 
     def _compute_graph_connectivity(
             self,
             node_features: torch.tensor,
             nparticles_per_example: torch.tensor,
             add_self_edges: bool = True):
-        """Generate graph edges to all particles' 2 NN
+        """Generate graph edges to all particles' k NN (2 by default)
 
         Args:
           node_features: Node features with shape (nparticles, dim).
@@ -91,28 +197,99 @@ class LearnedSimulator(nn.Module):
           add_self_edges: Boolean flag to include self edge (default: True)
         """
         # Specify examples id for particles
-        batch_ids = torch.cat(
-            [torch.LongTensor([i for _ in range(n)])
-             for i, n in enumerate(nparticles_per_example)]).to(self._device)
+        batch_ids = self._batch_ids(nparticles_per_example, node_features.shape[0])
+
+        reuse = self._graph_skin is not None and not self.training
+        if reuse and self._graph_cache is not None:
+            cached_positions, cached_batch_ids, cached_edges = self._graph_cache
+            if cached_batch_ids.shape == batch_ids.shape and torch.equal(cached_batch_ids, batch_ids):
+                displacement = torch.linalg.vector_norm(
+                    node_features - cached_positions, dim=-1).max()
+                if displacement <= 0.5 * self._graph_skin:
+                    return cached_edges
 
         # A torch tensor list of source and target nodes with shape (2, nedges)
-        edge_index = knn_graph(
-            node_features, k=2, batch=batch_ids, loop=add_self_edges)
+        edge_index = graph_builder.knn_graph(
+            node_features, k=self._knn_k, batch=batch_ids, loop=add_self_edges,
+            radius=self._knn_radius, backend=self._knn_backend)
 
         # The flow direction when using in combination with message passing is
         # "source_to_target"
         receivers = edge_index[0, :]
         senders = edge_index[1, :]
 
+        if reuse:
+            self._graph_cache = (node_features.detach().clone(), batch_ids, (receivers, senders))
+
         return receivers, senders
 
+    def _static_node_features(
+            self,
+            particle_types: torch.tensor,
+            universe_numbers: torch.tensor,
+            material_property: torch.tensor = None):
+        """Node features that do not change over time: particle type and
+        universe embeddings and material properties.
+
+        Returns:
+          list: Feature tensors with shape (nparticles, nfeatures), in node feature order.
+        """
+        node_features = []
+
+        # Particle type
+        if self._nparticle_types > 1:
+            particle_type_embeddings = self._particle_type_embedding(
+                particle_types)
+            node_features.append(particle_type_embeddings)
+            
+        # Universe type
+        if self._nuniverse_types > 1:
+            universe_number_embeddings = self._universe_number_embedding(
+                universe_numbers)
+            node_features.append(universe_number_embeddings)
+
+        # Material property
+        if material_property is not None:
+            # material_property = material_property.view(nparticles, 1)
+            node_features.append(material_property)
+
+        return node_features
+
+    def rollout_context(
+            self,
+            particle_types: torch.tensor,
+            universe_numbers: torch.tensor,
+            material_property: torch.tensor = None) -> RolloutContext:
+        """Precompute the time-invariant node inputs of a rollout.
+
+        The context is only valid while the model weights are unchanged, so it
+        is meant for evaluation rollouts, not training.
+
+        Args:
+          particle_types: Particle types with shape (nparticles)
+          universe_numbers: Category variable representing data under same conditions (nparticles)
+          material_property: Particle characteristics that do not change over time (nparticles)
+        """
+        boundaries = torch.tensor(
+            self._boundaries, requires_grad=False).float().to(self._device)
+        static_features = self._static_node_features(
+            particle_types, universe_numbers, material_property)
+        if not static_features:
+            return RolloutContext(boundaries)
+
+        static_features = torch.cat(static_features, dim=-1)
+        node_static_term = self._encode_process_decode._encoder.node_static_term(
+            static_features)
+        return RolloutContext(boundaries, static_features, node_static_term)
+
     def _encoder_preprocessor(
             self,
             position_sequence: torch.tensor,
             nparticles_per_example: torch.tensor,
             particle_types: torch.tensor,
             universe_numbers: torch.tensor,
-            material_property: torch.tensor = None):
+            material_property: torch.tensor = None,
+            context: RolloutContext = None):
         """Extracts important features from the position sequence. Returns a tuple
         of node_features (nparticles, total_dim), edge_index (nparticles, nparticles), and
         edge_features (nparticles, 3).
@@ -125,10 +302,12 @@ class LearnedSimulator(nn.Module):
           particle_types: Particle types with shape (nparticles)
           universe_numbers: Category variable representing data under same conditions (nparticles)
           material_property: multi-dimensional vector of particle properties, e.g. BC, OC, N (nparticles)
+          context: Optional `RolloutContext`. If it holds a node static term, the
+            returned node features only contain the time-dependent features.
         """
         nparticles = position_sequence.shape[0]
         most_recent_position = position_sequence[:, -1]  # (n_nodes, 2)
-        velocity_sequence = time_diff(position_sequence)
+        velocity_sequence = time_diff(position_sequence) / self._dt
 
         # Get connectivity of the graph with shape of (nparticles, 2)
         senders, receivers = self._compute_graph_connectivity(
@@ -148,8 +327,11 @@ class LearnedSimulator(nn.Module):
         # Normalized clipped distances to lower and upper boundaries.
         # boundaries are an array of shape [num_dimensions, 2], where the second
         # axis, provides the lower/upper boundaries.
-        boundaries = torch.tensor(
-            self._boundaries, requires_grad=False).float().to(self._device)
+        if context is not None:
+            boundaries = context.boundaries
+        else:
+            boundaries = torch.tensor(
+                self._boundaries, requires_grad=False).float().to(self._device)
         distance_to_lower_boundary = (
             most_recent_position - boundaries[:, 0][None])
         distance_to_upper_boundary = (
@@ -164,22 +346,12 @@ class LearnedSimulator(nn.Module):
         # node_features.append(normalized_clipped_distance_to_upper_boundary)
         node_features.append(distance_to_boundaries)
 
-        # Particle type
-        if self._nparticle_types > 1:
-            particle_type_embeddings = self._particle_type_embedding(
-                particle_types)
-            node_features.append(particle_type_embeddings)
-            
-        # Universe type
-        if self._nuniverse_types > 1:
-            universe_number_embeddings = self._universe_number_embedding(
-                universe_numbers)
-            node_features.append(universe_number_embeddings)
-
-        # Material property
-        if material_property is not None:
-            # material_property = material_property.view(nparticles, 1)
-            node_features.append(material_property)
+        # Time-invariant features (embeddings, material property)
+        if context is None:
+            node_features.extend(self._static_node_features(
+                particle_types, universe_numbers, material_property))
+        elif context.static_features is not None and context.node_static_term is None:
+            node_features.append(context.static_features)
 
         # Collect edge features.
         edge_features = []
@@ -205,6 +377,25 @@ class LearnedSimulator(nn.Module):
                 torch.stack([senders, receivers]),
                 torch.cat(edge_features, dim=-1))
 
+    def _encode_process_decode_forward(
+            self,
+            node_features: torch.tensor,
+            edge_index: torch.tensor,
+            edge_features: torch.tensor,
+            node_static_term: torch.tensor = None) -> torch.tensor:
+        """Run EncodeProcessDecode, under autocast for reduced precision.
+
+        Returns:
+          torch.tensor: Normalized acceleration in float32 (nparticles, dim).
+        """
+        if self._autocast_dtype is None:
+            return self._encode_process_decode(
+                node_features, edge_index, edge_features, node_static_term)
+        with torch.autocast(device_type=node_features.device.type, dtype=self._autocast_dtype):
+            normalized_acceleration = self._encode_process_decode(
+                node_features, edge_index, edge_features, node_static_term)
+        return normalized_acceleration.float()
+
     def _decoder_postprocessor(
             self,
             normalized_acceleration: torch.tensor,
@@ -227,14 +418,13 @@ class LearnedSimulator(nn.Module):
             normalized_acceleration * acceleration_stats['std']
         ) + acceleration_stats['mean']
 
-        # Use an Euler integrator to go from acceleration to position, assuming
-        # a dt=1 corresponding to the size of the finite difference.
+        # Use an Euler integrator to go from acceleration to position, with the
+        # dt of the finite differences.
         most_recent_position = position_sequence[:, -1]
-        most_recent_velocity = most_recent_position - position_sequence[:, -2]
+        most_recent_velocity = (most_recent_position - position_sequence[:, -2]) / self._dt
 
-        # TODO: Fix dt
-        new_velocity = most_recent_velocity + acceleration  # * dt = 1
-        new_position = most_recent_position + new_velocity  # * dt = 1
+        new_velocity = most_recent_velocity + acceleration * self._dt
+        new_position = most_recent_position + new_velocity * self._dt
         return new_position
 
     def predict_positions(
@@ -243,7 +433,8 @@ class LearnedSimulator(nn.Module):
             nparticles_per_example: torch.tensor,
             particle_types: torch.tensor,
             universe_numbers: torch.tensor,
-            material_property: torch.tensor = None) -> torch.tensor:
+            material_property: torch.tensor = None,
+            context: RolloutContext = None) -> torch.tensor:
         """Predict position based on acceleration.
 
         Args:
@@ -253,18 +444,17 @@ class LearnedSimulator(nn.Module):
           particle_types: Particle types with shape (nparticles).
           universe_numbers: Category variable representing data under same conditions (nparticles).
           material_property: Particle characteristics that do not change over time (nparticles).
+          context: Optional `RolloutContext` of the same particles, see `rollout_context`.
 
         Returns:
           next_positions (torch.tensor): Next position of particles.
         """
-        if material_property is not None:
-            node_features, edge_index, edge_features = self._encoder_preprocessor(
-                current_positions, nparticles_per_example, particle_types, universe_numbers, material_property)
-        else:
-            node_features, edge_index, edge_features = self._encoder_preprocessor(
-                current_positions, nparticles_per_example, particle_types, universe_numbers)
-        predicted_normalized_acceleration = self._encode_process_decode(
-            node_features, edge_index, edge_features)
+        node_features, edge_index, edge_features = self._encoder_preprocessor(
+            current_positions, nparticles_per_example, particle_types, universe_numbers,
+            material_property, context)
+        node_static_term = context.node_static_term if context is not None else None
+        predicted_normalized_acceleration = self._encode_process_decode_forward(
+            node_features, edge_index, edge_features, node_static_term)
         next_positions = self._decoder_postprocessor(
             predicted_normalized_acceleration, current_positions)
         return next_positions
@@ -309,7 +499,7 @@ class LearnedSimulator(nn.Module):
         else:
             node_features, edge_index, edge_features = self._encoder_preprocessor(
                 noisy_position_sequence, nparticles_per_example, particle_types, universe_numbers)
-        predicted_normalized_acceleration = self._encode_process_decode(
+        predicted_normalized_acceleration = self._encode_process_decode_forward(
             node_features, edge_index, edge_features)
 
         # Calculate the target acceleration, using an `adjusted_next_position `that
@@ -346,9 +536,9 @@ class LearnedSimulator(nn.Module):
 
         """
         previous_position = position_sequence[:, -1]
-        previous_velocity = previous_position - position_sequence[:, -2]
-        next_velocity = (next_position - previous_position)
-        acceleration = (next_velocity - previous_velocity)
+        previous_velocity = (previous_position - position_sequence[:, -2]) / self._dt
+        next_velocity = (next_position - previous_position) / self._dt
+        acceleration = (next_velocity - previous_velocity) / self._dt
 
         acceleration_stats = self._normalization_stats["acceleration"]
         normalized_acceleration = (
@@ -358,12 +548,12 @@ class LearnedSimulator(nn.Module):
     def save(
             self,
             path: str = 'model.pt'):
-        """Save model state
+        """Save model state, together with the `dt` the model was trained with
 
         Args:
           path: Model path
         """
-        torch.save(self.state_dict(), path)
+        torch.save({**self.state_dict(), DT_KEY: torch.tensor(self._dt)}, path)
 
     def load(
             self,
@@ -372,9 +562,17 @@ class LearnedSimulator(nn.Module):
 
         Args:
           path: Model path
+
+        Raises:
+          ValueError: If the model was trained with another `dt` (i.e.
+            another temporal stride); checkpoints without one have dt = 1.
         """
-        self.load_state_dict(torch.load(
-            path, map_location=torch.device('cpu')))
+        state_dict = torch.load(path, map_location=torch.device('cpu'))
+        dt = float(state_dict.pop(DT_KEY, 1.))
+        if dt != self._dt:
+            raise ValueError(f"{path} was trained with dt={dt:g} (temporal stride), "
+                             f"but the simulator has dt={self._dt:g}")
+        self.load_state_dict(state_dict)
 
 
 def time_diff(
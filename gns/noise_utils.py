@@ -21,8 +21,11 @@ def get_random_walk_noise_for_position_sequence(
     # so to keep `std_last_step` fixed, we apply at each step:
     # std_each_step `std_last_step / np.sqrt(num_input_velocities)`
     num_velocities = velocity_sequence.shape[1]
+    # Sampled on the device (and in the dtype) of the positions, so device-resident
+    # batches never round-trip through the host.
     velocity_sequence_noise = torch.randn(
-        list(velocity_sequence.shape)) * (noise_std_last_step/num_velocities**0.5)
+        list(velocity_sequence.shape), device=velocity_sequence.device,
+        dtype=velocity_sequence.dtype) * (noise_std_last_step/num_velocities**0.5)
 
     # Apply the random walk.
     velocity_sequence_noise = torch.cumsum(velocity_sequence_noise, dim=1)
@@ -0,0 +1,29 @@
+"""Post-training dynamic int8 quantization of a LearnedSimulator for CPU rollouts.
+
+`python -m benchmarks.bench_quantize` reports the rollout drift and speedup of
+the quantized model.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+
+def quantize_simulator(simulator):
+    """Dynamic int8 quantization of the MLP `nn.Linear` layers of a simulator.
+
+    Only EncodeProcessDecode (the layers of `build_mlp`/`build_alt_mlp`) is
+    quantized; the embeddings, normalization and integration stay in float32.
+    Weights are quantized once, activations per batch at run time, so no
+    calibration pass is needed. The quantized model only runs on CPU.
+
+    Args:
+      simulator: Learned simulator with its weights loaded, on CPU.
+
+    Returns:
+      LearnedSimulator: Quantized copy of `simulator`, in eval mode.
+    """
+    quantized = copy.deepcopy(simulator).eval()
+    quantized._encode_process_decode = torch.ao.quantization.quantize_dynamic(
+        quantized._encode_process_decode, {nn.Linear}, dtype=torch.qint8)
+    return quantized
@@ -0,0 +1,259 @@
+"""Allocation-free rollout loop.
+
+The rollout keeps its input window in one preallocated (nparticles, 2, dim)
+tensor that is shifted in place, hands every predicted step to a sink and, if a
+ground truth is given, reduces the squared error of each step in place. Only
+the simulator's own forward pass allocates per step. An optional
+`SteadyStateMonitor` ends the rollout (or its use of the simulator) once the
+trajectories have converged.
+"""
+import torch
+from tqdm import tqdm
+
+
+class RolloutSink:
+    """Receives the predicted positions of a rollout, one step at a time."""
+
+    def start(self, nsteps: int, nparticles: int, dim: int, dtype, device):
+        """Called once before the first step."""
+
+    def write(self, step: int, positions: torch.tensor):
+        """Store the predicted positions (nparticles, dim) of `step`.
+
+        `positions` may be overwritten after the call returns, so copy it.
+        """
+        raise NotImplementedError
+
+    def checkpoint(self, step: int, window: torch.tensor):
+        """Called after every step with the input window (nparticles, 2, dim) of
+        `step`, the next one; sinks that persist the rollout can checkpoint it."""
+
+    def truncate(self, nsteps: int):
+        """Called before `finish` if the rollout ended after `nsteps` steps,
+        fewer than the ones it was started with."""
+
+    def finish(self):
+        """Called once after the last step; the return value is the rollout result."""
+
+
+class TensorSink(RolloutSink):
+    """Collects the rollout in one preallocated (nsteps, nparticles, dim) tensor."""
+
+    def __init__(self):
+        self.predictions = None
+
+    def start(self, nsteps, nparticles, dim, dtype, device):
+        self.predictions = torch.empty((nsteps, nparticles, dim), dtype=dtype, device=device)
+
+    def write(self, step, positions):
+        self.predictions[step].copy_(positions)
+
+    def truncate(self, nsteps):
+        self.predictions = self.predictions[:nsteps]
+
+    def finish(self):
+        return self.predictions
+
+
+class EnsembleSink(RolloutSink):
+    """Reduces an ensemble rollout to per-step statistics over its members.
+
+    The members are consecutive blocks of `nparticles / nmembers` particles.
+    Only the mean, standard deviation and quantiles over the members are kept
+    (per step, particle and dimension), never the members' trajectories.
+    """
+
+    def __init__(self, nmembers: int, quantiles=(0.05, 0.5, 0.95)):
+        self.nmembers = nmembers
+        self.quantiles = torch.as_tensor(quantiles, dtype=torch.float32)
+        self.mean = None
+        self.std = None
+        self.quantile_values = None
+
+    def start(self, nsteps, nparticles, dim, dtype, device):
+        if nparticles % self.nmembers:
+            raise ValueError(f"{nparticles} particles do not split into {self.nmembers} members")
+        shape = (nsteps, nparticles // self.nmembers, dim)
+        self.quantiles = self.quantiles.to(dtype=dtype, device=device)
+        self.mean = torch.empty(shape, dtype=dtype, device=device)
+        self.std = torch.empty(shape, dtype=dtype, device=device)
+        self.quantile_values = torch.empty((len(self.quantiles),) + shape, dtype=dtype, device=device)
+
+    def write(self, step, positions):
+        members = positions.view(self.nmembers, -1, positions.shape[-1])
+        std, mean = torch.std_mean(members, dim=0, correction=0)
+        self.std[step].copy_(std)
+        self.mean[step].copy_(mean)
+        self.quantile_values[:, step] = torch.quantile(members, self.quantiles, dim=0)
+
+    def truncate(self, nsteps):
+        self.mean = self.mean[:nsteps]
+        self.std = self.std[:nsteps]
+        self.quantile_values = self.quantile_values[:, :nsteps]
+
+    def finish(self):
+        """Returns a dict of the mean and std (nsteps, nparticles, dim) and the
+        quantiles (nquantiles, nsteps, nparticles, dim) over the members."""
+        return {'mean': self.mean, 'std': self.std, 'quantiles': self.quantile_values}
+
+
+class SteadyStateMonitor:
+    """Detects when the examples of a rollout have reached a steady state.
+
+    An example is steady once the RMS velocity over its particles (position
+    change per step) of every species stays below `tol` for `window`
+    consecutive steps. When all examples are steady, the simulator is no longer
+    called: with action 'stop' the rollout ends there, with 'extrapolate' the
+    remaining steps move every particle on at its last velocity.
+    """
+
+    ACTIONS = ('stop', 'extrapolate')
+
+    def __init__(self, tol: float, window: int = 10, action: str = 'stop'):
+        if action not in self.ACTIONS:
+            raise ValueError(f"Unknown steady state action {action}, expected one of {self.ACTIONS}")
+        self.tol = tol
+        self.window = window
+        self.action = action
+        # Step after which every example was steady, and per example the
+        # step after which it was (-1 if never)
+        self.stop_step = None
+        self.steady_steps = None
+
+    def start(self, example_ids: torch.tensor, counts: torch.tensor, dim: int, dtype, device):
+        """Called once before the first step with the example of every particle."""
+        self.example_ids = example_ids
+        self.counts = counts.to(dtype)[:, None]
+        self.squared_velocity = torch.empty((len(counts), dim), dtype=dtype, device=device)
+        self.nsteady = torch.zeros(len(counts), dtype=torch.long, device=device)
+        self.steady_steps = torch.full((len(counts),), -1, dtype=torch.long, device=device)
+        self.stop_step = None
+
+    def update(self, step: int, velocity: torch.tensor) -> bool:
+        """Track the velocity (nparticles, dim) of `step`; True once all examples are steady."""
+        self.squared_velocity.zero_().index_add_(0, self.example_ids, velocity.square())
+        steady = (self.squared_velocity / self.counts < self.tol ** 2).all(dim=1)
+        self.nsteady = torch.where(steady, self.nsteady + 1, 0)
+        converged = self.nsteady >= self.window
+        self.steady_steps[converged & (self.steady_steps < 0)] = step + 1
+        if bool(converged.all()):
+            self.stop_step = step + 1
+            return True
+        return False
+
+
+def rollout(
+        simulator,
+        initial_positions: torch.tensor,
+        nsteps: int,
+        particle_types: torch.tensor,
+        universe_numbers: torch.tensor,
+        material_property: torch.tensor = None,
+        nparticles_per_example=None,
+        ground_truth_positions: torch.tensor = None,
+        sink: RolloutSink = None,
+        progress: bool = True,
+        start_step: int = 0,
+        monitor: SteadyStateMonitor = None):
+    """Roll out a trajectory by applying the simulator in sequence.
+
+    Args:
+      simulator: Learned simulator (or a `compiled.CompiledSimulator`).
+      initial_positions: Initial positions with shape (nparticles, 2, dim), i.e.
+        the input window of `start_step`.
+      nsteps: Number of steps.
+      particle_types: Particles types with shape (nparticles)
+      universe_numbers: Category variable representing data under same conditions (nparticles)
+      material_property: Particle characteristics that do not change over time (nparticles)
+      nparticles_per_example: Number of particles per example (default: one
+        example), as a tensor or a list of ints/tensors. Examples are disjoint
+        graphs rolled out in lockstep.
+      ground_truth_positions: Optional ground truth with shape (nparticles, >= nsteps, dim).
+      sink: Where the predictions go (default: a `TensorSink`).
+      progress: Show a progress bar.
+      start_step: Step to resume from (e.g. a checkpoint of the sink); the
+        earlier steps are neither predicted nor handed to the sink.
+      monitor: Optional steady state monitor; a rollout it stops has only
+        `monitor.stop_step` steps.
+
+    Returns:
+      tuple: The sink's result (a (nsteps, nparticles, dim) tensor for
+        `TensorSink`) and the mean squared error of every step and example with
+        shape (nsteps, nexamples), or None without ground truth.
+    """
+    nparticles, _, dim = initial_positions.shape
+    device = initial_positions.device
+    if nparticles_per_example is None:
+        nparticles_per_example = torch.tensor([nparticles])
+    if sink is None:
+        sink = TensorSink()
+    sink.start(nsteps, nparticles, dim, initial_positions.dtype, device)
+
+    window = initial_positions.clone(memory_format=torch.contiguous_format)
+    if ground_truth_positions is not None or monitor is not None:
+        counts = example_counts(nparticles_per_example).to(device)
+        example_ids = torch.repeat_interleave(
+            torch.arange(len(counts), device=device), counts, output_size=nparticles)
+    if monitor is not None:
+        monitor.start(example_ids, counts, dim, initial_positions.dtype, device)
+        velocity = torch.empty((nparticles, dim), dtype=initial_positions.dtype, device=device)
+    steady = False
+    if ground_truth_positions is not None:
+        loss = torch.zeros((nsteps, len(counts)), dtype=initial_positions.dtype, device=device)
+        error = torch.empty((nparticles, dim), dtype=initial_positions.dtype, device=device)
+    else:
+        loss = None
+
+    simulator.reset_graph_cache()
+    context = simulator.rollout_context(
+        particle_types, universe_numbers, material_property)
+
+    for step in tqdm(range(start_step, nsteps), initial=start_step, total=nsteps, disable=not progress):
+        if steady:
+            # Steady: keep the last velocity instead of calling the simulator
+            next_position = window[:, 1] + velocity
+        else:
+            # Get next position with shape (nnodes, dim)
+            next_position = simulator.predict_positions(
+                window,
+                nparticles_per_example=nparticles_per_example,
+                particle_types=particle_types,
+                universe_numbers=universe_numbers,
+                material_property=material_property,
+                context=context
+            )
+            if monitor is not None:
+                torch.sub(next_position, window[:, 1], out=velocity)
+                steady = monitor.update(step, velocity)
+        sink.write(step, next_position)
+
+        if loss is not None:
+            torch.sub(next_position, ground_truth_positions[:, step], out=error)
+            loss[step].index_add_(0, example_ids, error.square_().sum(dim=-1))
+
+        # Shift the window in place: drop the oldest position, append the new one
+        window[:, 0].copy_(window[:, 1])
+        window[:, 1].copy_(next_position)
+        sink.checkpoint(step + 1, window)
+
+        if steady and monitor.action == 'stop':
+            if step + 1 < nsteps:
+                sink.truncate(step + 1)
+                if loss is not None:
+                    loss = loss[:step + 1]
+            break
+
+    if loss is not None:
+        loss /= counts * dim
+    return sink.finish(), loss
+
+
+def example_counts(nparticles_per_example) -> torch.tensor:
+    """Number of particles per example as a 1D long tensor.
+
+    Args:
+      nparticles_per_example: A tensor or a list of ints/tensors.
+    """
+    if isinstance(nparticles_per_example, (list, tuple)):
+        return torch.cat([torch.as_tensor(n).reshape(-1) for n in nparticles_per_example]).long()
+    return torch.as_tensor(nparticles_per_example).reshape(-1).long()
@@ -0,0 +1,237 @@
+"""Chunked, memory-mappable rollout outputs.
+
+A rollout store is a directory with one raw array file per array of the
+rollout output dict (see `columnar`) and a JSON manifest. The predicted
+positions are appended in time chunks while the rollout runs, so neither the
+writer nor the readers need the whole trajectory in memory, and every chunk
+checkpoints the rollout so that an interrupted one can be resumed:
+
+    rollout = rollout_store.load_rollout('rollouts/rollout_ex0')
+    rollout['predicted_rollout'][100:200, :1000]  # reads only these pages
+"""
+import json
+import os
+
+import numpy as np
+import torch
+
+from gns import columnar
+from gns import rollout_engine
+
+MANIFEST_FILE = "manifest.json"
+FORMAT_NAME = "glad-rollout"
+FORMAT_VERSION = 1
+PREDICTED = "predicted_rollout"
+
+
+def is_rollout_store(path: str) -> bool:
+    """Whether `path` is a rollout store directory.
+
+    Args:
+        path (str): Path to check.
+
+    Returns:
+        bool: True if `path` holds a rollout manifest.
+    """
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def _read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE), "rt") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a {FORMAT_NAME} store")
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    """Replace the manifest atomically, so readers never see a partial one."""
+    filename = os.path.join(path, MANIFEST_FILE)
+    with open(filename + ".tmp", "wt") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(filename + ".tmp", filename)
+
+
+def _new_manifest():
+    return {"format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "complete": False,
+            "arrays": {},
+            "attributes": {}}
+
+
+class RolloutStoreSink(rollout_engine.RolloutSink):
+    """Streams the predicted positions of one or more packed examples to stores.
+
+    Steps are buffered on the host and appended to `predicted_rollout.bin` of
+    each example every `chunk_size` steps. The manifest then records the steps
+    written together with a checkpoint, the input window of the next step, from
+    which a new sink with `resume=True` continues an interrupted rollout.
+    """
+
+    def __init__(self, paths, nparticles_per_example, chunk_size: int = 64, resume: bool = False):
+        """
+        Args:
+          paths: Store directory of every example, created if missing.
+          nparticles_per_example: Number of particles of every example, in the
+            order they are packed in the rollout.
+          chunk_size: Number of steps per appended chunk (and checkpoint).
+          resume: Append to the stores after their checkpoint instead of
+            starting new ones; see `read_checkpoint`.
+        """
+        self.paths = list(paths)
+        counts = rollout_engine.example_counts(nparticles_per_example).tolist()
+        self.ranges = np.cumsum([0] + counts)
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.buffer = None
+        self.files = []
+        self.nsteps_buffered = 0
+        self.nsteps_written = 0
+
+    def start(self, nsteps, nparticles, dim, dtype, device):
+        self.buffer = torch.empty((min(self.chunk_size, nsteps), nparticles, dim), dtype=dtype)
+        self.nsteps_buffered = 0
+        self.nsteps_written = 0
+        self.files = []
+        for i, path in enumerate(self.paths):
+            filename = os.path.join(path, PREDICTED + ".bin")
+            if self.resume:
+                _, step, _ = read_checkpoint(path)
+                if step is None or (i > 0 and step != self.nsteps_written):
+                    raise ValueError(f"{path} has no checkpoint to resume the packed rollout from")
+                self.nsteps_written = step
+                # Drop the steps appended after the checkpoint
+                f = open(filename, "r+b")
+                f.truncate(step * (self.ranges[i + 1] - self.ranges[i]) * dim * self.buffer.element_size())
+                f.seek(0, os.SEEK_END)
+            else:
+                os.makedirs(path, exist_ok=True)
+                _write_manifest(path, _new_manifest())
+                f = open(filename, "wb")
+            self.files.append(f)
+        self._update_manifests()
+
+    def write(self, step, positions):
+        self.buffer[self.nsteps_buffered].copy_(positions)
+        self.nsteps_buffered += 1
+        if self.nsteps_buffered == len(self.buffer):
+            self._flush()
+
+    def checkpoint(self, step, window):
+        # Right after a chunk was appended, `window` only holds written steps
+        if self.nsteps_buffered == 0 and step == self.nsteps_written:
+            self._update_manifests(window.cpu().numpy())
+
+    def finish(self):
+        """Returns the store paths."""
+        self._flush()
+        self._update_manifests()
+        for f in self.files:
+            f.close()
+        return self.paths
+
+    def _flush(self):
+        """Append the buffered steps to the stores."""
+        if self.nsteps_buffered == 0:
+            return
+        chunk = self.buffer[:self.nsteps_buffered].numpy()
+        for i, f in enumerate(self.files):
+            np.ascontiguousarray(chunk[:, self.ranges[i]:self.ranges[i + 1]]).tofile(f)
+            f.flush()
+        self.nsteps_written += self.nsteps_buffered
+        self.nsteps_buffered = 0
+
+    def _update_manifests(self, window: np.ndarray = None):
+        """Record the steps written and, if given, the window of the next step."""
+        dim = self.buffer.shape[-1]
+        dtype = self.buffer[:0].numpy().dtype.str
+        for i, path in enumerate(self.paths):
+            manifest = _read_manifest(path)
+            manifest["arrays"][PREDICTED] = {
+                "file": PREDICTED + ".bin", "dtype": dtype,
+                "shape": [self.nsteps_written, int(self.ranges[i + 1] - self.ranges[i]), dim]}
+            manifest["chunk_size"] = self.chunk_size
+            previous = manifest.get("checkpoint")
+            if window is not None:
+                manifest["checkpoint"] = {
+                    "step": self.nsteps_written,
+                    "window": columnar._write_array(
+                        path, f"window-{self.nsteps_written}.bin", window[self.ranges[i]:self.ranges[i + 1]])}
+            _write_manifest(path, manifest)
+            if window is not None and previous is not None:
+                _remove_array(path, previous["window"])
+
+
+def _remove_array(path, entry):
+    filename = os.path.join(path, entry["file"])
+    if os.path.exists(filename):
+        os.remove(filename)
+
+
+def read_checkpoint(path: str):
+    """Progress of a rollout store.
+
+    Args:
+        path (str): Rollout store directory.
+
+    Returns:
+        tuple: Whether the store is complete, the step of its latest checkpoint
+          and the input window of that step (nparticles, 2, dim); the latter two
+          are None without a checkpoint.
+    """
+    manifest = _read_manifest(path)
+    checkpoint = manifest.get("checkpoint")
+    if checkpoint is None:
+        return manifest["complete"], None, None
+    window = np.array(columnar._open_array(path, checkpoint["window"]))
+    return manifest["complete"], checkpoint["step"], window
+
+
+def save_rollout(path: str, output_dict: dict):
+    """Save a rollout output dict as a store and mark it complete.
+
+    Arrays become raw array files; everything else (metadata, loss, ...) is
+    kept in the manifest. Arrays already streamed to `path` by a
+    `RolloutStoreSink` are kept.
+
+    Args:
+        path (str): Store directory, created if missing.
+        output_dict (dict): Rollout output, as written to the rollout pickles.
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest = _read_manifest(path) if is_rollout_store(path) else _new_manifest()
+    for name, value in output_dict.items():
+        if isinstance(value, torch.Tensor):
+            value = value.cpu().numpy()
+        if isinstance(value, np.ndarray) and value.ndim > 0:
+            manifest["arrays"][name] = columnar._write_array(path, f"{name}.bin", value)
+        else:
+            if isinstance(value, np.ndarray):
+                value = value.item()
+            manifest["attributes"][name] = value
+    checkpoint = manifest.pop("checkpoint", None)
+    manifest["complete"] = True
+    _write_manifest(path, manifest)
+    if checkpoint is not None:
+        _remove_array(path, checkpoint["window"])
+
+
+def load_rollout(path: str) -> dict:
+    """Open a rollout store with np.memmap.
+
+    Only the manifest is read here; slicing an array (e.g. a time and particle
+    range of `predicted_rollout`) reads just the pages it touches. A store that
+    is still being written holds the steps appended so far.
+
+    Args:
+        path (str): Rollout store directory.
+
+    Returns:
+        dict: The rollout output dict, with memory-mapped arrays.
+    """
+    manifest = _read_manifest(path)
+    rollout = {name: columnar._open_array(path, entry)
+               for name, entry in manifest["arrays"].items()}
+    rollout.update(manifest["attributes"])
+    return rollout
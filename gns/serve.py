@@ -0,0 +1,421 @@
+"""Long-lived rollout server keeping loaded simulators in memory.
+
+python -m gns.serve --data_path='<prepared data path>' --model_path='<model storage path>'
+       [--port=8000 | --socket_path='/tmp/gns.sock']
+
+Jobs are HTTP POSTs, over TCP or a Unix socket, of an npz body holding one
+trajectory as `train.rollout` takes it: `positions` (nparticles, timesteps,
+dim), `particle_type`, `universe_number` and optionally `material_property`.
+
+    POST /rollout?model_file=model-100.pt  -> npz of `predicted_rollout`, `loss`
+    POST /predict?model_file=model-100.pt  -> npz of `predicted_rollout`
+    GET /health                            -> JSON list of the loaded models
+
+`data_path`, `model_path` and `nsteps` (model steps, of --temporal_stride
+dataset steps each) can be given per job as well. The
+rollout of `/rollout` starts from the first two positions and is compared with
+the rest; `/predict` rolls out `nsteps` steps (default: from the metadata).
+The `--cache_size` most recently used checkpoints stay loaded, and concurrent
+jobs for the same checkpoint and horizon are packed into one graph and rolled
+out in lockstep (`train.rollout_batch`). The model flags (--knn_k,
+--interaction_network, --compile, ...) are those of gns.train; `Client` sends
+jobs from Python.
+"""
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import torch
+from absl import app
+from absl import flags
+
+from gns import reading_utils
+from gns import train
+
+flags.DEFINE_string('host', 'localhost', help='Host of the HTTP endpoint.')
+flags.DEFINE_integer('port', 8000, help='Port of the HTTP endpoint.')
+flags.DEFINE_string('socket_path', None, help='Serve on this Unix socket instead of host:port.')
+flags.DEFINE_integer('cache_size', 2, help='Number of loaded checkpoints kept in memory.')
+flags.DEFINE_integer('max_batch_size', 16, help='Maximum number of jobs rolled out together.')
+flags.DEFINE_float('batch_timeout_ms', 5., help='How long a job waits for others to batch with.')
+
+FLAGS = flags.FLAGS
+
+
+class _Job:
+    """A rollout job and, once `done` is set, its result or error."""
+
+    def __init__(self, example, nsteps, ground_truth):
+        self.example = example
+        self.nsteps = nsteps
+        self.ground_truth = ground_truth
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ModelWorker:
+    """Rolls out the jobs of one loaded simulator in micro-batches.
+
+    A job waits up to `batch_timeout` seconds for up to `max_batch_size - 1`
+    others; jobs with the same horizon and kind are then packed into one graph.
+    """
+
+    def __init__(self, simulator, metadata, max_batch_size: int = 16, batch_timeout: float = 0.005):
+        self.simulator = simulator
+        self.metadata = metadata
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.rollout_lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, example, nsteps: int, ground_truth: bool):
+        """Queue a job and wait for its (output dictionary, loss)."""
+        job = _Job(example, nsteps, ground_truth)
+        with self.lock:
+            stopped = self.stopped
+            if not stopped:
+                self.jobs.put(job)
+        if stopped:
+            # Evicted while the job was on its way: roll it out here
+            self._rollout([job], nsteps, ground_truth)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stop(self):
+        """Finish the queued jobs and stop the worker thread."""
+        self.jobs.put(None)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.max_batch_size:
+                try:
+                    if deadline is None:
+                        job = self.jobs.get()
+                        deadline = time.perf_counter() + self.batch_timeout
+                    else:
+                        job = self.jobs.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if job is None:
+                    with self.lock:
+                        self.stopped = True
+                    # Only the jobs queued before `stopped` was set are left
+                    stopping = True
+                    batch.extend(self._drain())
+                    break
+                batch.append(job)
+
+            groups = collections.defaultdict(list)
+            for job in batch:
+                groups[job.nsteps, job.ground_truth].append(job)
+            for (nsteps, ground_truth), jobs in groups.items():
+                self._rollout(jobs, nsteps, ground_truth)
+
+    def _drain(self):
+        jobs = []
+        while not self.jobs.empty():
+            jobs.append(self.jobs.get_nowait())
+        return jobs
+
+    def _rollout(self, jobs, nsteps, ground_truth):
+        try:
+            with self.rollout_lock, torch.no_grad():
+                outputs = train.rollout_batch(
+                    self.simulator, [job.example for job in jobs], nsteps,
+                    ground_truth, progress=False)
+            for job, output in zip(jobs, outputs):
+                job.result = output
+        except Exception as error:
+            if len(jobs) > 1:
+                # Do not fail the whole micro-batch for one bad job
+                for job in jobs:
+                    self._rollout([job], nsteps, ground_truth)
+                return
+            jobs[0].error = error
+        for job in jobs:
+            job.done.set()
+
+
+class ModelCache:
+    """LRU cache of `ModelWorker`s keyed by checkpoint, metadata and features."""
+
+    def __init__(self, capacity: int, device: torch.device, max_batch_size: int = 16,
+                 batch_timeout: float = 0.005):
+        self.capacity = capacity
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.workers = collections.OrderedDict()
+        # Checkpoints being loaded: key -> Future of the worker
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get(self, data_path: str, model_file: str, n_features: int) -> ModelWorker:
+        """The worker of a checkpoint, loading it (and evicting the least
+        recently used one) on a miss.
+
+        The checkpoint is loaded outside the cache lock, so hits are not held up
+        by a load; concurrent misses of the same checkpoint wait for one load.
+        """
+        key = (os.path.abspath(data_path), os.path.abspath(model_file), n_features)
+        with self.lock:
+            if key in self.workers:
+                self.workers.move_to_end(key)
+                return self.workers[key]
+            future = self.loading.get(key)
+            if future is None:
+                future = self.loading[key] = concurrent.futures.Future()
+                loader = True
+            else:
+                loader = False
+        if not loader:
+            return future.result()
+
+        try:
+            metadata = reading_utils.read_metadata(data_path, "rollout")
+            simulator = train.load_rollout_simulator(metadata, n_features, model_file, self.device)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        worker = ModelWorker(simulator, metadata, self.max_batch_size, self.batch_timeout)
+        evicted = None
+        with self.lock:
+            del self.loading[key]
+            self.workers[key] = worker
+            if len(self.workers) > self.capacity:
+                _, evicted = self.workers.popitem(last=False)
+        if evicted is not None:
+            evicted.stop()
+        future.set_result(worker)
+        return worker
+
+    def keys(self):
+        with self.lock:
+            return list(self.workers)
+
+
+def _check_arrays(arrays, dim):
+    """Raise a ValueError if the arrays of a job do not form one trajectory of `dim` dimensions."""
+    positions = arrays['positions']
+    if positions.ndim != 3 or positions.shape[2] != dim:
+        raise ValueError(f"positions must have shape (nparticles, timesteps, {dim}), got {positions.shape}")
+    nparticles = positions.shape[0]
+    for name in ('particle_type', 'universe_number'):
+        if arrays[name].shape != (nparticles,):
+            raise ValueError(f"{name} must have shape ({nparticles},), got {arrays[name].shape}")
+    if 'material_property' in arrays and arrays['material_property'].shape[:1] != (nparticles,):
+        raise ValueError(f"material_property must have {nparticles} rows, "
+                         f"got {arrays['material_property'].shape}")
+
+
+def _example(arrays, device):
+    """Turn the arrays of a job into a `train.rollout_batch` example."""
+    positions = torch.from_numpy(arrays['positions']).float().to(device)
+    particle_type = torch.from_numpy(arrays['particle_type']).long().to(device)
+    universe_number = torch.from_numpy(arrays['universe_number']).long().to(device)
+    material_property = None
+    if 'material_property' in arrays:
+        material_property = torch.from_numpy(arrays['material_property']).float().to(device)
+    n_particles_per_example = torch.tensor([positions.shape[0]], dtype=torch.int32).to(device)
+    return positions, particle_type, universe_number, material_property, n_particles_per_example
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if urllib.parse.urlparse(self.path).path != "/health":
+            return self._reply(404, b"Unknown endpoint", "text/plain")
+        models = [list(key) for key in self.server.cache.keys()]
+        self._reply(200, json.dumps({"models": models}).encode(), "application/json")
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path not in ("/rollout", "/predict"):
+            return self._reply(404, b"Unknown endpoint", "text/plain")
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        try:
+            with np.load(io.BytesIO(body), allow_pickle=False) as data_file:
+                arrays = dict(data_file.items())
+            data_path = params.get("data_path", FLAGS.data_path)
+            model_file = os.path.join(params.get("model_path", FLAGS.model_path),
+                                      params.get("model_file", FLAGS.model_file))
+            n_features = 4 if 'material_property' in arrays else 3
+            worker = self.server.cache.get(data_path, model_file, n_features)
+
+            _check_arrays(arrays, worker.metadata['dim'])
+            ground_truth = url.path == "/rollout"
+            sequence_length = arrays['positions'].shape[1]
+            # Every `temporal_stride`-th position is a model step
+            arrays['positions'] = arrays['positions'][:, ::FLAGS.temporal_stride]
+            if arrays['positions'].shape[1] < train.INPUT_SEQUENCE_LENGTH:
+                raise ValueError(f"positions need at least {train.INPUT_SEQUENCE_LENGTH} model steps")
+            max_nsteps = train.rollout_nsteps(sequence_length, FLAGS.temporal_stride)
+            if "nsteps" in params:
+                nsteps = int(params["nsteps"])
+            elif not ground_truth and worker.metadata['sequence_length'] is not None:
+                nsteps = train.rollout_nsteps(worker.metadata['sequence_length'], FLAGS.temporal_stride)
+            else:
+                nsteps = max_nsteps
+            if ground_truth and nsteps > max_nsteps:
+                raise ValueError(f"/rollout needs {nsteps} ground truth steps")
+            # Only the input window (and the ground truth of the rollout) is
+            # used, so that jobs of any trajectory length pack together
+            arrays['positions'] = arrays['positions'][
+                :, :train.INPUT_SEQUENCE_LENGTH + (nsteps if ground_truth else 0)]
+
+            output_dict, loss = worker.submit(
+                _example(arrays, self.server.cache.device), nsteps, ground_truth)
+        except Exception as error:
+            return self._reply(400, f"{type(error).__name__}: {error}".encode(), "text/plain")
+
+        results = {'predicted_rollout': output_dict['predicted_rollout']}
+        if loss is not None:
+            results['loss'] = loss.cpu().numpy()
+        buffer = io.BytesIO()
+        np.savez(buffer, **results)
+        self._reply(200, buffer.getvalue(), "application/octet-stream")
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no (host, port) address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, one thread per connection."""
+
+    daemon_threads = True
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    """Sends jobs to a `gns.serve` server.
+
+    Args:
+      address: "http://host:port" or the path of the server's Unix socket.
+      timeout: Optional socket timeout in seconds.
+    """
+
+    def __init__(self, address: str, timeout: float = None):
+        self.address = address
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.address.startswith("http://"):
+            url = urllib.parse.urlparse(self.address)
+            return http.client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+        return _UnixHTTPConnection(self.address, timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"{method} {path} failed ({response.status}): {data.decode()}")
+        return data
+
+    def health(self) -> dict:
+        return json.loads(self._request("GET", "/health"))
+
+    def rollout(self, positions, particle_type, universe_number, material_property=None,
+                mode: str = "rollout", **params) -> dict:
+        """Roll out one trajectory.
+
+        Args:
+          positions: Positions (nparticles, timesteps, dim); only the first two
+            steps are used by `mode="predict"`.
+          particle_type: Particles types (nparticles).
+          universe_number: Universe numbers (nparticles).
+          material_property: Optional material properties (nparticles, num_prop).
+          mode: "rollout" (compare with the ground truth in `positions`) or "predict".
+          **params: Optional `model_file`, `model_path`, `data_path` and `nsteps`.
+
+        Returns:
+          dict: `predicted_rollout` (nsteps, nparticles, dim) and, for
+            `mode="rollout"`, the `loss` of every step.
+        """
+        arrays = dict(positions=positions, particle_type=particle_type,
+                      universe_number=universe_number)
+        if material_property is not None:
+            arrays['material_property'] = material_property
+        buffer = io.BytesIO()
+        np.savez(buffer, **{name: np.asarray(array) for name, array in arrays.items()})
+        query = urllib.parse.urlencode({name: value for name, value in params.items() if value is not None})
+        data = self._request("POST", f"/{mode}?{query}", buffer.getvalue())
+        with np.load(io.BytesIO(data), allow_pickle=False) as data_file:
+            return dict(data_file.items())
+
+
+def main(_):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if FLAGS.cuda_device_number is not None and torch.cuda.is_available():
+        device = torch.device(f'cuda:{int(FLAGS.cuda_device_number)}')
+    cache = ModelCache(FLAGS.cache_size, device, FLAGS.max_batch_size, FLAGS.batch_timeout_ms / 1e3)
+
+    if FLAGS.socket_path is not None:
+        if os.path.exists(FLAGS.socket_path):
+            os.remove(FLAGS.socket_path)
+        server = ThreadingUnixHTTPServer(FLAGS.socket_path, _Handler)
+        address = FLAGS.socket_path
+    else:
+        server = http.server.ThreadingHTTPServer((FLAGS.host, FLAGS.port), _Handler)
+        address = f"http://{FLAGS.host}:{FLAGS.port}"
+    server.cache = cache
+    print(f"Serving rollouts on {address}", flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    app.run(main)
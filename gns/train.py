@@ -3,6 +3,11 @@ from gns import data_loader
 from gns import reading_utils
 from gns import noise_utils
 from gns import learned_simulator
+from gns import graph_builder
+from gns import compiled
+from gns import quantize
+from gns import rollout_engine
+from gns import rollout_store
 import collections
 import json
 import os
@@ -15,7 +20,6 @@ import time
 import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
-from tqdm import tqdm
 
 from absl import flags
 from absl import app
@@ -50,8 +54,84 @@ flags.DEFINE_float('lr_decay', 0.1, help='Learning rate decay.')
 flags.DEFINE_integer('lr_decay_steps', int(
     1e5), help='Learning rate decay steps.')
 
+flags.DEFINE_enum('dataset_residency', 'host', ['host', 'device'],
+                  help='Where the training set lives: "host" streams batches through a DataLoader, '
+                       '"device" loads train data once into tensors on the training device.')
+
+flags.DEFINE_integer('num_workers', 0, help='Number of persistent data loading worker processes.')
+flags.DEFINE_integer('prefetch_batches', 0,
+                     help='Size of the background queue of batches already moved to the training device (0 disables it).')
+
+flags.DEFINE_integer('rollout_batch_size', 1,
+                     help='Rollout/predict: number of trajectories packed into one graph and rolled out in lockstep.')
+
+flags.DEFINE_enum('rollout_format', 'pickle', ['pickle', 'chunked'],
+                  help='Rollout/predict output: one pickle per trajectory, or a chunked memory-mappable '
+                       'store directory (gns.rollout_store) written while rolling out.')
+flags.DEFINE_integer('rollout_chunk_size', 64,
+                     help='Steps per chunk appended (and checkpointed) to a chunked rollout store.')
+flags.DEFINE_boolean('resume', False,
+                     help='Predict: continue the chunked rollout stores in output_path from their checkpoints '
+                          'and skip the complete ones.')
+
+flags.DEFINE_integer('ensemble_size', 1,
+                     help='Rollout/predict: number of perturbed ensemble members per trajectory (1: no ensemble).')
+flags.DEFINE_float('ensemble_noise_std', None,
+                   help='Std of the random-walk perturbation of the ensemble initial positions (default: noise_std).')
+flags.DEFINE_list('ensemble_quantiles', ['0.05', '0.5', '0.95'],
+                  help='Quantiles over the ensemble members to save.')
+flags.DEFINE_integer('ensemble_seed', 0, help='Random seed of the ensemble perturbations.')
+
+flags.DEFINE_float('steady_state_tol', None,
+                   help='Rollout/predict: RMS velocity per species (change per step) below which a trajectory '
+                        'is steady (default: no steady state detection).')
+flags.DEFINE_integer('steady_state_window', 10,
+                     help='Number of consecutive steps below steady_state_tol before the rollout stops.')
+flags.DEFINE_enum('steady_state_action', 'stop', list(rollout_engine.SteadyStateMonitor.ACTIONS),
+                  help='Once steady: end the rollout there, or extrapolate the remaining steps at the last '
+                       'velocity without the model.')
+
+flags.DEFINE_float('graph_skin', None,
+                   help='Rollouts: reuse the kNN graph until a particle moves more than half this skin distance (default: rebuild every step).')
+
+flags.DEFINE_integer('temporal_stride', 1,
+                     help='Number of dataset steps predicted per model step; use the same value for training '
+                          'and rollouts, whose outputs then hold every temporal_stride-th position.')
+flags.DEFINE_integer('nmessage_passing_steps', 1,
+                     help='Number of message passing steps (GN blocks) of the processor; must match the checkpoint.')
+flags.DEFINE_boolean('gradient_checkpointing', False,
+                     help='Training: recompute each GN block in the backward pass instead of storing its activations.')
+
+flags.DEFINE_integer('knn_k', 2, help='Number of nearest neighbours per particle in the graph (self edge included).')
+flags.DEFINE_float('knn_radius', None, help='Optional cutoff distance for the nearest neighbours.')
+flags.DEFINE_enum('knn_backend', 'auto', list(graph_builder.BACKENDS),
+                  help='kNN graph backend; "auto" prefers torch_cluster, then the SciPy KD-tree on CPU, then brute force.')
+
+flags.DEFINE_enum('interaction_network', 'message_passing', ['message_passing', 'fused'],
+                  help='Processor GN block: the torch_geometric MessagePassing one, or "fused" with a decomposed '
+                       'first edge layer and index_add_ aggregation (same parameters, checkpoints load into both).')
+
+flags.DEFINE_enum('precision', 'float32', list(learned_simulator.PRECISIONS),
+                  help='"bfloat16" runs the encoder/processor/decoder MLPs under bfloat16 autocast (CPU or GPU); '
+                       'normalization and the Euler update stay in float32.')
+
+flags.DEFINE_boolean('quantize', False,
+                     help='Rollout/predict on CPU with the MLP linear layers dynamically quantized to int8 '
+                          '(see python -m benchmarks.bench_quantize for the drift and speedup).')
+
+flags.DEFINE_enum('compile', 'none', list(compiled.MODES),
+                  help='Rollout/predict: run each step as a TorchScript ("torchscript") or torch.compile ("inductor") '
+                       'module, with the brute-force kNN search.')
+flags.DEFINE_string('torchscript_file', None,
+                    help='Rollout/predict: also export the scripted step to this file (loadable without torch_geometric).')
+
 flags.DEFINE_integer("cuda_device_number", None,
                      help="CUDA device (zero indexed), default is None so default CUDA device will be used.")
+flags.DEFINE_integer('cpu_ranks', 1,
+                     help='Training without CUDA: number of data-parallel ranks (gloo) spawned on this host. '
+                          'Under torchrun the launcher sets the ranks instead.')
+flags.DEFINE_boolean('pin_cpu_threads', True,
+                     help='CPU data-parallel training: pin every rank of a host to its own group of cores.')
 
 FLAGS = flags.FLAGS
 
@@ -82,48 +162,13 @@ def rollout(
       n_particles_per_example
       nsteps: Number of steps.
       device: torch device.
-    """
 
-    initial_positions = position[:, :INPUT_SEQUENCE_LENGTH]
-    ground_truth_positions = position[:, INPUT_SEQUENCE_LENGTH:]
-
-    current_positions = initial_positions
-    predictions = []
-
-    for step in tqdm(range(nsteps), total=nsteps):
-        # Get next position with shape (nnodes, dim)
-        
-        next_position = simulator.predict_positions(
-            current_positions,
-            nparticles_per_example=[n_particles_per_example],
-            particle_types=particle_types,
-            universe_numbers=universe_numbers,
-            material_property=material_property
-        )
-            
-        predictions.append(next_position)
-
-        # Shift `current_positions`, removing the oldest position in the sequence
-        # and appending the next position at the end.
-        current_positions = torch.cat(
-            [current_positions[:, 1:], next_position[:, None, :]], dim=1)
-
-    # Predictions with shape (time, nnodes, dim)
-    predictions = torch.stack(predictions)
-    ground_truth_positions = ground_truth_positions.permute(1, 0, 2)
-
-    loss = (predictions - ground_truth_positions) ** 2
-
-    output_dict = {
-        'initial_positions': initial_positions.permute(1, 0, 2).cpu().numpy(),
-        'predicted_rollout': predictions.cpu().numpy(),
-        'ground_truth_rollout': ground_truth_positions.cpu().numpy(),
-        'particle_types': particle_types.cpu().numpy(),
-        'universe_numbers': universe_numbers.cpu().numpy(),
-        'material_property': material_property.cpu().numpy() if material_property is not None else None
-    }
-
-    return output_dict, loss
+    Returns:
+      tuple: Output dictionary and the mean squared error of every step (nsteps, ).
+    """
+    example = (position, particle_types, universe_numbers, material_property,
+               n_particles_per_example)
+    return rollout_batch(simulator, [example], nsteps)[0]
 
 
 def prediction_rollout(
@@ -148,40 +193,248 @@ def prediction_rollout(
       nsteps: Number of steps.
       device: torch device.
     """
+    example = (position, particle_types, universe_numbers, material_property,
+               n_particles_per_example)
+    output_dict, _ = rollout_batch(simulator, [example], nsteps, ground_truth=False)[0]
+    return output_dict
 
-    initial_positions = position[:, :INPUT_SEQUENCE_LENGTH]
-    current_positions = initial_positions
-    predictions = []
-
-    for step in tqdm(range(nsteps), total=nsteps):
-        # Get next position with shape (nnodes, dim)
-        next_position = simulator.predict_positions(
-            current_positions,
-            nparticles_per_example=[n_particles_per_example],
-            particle_types=particle_types,
-            universe_numbers=universe_numbers,
-            material_property=material_property
-        )
-        predictions.append(next_position)
-
-        # Shift `current_positions`, removing the oldest position in the sequence
-        # and appending the next position at the end.
-        current_positions = torch.cat(
-            [current_positions[:, 1:], next_position[:, None, :]], dim=1)
+
+def rollout_batch(
+        simulator: learned_simulator.LearnedSimulator,
+        examples: list,
+        nsteps: int,
+        ground_truth: bool = True,
+        sink: rollout_engine.RolloutSink = None,
+        start_step: int = 0,
+        window: torch.tensor = None,
+        progress: bool = True,
+        monitor: rollout_engine.SteadyStateMonitor = None):
+    """
+    Rolls out several trajectories in lockstep, packed as one disjoint graph.
+
+    Args:
+      simulator: Learned simulator.
+      examples: List of tuples (position, particle_types, universe_numbers,
+        material_property, n_particles_per_example) of single trajectories, see
+        `rollout`.
+      nsteps: Number of steps, the same for all examples.
+      ground_truth: Whether the positions after the initial ones are a ground
+        truth to compare with (rollout/valid) or not (predict).
+      sink: Optional sink of the predicted positions of all examples (e.g. a
+        `rollout_store.RolloutStoreSink`); the output dictionaries then have no
+        `predicted_rollout`.
+      start_step: Step to resume the rollout from, e.g. the checkpoint of a
+        resumed `sink`.
+      window: Packed input window (nnodes, 2, dim) of `start_step`; defaults to
+        the initial positions.
+      progress: Show a progress bar.
+      monitor: Optional steady state monitor of the rollout; the output
+        dictionaries then record the `steady_state_step` of every example.
+
+    Returns:
+      list: (output dictionary, mean squared error of every step (nsteps, ) or
+        None) for every example.
+    """
+    # Trajectories may be longer than the rollout; keep the frames it uses so
+    # that examples of different lengths pack together
+    nframes = INPUT_SEQUENCE_LENGTH + (nsteps if ground_truth else 0)
+    position = torch.cat([example[0][:, :nframes] for example in examples])
+    particle_types = torch.cat([example[1] for example in examples])
+    universe_numbers = torch.cat([example[2] for example in examples])
+    if examples[0][3] is not None:
+        material_property = torch.cat([example[3] for example in examples])
+    else:
+        material_property = None
+    n_particles_per_example = [example[4] for example in examples]
+
+    if window is None:
+        window = position[:, :INPUT_SEQUENCE_LENGTH]
 
     # Predictions with shape (time, nnodes, dim)
-    predictions = torch.stack(predictions)
-    
+    predictions, loss = rollout_engine.rollout(
+        simulator, window, nsteps, particle_types,
+        universe_numbers, material_property, n_particles_per_example,
+        ground_truth_positions=position[:, INPUT_SEQUENCE_LENGTH:] if ground_truth else None,
+        sink=sink, progress=progress, start_step=start_step, monitor=monitor)
+    nsteps = _steady_state_nsteps(nsteps, monitor)
+
+    # Split the packed rollout back into its examples
+    outputs = []
+    start = 0
+    for i, (position, particle_types, universe_numbers, material_property, _) in enumerate(examples):
+        stop = start + position.shape[0]
+        output_dict = {
+            'initial_positions': position[:, :INPUT_SEQUENCE_LENGTH].permute(1, 0, 2).cpu().numpy(),
+        }
+        if sink is None:
+            output_dict['predicted_rollout'] = predictions[:, start:stop].cpu().numpy()
+        if ground_truth:
+            output_dict['ground_truth_rollout'] = position[
+                :, INPUT_SEQUENCE_LENGTH:INPUT_SEQUENCE_LENGTH + nsteps].permute(1, 0, 2).cpu().numpy()
+        output_dict['particle_types'] = particle_types.cpu().numpy()
+        output_dict['universe_numbers'] = universe_numbers.cpu().numpy()
+        output_dict['material_property'] = material_property.cpu().numpy() if material_property is not None else None
+        if monitor is not None:
+            _record_steady_state(output_dict, monitor, int(monitor.steady_steps[i]))
+        outputs.append((output_dict, loss[:, i] if loss is not None else None))
+        start = stop
+
+    return outputs
+
+
+def ensemble_rollout(
+        simulator: learned_simulator.LearnedSimulator,
+        example: tuple,
+        nsteps: int,
+        ensemble_size: int,
+        noise_std: float,
+        quantiles: list,
+        ground_truth: bool = True,
+        monitor: rollout_engine.SteadyStateMonitor = None):
+    """
+    Rolls out an ensemble of perturbed copies of a trajectory in one batched graph.
+
+    Every member starts from the initial positions plus random-walk noise (see
+    `noise_utils`); the members are rolled out in lockstep as one disjoint graph
+    and reduced to streaming statistics, so their trajectories are never stored.
+
+    Args:
+      simulator: Learned simulator.
+      example: Tuple (position, particle_types, universe_numbers,
+        material_property, n_particles_per_example) of one trajectory, see `rollout`.
+      nsteps: Number of steps.
+      ensemble_size: Number of members.
+      noise_std: Std of the perturbation in the last input step.
+      quantiles: Quantiles over the members.
+      ground_truth: Whether the positions after the initial ones are a ground truth.
+      monitor: Optional steady state monitor; the ensemble is steady once all
+        its members are.
+
+    Returns:
+      tuple: Output dictionary, with the ensemble mean as `predicted_rollout`,
+        and the mean squared error of the ensemble mean at every step (nsteps, )
+        or None.
+    """
+    position, particle_types, universe_numbers, material_property, _ = example
+    nparticles = position.shape[0]
+    initial_positions = position[:, :INPUT_SEQUENCE_LENGTH].repeat(ensemble_size, 1, 1)
+    initial_positions += noise_utils.get_random_walk_noise_for_position_sequence(
+        initial_positions, noise_std_last_step=noise_std)
+    if material_property is not None:
+        material_property = material_property.repeat(
+            (ensemble_size,) + (1,) * (material_property.dim() - 1))
+
+    statistics, _ = rollout_engine.rollout(
+        simulator, initial_positions, nsteps,
+        particle_types.repeat(ensemble_size), universe_numbers.repeat(ensemble_size),
+        material_property, [nparticles] * ensemble_size,
+        sink=rollout_engine.EnsembleSink(ensemble_size, quantiles), monitor=monitor)
+    nsteps = _steady_state_nsteps(nsteps, monitor)
 
     output_dict = {
-        'initial_positions': initial_positions.permute(1, 0, 2).cpu().numpy(),
-        'predicted_rollout': predictions.cpu().numpy(),
-        'particle_types': particle_types.cpu().numpy(),
-        'universe_numbers': universe_numbers.cpu().numpy(),
-        'material_property': material_property.cpu().numpy() if material_property is not None else None
+        'initial_positions': position[:, :INPUT_SEQUENCE_LENGTH].permute(1, 0, 2).cpu().numpy(),
+        'predicted_rollout': statistics['mean'].cpu().numpy(),
     }
+    loss = None
+    if ground_truth:
+        ground_truth_positions = position[:, INPUT_SEQUENCE_LENGTH:INPUT_SEQUENCE_LENGTH + nsteps].permute(1, 0, 2)
+        output_dict['ground_truth_rollout'] = ground_truth_positions.cpu().numpy()
+        loss = (statistics['mean'] - ground_truth_positions[:nsteps]).square().mean(dim=(1, 2))
+    output_dict['particle_types'] = particle_types.cpu().numpy()
+    output_dict['universe_numbers'] = universe_numbers.cpu().numpy()
+    output_dict['material_property'] = example[3].cpu().numpy() if example[3] is not None else None
+    output_dict['ensemble_size'] = ensemble_size
+    output_dict['ensemble_std'] = statistics['std'].cpu().numpy()
+    output_dict['quantiles'] = list(quantiles)
+    output_dict['ensemble_quantiles'] = statistics['quantiles'].cpu().numpy()
+    if monitor is not None:
+        _record_steady_state(output_dict, monitor,
+                             monitor.stop_step if monitor.stop_step is not None else -1)
 
-    return output_dict
+    return output_dict, loss
+
+
+def steady_state_monitor():
+    """A new steady state monitor of the --steady_state_* flags, or None without --steady_state_tol."""
+    if FLAGS.steady_state_tol is None:
+        return None
+    return rollout_engine.SteadyStateMonitor(
+        FLAGS.steady_state_tol, FLAGS.steady_state_window, FLAGS.steady_state_action)
+
+
+def _steady_state_nsteps(nsteps, monitor):
+    """Number of steps of a rollout with `monitor`, which may have stopped it early."""
+    if monitor is not None and monitor.action == 'stop' and monitor.stop_step is not None:
+        return min(nsteps, monitor.stop_step)
+    return nsteps
+
+
+def _record_steady_state(output_dict, monitor, steady_step):
+    # Steps predicted when the trajectory was found steady (None: never)
+    output_dict['steady_state_step'] = steady_step if steady_step >= 0 else None
+    output_dict['steady_state_action'] = monitor.action
+
+
+def rollout_nsteps(sequence_length: int, temporal_stride: int = 1) -> int:
+    """Number of model steps of a rollout over `sequence_length` dataset steps.
+
+    Args:
+      sequence_length: Number of positions of the trajectory, initial ones included.
+      temporal_stride: Number of dataset steps per model step.
+    """
+    return (sequence_length - 1) // temporal_stride + 1 - INPUT_SEQUENCE_LENGTH
+
+
+def load_rollout_simulator(
+        metadata: json,
+        n_features: int,
+        model_file: str,
+        device: torch.device,
+        torchscript_file: str = None):
+    """
+    Instantiates the simulator of the model flags for rollouts and loads its weights.
+
+    Applies --quantize, --graph_skin and --compile (after exporting the step to
+    `torchscript_file`, if given).
+
+    Args:
+      metadata: JSON object with metadata.
+      n_features: Number of features of the trajectories (4 with material property).
+      model_file: Path to the model checkpoint.
+      device: torch device.
+      torchscript_file: Optional file to export the compiled rollout step to.
+    """
+    if FLAGS.compile != 'none' and (FLAGS.graph_skin is not None or FLAGS.knn_backend != 'auto'):
+        # The compiled step always rebuilds the graph with the brute-force search
+        raise ValueError("--compile does not support --graph_skin or --knn_backend")
+    if FLAGS.compile != 'none' and FLAGS.precision != 'float32':
+        # The compiled step has no autocast
+        raise ValueError("--compile needs --precision=float32")
+    simulator = _get_simulator(
+        metadata, FLAGS.noise_std, FLAGS.noise_std, n_features, device,
+        FLAGS.knn_k, FLAGS.knn_radius, FLAGS.knn_backend, FLAGS.interaction_network,
+        FLAGS.precision, FLAGS.nmessage_passing_steps, temporal_stride=FLAGS.temporal_stride)
+
+    # Load simulator
+    if os.path.exists(model_file):
+        simulator.load(model_file)
+    else:
+        raise Exception(
+            f"Model does not exist at {model_file}")
+
+    simulator.to(device)
+    simulator.eval()
+    if FLAGS.quantize:
+        if torch.device(device).type != 'cpu' or FLAGS.precision != 'float32':
+            raise ValueError("--quantize needs a CPU device and --precision=float32")
+        simulator = quantize.quantize_simulator(simulator)
+    if FLAGS.graph_skin is not None:
+        simulator.set_graph_reuse(FLAGS.graph_skin)
+    if torchscript_file is not None:
+        compiled.export_torchscript(simulator, torchscript_file)
+    if FLAGS.compile != 'none':
+        simulator = compiled.compile_simulator(simulator, FLAGS.compile)
+    return simulator
 
 
 def predict(device: str):
@@ -206,7 +459,7 @@ def predict(device: str):
 
     # Get dataset
     ds = data_loader.get_data_loader_by_trajectories(
-        path=f"{FLAGS.data_path}{split}.npz")
+        path=data_loader.get_split_path(FLAGS.data_path, split))
     n_features = len(ds.dataset._data[0])
 
     # See if our dataset has material property as feature
@@ -220,31 +473,104 @@ def predict(device: str):
 
     # Read metadata
     metadata = reading_utils.read_metadata(FLAGS.data_path, "rollout")
-    simulator = _get_simulator(
-        metadata, FLAGS.noise_std, FLAGS.noise_std, n_features, device)
-
-    # Load simulator
-    if os.path.exists(FLAGS.model_path + FLAGS.model_file):
-        simulator.load(FLAGS.model_path + FLAGS.model_file)
-    else:
-        raise Exception(
-            f"Model does not exist at {FLAGS.model_path + FLAGS.model_file}")
+    simulator = load_rollout_simulator(
+        metadata, n_features, FLAGS.model_path + FLAGS.model_file, device,
+        FLAGS.torchscript_file)
 
-    simulator.to(device)
-    simulator.eval()
+    if FLAGS.resume and (FLAGS.mode != 'predict' or FLAGS.rollout_format != 'chunked'
+                         or FLAGS.ensemble_size > 1):
+        raise ValueError("--resume needs --mode=predict and --rollout_format=chunked without --ensemble_size")
 
     start = time.time()
-    eval_loss = []
+    # Sum and number of the squared errors of all examples
+    eval_loss_sum = 0.
+    eval_loss_count = 0
+
+    if FLAGS.ensemble_size > 1:
+        torch.manual_seed(FLAGS.ensemble_seed)
+        ensemble_noise_std = FLAGS.ensemble_noise_std
+        if ensemble_noise_std is None:
+            ensemble_noise_std = FLAGS.noise_std
+        quantiles = [float(q) for q in FLAGS.ensemble_quantiles]
+
+    def rollout_batch_or_ensemble(examples, nsteps, ground_truth=True, sink=None,
+                                  start_step=0, window=None):
+        """`rollout_batch`, or an `ensemble_rollout` of every example."""
+        if FLAGS.ensemble_size > 1:
+            return [ensemble_rollout(simulator, example, nsteps, FLAGS.ensemble_size,
+                                     ensemble_noise_std, quantiles, ground_truth,
+                                     monitor=steady_state_monitor())
+                    for example in examples]
+        return rollout_batch(simulator, examples, nsteps, ground_truth, sink, start_step, window,
+                             monitor=steady_state_monitor())
+
+    def output_name(example_i):
+        """Output file (without extension) or store directory of an example."""
+        suffix = 'ex' if FLAGS.mode == 'rollout' else 'set'
+        return os.path.join(FLAGS.output_path, f'{FLAGS.output_filename}_{suffix}{example_i}')
+
+    def save_output(output_dict, example_i):
+        if FLAGS.rollout_format == 'chunked':
+            rollout_store.save_rollout(output_name(example_i), output_dict)
+        else:
+            with open(output_name(example_i) + '.pkl', 'wb') as f:
+                pickle.dump(output_dict, f)
+
+    def rollout_pending(pending, start_step=0, window=None):
+        """Roll out and save the (example_i, nsteps, example) tuples of `pending`,
+        resuming their stores from the checkpoint `start_step` if `window` is given."""
+        nonlocal eval_loss_sum, eval_loss_count
+        example_ids = [example_i for example_i, _, _ in pending]
+        examples = [example for _, _, example in pending]
+        nsteps = pending[0][1]
+        sink = None
+        if FLAGS.mode != 'valid' and FLAGS.rollout_format == 'chunked' and FLAGS.ensemble_size == 1:
+            # Stream the predicted positions to the stores during the rollout
+            sink = rollout_store.RolloutStoreSink(
+                [output_name(example_i) for example_i in example_ids],
+                [example[4] for example in examples], FLAGS.rollout_chunk_size,
+                resume=window is not None)
+
+        # Predict example rollout
+        if FLAGS.mode in ['rollout', 'valid']:
+            outputs = rollout_batch_or_ensemble(examples, nsteps, sink=sink)
+            for example_i, example, (example_rollout, loss) in zip(example_ids, examples, outputs):
+                print("Predicting example {} loss: {}".format(example_i, loss.mean()))
+                # `loss` holds per-step means over (nparticles, dim) values
+                positions = example[0]
+                nvalues = positions.shape[0] * positions.shape[2]
+                eval_loss_sum += loss.sum().item() * nvalues
+                eval_loss_count += loss.numel() * nvalues
+
+                # Save rollout in testing
+                if FLAGS.mode == 'rollout':
+                    example_rollout['metadata'] = metadata
+                    example_rollout['temporal_stride'] = FLAGS.temporal_stride
+                    example_rollout['loss'] = loss.mean()
+                    save_output(example_rollout, example_i)
+        elif FLAGS.mode == 'predict':
+            outputs = rollout_batch_or_ensemble(examples, nsteps, ground_truth=False, sink=sink,
+                                                start_step=start_step, window=window)
+            for example_i, (prediction, _) in zip(example_ids, outputs):
+                prediction['metadata'] = metadata
+                prediction['temporal_stride'] = FLAGS.temporal_stride
+                save_output(prediction, example_i)
+
     with torch.no_grad():
+        # Trajectories with the same number of steps are packed by
+        # `rollout_batch_size` into one graph and rolled out in lockstep
+        pending = []
         for example_i, features in enumerate(ds):
             positions = features[0].to(device)
             if metadata['sequence_length'] is not None:
                 # If `sequence_length` is predefined in metadata,
-                nsteps = metadata['sequence_length'] - INPUT_SEQUENCE_LENGTH
+                sequence_length = metadata['sequence_length']
             else:
                 # If no predefined `sequence_length`, then get the sequence length
                 sequence_length = positions.shape[1]
-                nsteps = sequence_length - INPUT_SEQUENCE_LENGTH
+            # Every `temporal_stride`-th position is a model step
+            nsteps = rollout_nsteps(sequence_length, FLAGS.temporal_stride)
+            positions = positions[:, ::FLAGS.temporal_stride]
             particle_type = features[1].to(device)
             universe_number = features[2].to(device)
             if material_property_as_feature:
@@ -256,47 +582,33 @@ def predict(device: str):
                 n_particles_per_example = torch.tensor(
                     [int(features[3])], dtype=torch.int32).to(device)
 
-            # Predict example rollout
-            if FLAGS.mode in ['rollout', 'valid']:
-                example_rollout, loss = rollout(simulator,
-                                                positions,
-                                                particle_type,
-                                                universe_number,
-                                                material_property,
-                                                n_particles_per_example,
-                                                nsteps,
-                                                device)
-
-                example_rollout['metadata'] = metadata
-                print("Predicting example {} loss: {}".format(example_i, loss.mean()))
-                eval_loss.append(torch.flatten(loss))
-
-                # Save rollout in testing
-                if FLAGS.mode == 'rollout':
-                    example_rollout['metadata'] = metadata
-                    example_rollout['loss'] = loss.mean()
-                    filename = f'{FLAGS.output_filename}_ex{example_i}.pkl'
-                    filename = os.path.join(FLAGS.output_path, filename)
-                    with open(filename, 'wb') as f:
-                        pickle.dump(example_rollout, f)
-            elif FLAGS.mode == 'predict':
-                prediction = prediction_rollout(simulator,
-                                                positions,
-                                                particle_type,
-                                                universe_number,
-                                                material_property,
-                                                n_particles_per_example,
-                                                nsteps,
-                                                device)
-                prediction['metadata'] = metadata
-                filename = f'{FLAGS.output_filename}_set{example_i}.pkl'
-                filename = os.path.join(FLAGS.output_path, filename)
-                with open(filename, 'wb') as f:
-                    pickle.dump(prediction, f)
+            example = (positions, particle_type, universe_number,
+                       material_property, n_particles_per_example)
+
+            if FLAGS.resume and rollout_store.is_rollout_store(output_name(example_i)):
+                complete, step, window = rollout_store.read_checkpoint(output_name(example_i))
+                if complete:
+                    print(f"Example {example_i} is complete, skipping it")
+                    continue
+                if step is not None:
+                    print(f"Resuming example {example_i} from step {step}")
+                    rollout_pending([(example_i, nsteps, example)], step,
+                                    torch.from_numpy(window).to(device))
+                    continue
+
+            if pending and pending[-1][1] != nsteps:
+                rollout_pending(pending)
+                pending = []
+            pending.append((example_i, nsteps, example))
+            if len(pending) == FLAGS.rollout_batch_size:
+                rollout_pending(pending)
+                pending = []
+        if pending:
+            rollout_pending(pending)
 
     if FLAGS.mode in ['rollout', 'valid']:
         print("Mean loss on rollout prediction: {}".format(
-            torch.mean(torch.cat(eval_loss))))
+            eval_loss_sum / eval_loss_count))
         end = time.time()
         print(f"Total prediction time: {end - start}")
     elif FLAGS.mode == 'predict':
@@ -328,38 +640,70 @@ def train(rank, flags, world_size, device):
       world_size: total number of ranks
       device: torch device type
     """
+    # GPUs always train with DDP, CPUs with more than one rank (over gloo)
+    distributed = device == torch.device("cuda") or world_size > 1
+    if distributed:
+        global_rank = distribute.setup(rank, world_size, device)
+    else:
+        global_rank = 0
     if device == torch.device("cuda"):
-        distribute.setup(rank, world_size, device)
         device_id = rank
     else:
         device_id = device
-
-    if device == torch.device("cuda"):
-        dl = distribute.get_data_distributed_dataloader_by_samples(path=f'{flags["data_path"]}train.npz',
+        if distributed and flags["pin_cpu_threads"]:
+            launched = distribute.launched_ranks()
+            cores = distribute.pin_threads(rank, launched[3] if launched is not None else world_size)
+            if cores is not None:
+                print(f"rank = {global_rank}, cores = {cores}")
+            else:
+                print(f"rank = {global_rank}, threads = {torch.get_num_threads()}")
+
+    if flags["dataset_residency"] == "device":
+        dl = data_loader.get_device_data_loader_by_samples(path=data_loader.get_split_path(flags["data_path"], "train"),
+                                                           input_length_sequence=INPUT_SEQUENCE_LENGTH,
+                                                           batch_size=flags["batch_size"],
+                                                           device=device_id,
+                                                           distributed=distributed,
+                                                           temporal_stride=flags["temporal_stride"])
+    elif distributed:
+        dl = distribute.get_data_distributed_dataloader_by_samples(path=data_loader.get_split_path(flags["data_path"], "train"),
                                                                    input_length_sequence=INPUT_SEQUENCE_LENGTH,
-                                                                   batch_size=flags["batch_size"])
+                                                                   batch_size=flags["batch_size"],
+                                                                   num_workers=flags["num_workers"],
+                                                                   noise_std=flags["noise_std"],
+                                                                   temporal_stride=flags["temporal_stride"])
     else:
-        dl = data_loader.get_data_loader_by_samples(path=f'{flags["data_path"]}train.npz',
+        dl = data_loader.get_data_loader_by_samples(path=data_loader.get_split_path(flags["data_path"], "train"),
                                                     input_length_sequence=INPUT_SEQUENCE_LENGTH,
-                                                    batch_size=flags["batch_size"])
+                                                    batch_size=flags["batch_size"],
+                                                    num_workers=flags["num_workers"],
+                                                    noise_std=flags["noise_std"],
+                                                    temporal_stride=flags["temporal_stride"])
+    if flags["prefetch_batches"] > 0 and flags["dataset_residency"] == "host":
+        dl = data_loader.PrefetchLoader(dl, device_id, depth=flags["prefetch_batches"])
     n_features = len(dl.dataset._data[0])
 
     # Read metadata
     metadata = reading_utils.read_metadata(flags["data_path"], "train")
 
     # Get simulator and optimizer
-    if device == torch.device("cuda"):
-        serial_simulator = _get_simulator(
-            metadata, flags["noise_std"], flags["noise_std"], n_features, rank)
-        simulator = DDP(serial_simulator.to(rank),
-                        device_ids=[rank], output_device=rank)
-        optimizer = torch.optim.Adam(
-            simulator.parameters(), lr=flags["lr_init"]*world_size)
+    serial_simulator = _get_simulator(
+        metadata, flags["noise_std"], flags["noise_std"], n_features, device_id,
+        flags["knn_k"], flags["knn_radius"], flags["knn_backend"],
+        flags["interaction_network"], flags["precision"],
+        flags["nmessage_passing_steps"], flags["gradient_checkpointing"],
+        flags["temporal_stride"])
+    if distributed:
+        # The parameters used (e.g. no particle type embedding with a single
+        # type) are the same in every step
+        simulator = DDP(serial_simulator.to(device_id),
+                        device_ids=[rank] if device == torch.device("cuda") else None,
+                        output_device=rank if device == torch.device("cuda") else None,
+                        static_graph=True)
     else:
-        simulator = _get_simulator(
-            metadata, flags["noise_std"], flags["noise_std"], n_features, device)
-        optimizer = torch.optim.Adam(
-            simulator.parameters(), lr=flags["lr_init"] * world_size)
+        simulator = serial_simulator
+    optimizer = torch.optim.Adam(
+        simulator.parameters(), lr=flags["lr_init"] * world_size)
     step = 0
 
     # If model_path does exist and model_file and train_state_file exist continue training.
@@ -380,18 +724,13 @@ def train(rank, flags, world_size, device):
 
         if os.path.exists(flags["model_path"] + flags["model_file"]) and os.path.exists(flags["model_path"] + flags["train_state_file"]):
             # load model
-            if device == torch.device("cuda"):
-                simulator.module.load(
-                    flags["model_path"] + flags["model_file"])
-            else:
-                simulator.load(flags["model_path"] + flags["model_file"])
+            serial_simulator.load(flags["model_path"] + flags["model_file"])
 
             # load train state
             train_state = torch.load(
                 flags["model_path"] + flags["train_state_file"])
             # set optimizer state
-            optimizer = torch.optim.Adam(
-                simulator.module.parameters() if device == torch.device("cuda") else simulator.parameters())
+            optimizer = torch.optim.Adam(serial_simulator.parameters())
             optimizer.load_state_dict(train_state["optimizer_state"])
             optimizer_to(optimizer, device_id)
             # set global train state
@@ -404,16 +743,17 @@ def train(rank, flags, world_size, device):
     simulator.train()
     simulator.to(device_id)
 
-    print(f"rank = {rank}, cuda = {torch.cuda.is_available()}")
+    print(f"rank = {global_rank}, cuda = {torch.cuda.is_available()}")
     not_reached_nsteps = True
     try:
         start = time.time()
         loss = 1
+        epoch = 0
         while loss > 1e-16 and not_reached_nsteps:
-            if device == torch.device("cuda"):
+            if distributed:
                 torch.distributed.barrier()
-            else:
-                pass
+                distribute.set_epoch(dl, epoch)
+            epoch += 1
             # ((position, particle_type, material_property, n_particles_per_example), labels) are in dl
             for example in dl:
                 position = example[0][0].to(device_id)
@@ -431,36 +771,27 @@ def train(rank, flags, world_size, device):
                 n_particles_per_example.to(device_id)
                 labels.to(device_id)
 
-                # TODO (jpv): Move noise addition to data_loader
-                # Sample the noise to add to the inputs to the model during training.
-                sampled_noise = noise_utils.get_random_walk_noise_for_position_sequence(
-                    position, noise_std_last_step=flags["noise_std"]).to(device_id)
-
-                # Get the predictions and target accelerations.
-                if device == torch.device("cuda"):
-                    pred_acc, target_acc = simulator.module.predict_accelerations(
-                        next_positions=labels.to(rank),
-                        position_sequence_noise=sampled_noise.to(rank),
-                        position_sequence=position.to(rank),
-                        nparticles_per_example=n_particles_per_example.to(
-                            rank),
-                        particle_types=particle_type.to(rank),
-                        universe_numbers=universe_number.to(rank),
-                        material_property=material_property.to(
-                            rank) if n_features == 4 else None
-                    )
+                # Sample the noise to add to the inputs to the model during training,
+                # unless the data loader already sampled it with the batch.
+                if len(example) > 2:
+                    sampled_noise = example[2].to(device_id)
                 else:
-                    pred_acc, target_acc = simulator.predict_accelerations(
-                        next_positions=labels.to(device),
-                        position_sequence_noise=sampled_noise.to(device),
-                        position_sequence=position.to(device),
-                        nparticles_per_example=n_particles_per_example.to(
-                            device),
-                        particle_types=particle_type.to(device),
-                        universe_numbers=universe_number.to(device),
-                        material_property=material_property.to(
-                            device) if n_features == 4 else None
-                    )
+                    sampled_noise = noise_utils.get_random_walk_noise_for_position_sequence(
+                        position, noise_std_last_step=flags["noise_std"]).to(device_id)
+
+                # Get the predictions and target accelerations. Calling the
+                # (DDP) module all-reduces the gradients across the ranks.
+                pred_acc, target_acc = simulator(
+                    next_positions=labels.to(device_id),
+                    position_sequence_noise=sampled_noise.to(device_id),
+                    position_sequence=position.to(device_id),
+                    nparticles_per_example=n_particles_per_example.to(
+                        device_id),
+                    particle_types=particle_type.to(device_id),
+                    universe_numbers=universe_number.to(device_id),
+                    material_property=material_property.to(
+                        device_id) if n_features == 4 else None
+                )
 
                 # Calculate the loss 
                 loss = (pred_acc - target_acc)** 2
@@ -478,17 +809,13 @@ def train(rank, flags, world_size, device):
                 for param in optimizer.param_groups:
                     param['lr'] = lr_new
 
-                if rank == 0 or device == torch.device("cpu"):
+                if global_rank == 0:
                     print(
                         f'Training step: {step}/{flags["ntraining_steps"]}. Loss: {loss}.')
                     # Save model state
                     if step % flags["nsave_steps"] == 0:
-                        if device == torch.device("cpu"):
-                            simulator.save(
-                                flags["model_path"] + 'model-'+str(step)+'.pt')
-                        else:
-                            simulator.module.save(
-                                flags["model_path"] + 'model-'+str(step)+'.pt')
+                        serial_simulator.save(
+                            flags["model_path"] + 'model-'+str(step)+'.pt')
                         train_state = dict(optimizer_state=optimizer.state_dict(),
                                            global_train_state={"step": step},
                                            loss=loss.item())
@@ -507,18 +834,14 @@ def train(rank, flags, world_size, device):
     except KeyboardInterrupt:
         pass
 
-    if rank == 0 or device == torch.device("cpu"):
-        if device == torch.device("cpu"):
-            simulator.save(flags["model_path"] + 'model-'+str(step)+'.pt')
-        else:
-            simulator.module.save(
-                flags["model_path"] + 'model-'+str(step)+'.pt')
+    if global_rank == 0:
+        serial_simulator.save(flags["model_path"] + 'model-'+str(step)+'.pt')
         train_state = dict(optimizer_state=optimizer.state_dict(),
                            global_train_state={"step": step},
                            loss=loss.item())
         torch.save(train_state, f'{flags["model_path"]}train_state-{step}.pt')
 
-    if torch.cuda.is_available():
+    if distributed:
         distribute.cleanup()
 
 
@@ -527,7 +850,15 @@ def _get_simulator(
         acc_noise_std: float,
         vel_noise_std: float,
         n_features: int,
-        device: torch.device) -> learned_simulator.LearnedSimulator:
+        device: torch.device,
+        knn_k: int = 2,
+        knn_radius: float = None,
+        knn_backend: str = "auto",
+        interaction_network: str = "message_passing",
+        precision: str = "float32",
+        nmessage_passing_steps: int = 1,
+        gradient_checkpointing: bool = False,
+        temporal_stride: int = 1) -> learned_simulator.LearnedSimulator:
     """Instantiates the simulator.
 
     Args:
@@ -535,6 +866,14 @@ def _get_simulator(
       acc_noise_std: Acceleration noise std deviation.
       vel_noise_std: Velocity noise std deviation.
       device: PyTorch device 'cpu' or 'cuda'.
+      knn_k: Number of nearest neighbours per particle.
+      knn_radius: Optional cutoff distance for the nearest neighbours.
+      knn_backend: kNN graph backend.
+      interaction_network: Processor GN block, "message_passing" or "fused".
+      precision: "float32" or "bfloat16" (autocast of EncodeProcessDecode).
+      nmessage_passing_steps: Number of message passing steps.
+      gradient_checkpointing: Checkpoint the processor's GN blocks in training.
+      temporal_stride: Number of dataset steps predicted per model step.
     """
 
     # Normalization stats
@@ -570,7 +909,7 @@ def _get_simulator(
         nnode_in=nnode_in,
         nedge_in=nedge_in,
         latent_dim=128,
-        nmessage_passing_steps=1,
+        nmessage_passing_steps=nmessage_passing_steps,
         nmlp_layers=2,
         mlp_hidden_dim=256,
         boundaries=np.array(metadata['bounds']),
@@ -579,7 +918,16 @@ def _get_simulator(
         particle_type_embedding_size=16,
         nuniverse_types=NUM_UNIVERSE_TYPES,
         universe_number_embedding_size=16,
-        device=device)
+        device=device,
+        knn_k=knn_k,
+        knn_radius=knn_radius,
+        knn_backend=knn_backend,
+        interaction_network=interaction_network,
+        precision=precision,
+        gradient_checkpointing=gradient_checkpointing,
+        # The velocity/acceleration statistics are finite differences over one
+        # dataset step, i.e. their time unit is the dataset `dt`
+        dt=float(temporal_stride))
 
     return simulator
 
@@ -589,9 +937,6 @@ def main(_):
 
     """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    if device == torch.device('cuda'):
-        os.environ["MASTER_ADDR"] = "localhost"
-        os.environ["MASTER_PORT"] = "29500"
 
     myflags = {}
     myflags["data_path"] = FLAGS.data_path
@@ -605,18 +950,43 @@ def main(_):
     myflags["model_file"] = FLAGS.model_file
     myflags["model_path"] = FLAGS.model_path
     myflags["train_state_file"] = FLAGS.train_state_file
+    myflags["dataset_residency"] = FLAGS.dataset_residency
+    myflags["num_workers"] = FLAGS.num_workers
+    myflags["prefetch_batches"] = FLAGS.prefetch_batches
+    myflags["knn_k"] = FLAGS.knn_k
+    myflags["knn_radius"] = FLAGS.knn_radius
+    myflags["knn_backend"] = FLAGS.knn_backend
+    myflags["interaction_network"] = FLAGS.interaction_network
+    myflags["precision"] = FLAGS.precision
+    myflags["nmessage_passing_steps"] = FLAGS.nmessage_passing_steps
+    myflags["gradient_checkpointing"] = FLAGS.gradient_checkpointing
+    myflags["temporal_stride"] = FLAGS.temporal_stride
+    myflags["pin_cpu_threads"] = FLAGS.pin_cpu_threads
 
     if FLAGS.mode == 'train':
         # If model_path does not exist create new directory.
-        if not os.path.exists(FLAGS.model_path):
-            os.makedirs(FLAGS.model_path)
+        os.makedirs(FLAGS.model_path, exist_ok=True)
+
+        # Ranks started by torchrun (possibly on several hosts), which also
+        # sets the rendezvous environment
+        launched = distribute.launched_ranks()
+        if launched is not None:
+            _, local_rank, world_size, _ = launched
+            train(local_rank, myflags, world_size, device)
 
         # Train on gpu
-        if device == torch.device('cuda'):
+        elif device == torch.device('cuda'):
             world_size = torch.cuda.device_count()
             print(f"world_size = {world_size}")
+            distribute.set_rendezvous_defaults()
             distribute.spawn_train(train, myflags, world_size, device)
 
+        # Train on several cpu ranks
+        elif FLAGS.cpu_ranks > 1:
+            print(f"world_size = {FLAGS.cpu_ranks}")
+            distribute.set_rendezvous_defaults()
+            distribute.spawn_train(train, myflags, FLAGS.cpu_ranks, device)
+
         # Train on cpu
         else:
             rank = None
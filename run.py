@@ -36,6 +36,14 @@ old_ts = total_steps
 example_number = 0
 rollout_number = 0
 
+# Prepare every scenario once, with one normalization shared by all universes
+scenario_str = ",".join(available_scenarios[scenario] for scenario in scenarios)
+universe_str = ",".join(str(scenario) for scenario in scenarios)
+os.system(f"mkdir -p {rollout_dicts}")
+os.system(f"python -m chem_data.chemgns --action='prepare-all' --raw_data_path={raw_data_path} --preped_data_path={npz_path} " +
+          f"--scenarios={scenario_str} --universes={universe_str} --material_properties={mat_prop_str} --gases={gases_str} " +
+          f"--particle_chem={part_chem_str} --share_path={rollout_dicts}")
+
 for scenario in scenarios:
     if rollout_number < len(scenarios):
         # if dir.startswith("."):
@@ -48,13 +56,8 @@ for scenario in scenarios:
         rollout_folder = rollouts_path + "rollout" + str(scenarios[rollout_number])
         dict_folder = rollout_dicts + "ex" + str(scenarios[rollout_number])
         
-        os.system(f"mkdir -p {example_folder}")
         os.system(f"mkdir -p {rollout_folder}")
         os.system(f"mkdir -p {dict_folder}")
-        
-        os.system(f"python -m chem_data.chemgns --action='prepare' --raw_data_path={path}  --preped_data_path={example_folder} " +
-                  f"--universe={scenarios[rollout_number]} --material_properties={mat_prop_str} --gases={gases_str} " + 
-                  f"--particle_chem={part_chem_str} --proc_data_path={dict_folder} --share_path={rollout_dicts}")
     
         if total_steps == train_steps:
             os.system(f"python -m gns.train --data_path={example_folder} --model_path={model_path} --output_path={rollout_folder} -ntraining_steps={total_steps}")
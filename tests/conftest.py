@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import torch
+
+from gns import learned_simulator
+
+DIM = 3
+INPUT_SEQUENCE_LENGTH = 2
+
+
+@pytest.fixture
+def simulator():
+    """A LearnedSimulator with random weights (seed 0), in eval mode."""
+    torch.manual_seed(0)
+    stats = {'mean': torch.zeros(DIM), 'std': torch.ones(DIM)}
+    return learned_simulator.LearnedSimulator(
+        particle_dimensions=DIM,
+        nnode_in=DIM * (INPUT_SEQUENCE_LENGTH + 1) + 16,
+        nedge_in=DIM + 1,
+        latent_dim=128,
+        nmessage_passing_steps=1,
+        nmlp_layers=2,
+        mlp_hidden_dim=256,
+        boundaries=np.array([[0., 1.]] * DIM),
+        normalization_stats={'acceleration': stats, 'velocity': stats},
+        nparticle_types=1,
+        particle_type_embedding_size=16,
+        nuniverse_types=9,
+        universe_number_embedding_size=16,
+        knn_k=4).eval()
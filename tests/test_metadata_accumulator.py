@@ -0,0 +1,63 @@
+"""Metadata statistics combined over workers (merge) and scenarios (extend) match a single pass."""
+import numpy as np
+import pytest
+
+from chem_data import prepare_data
+
+NSTEPS = 20
+DIM = 3
+NPARTICLES = [4, 5, 3]
+NUM_PROP = 2
+
+
+def _scenarios():
+    rng = np.random.default_rng(0)
+    return [np.cumsum(rng.normal(scale=scale, size=(NSTEPS, n, DIM)), axis=0)
+            for scale, n in zip([0.5, 1., 2.], NPARTICLES)]
+
+
+def _accumulate(block, chunk_size=3):
+    stats = prepare_data.MetadataAccumulator()
+    for start in range(0, block.shape[0], chunk_size):
+        stats.update(block[start:start + chunk_size])
+    return stats
+
+
+def _workers(X, boundaries=(0, 7, 12, NSTEPS)):
+    """Accumulator of `X` merged from time ranges, as the worker processes do."""
+    stats = prepare_data.MetadataAccumulator()
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        stats.merge(_accumulate(X[start:stop]))
+    return stats
+
+
+def _assert_same_metadata(stats, expected):
+    actual = stats.metadata(NUM_PROP)
+    expected = expected.metadata(NUM_PROP)
+    assert actual.keys() == expected.keys()
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-10)
+
+
+def test_merge_matches_single_pass():
+    X = _scenarios()[0]
+    _assert_same_metadata(_workers(X), _accumulate(X))
+
+
+def test_extend_and_merge_match_single_pass():
+    scenarios = _scenarios()
+    stats = prepare_data.MetadataAccumulator()
+    for X in scenarios:
+        stats.extend(_workers(X))
+    expected = _accumulate(np.concatenate(scenarios, axis=1))
+
+    assert stats.vel.mean.shape == (sum(NPARTICLES), DIM)
+    _assert_same_metadata(stats, expected)
+
+
+def test_extended_accumulator_cannot_merge():
+    first, second = _scenarios()[:2]
+    stats = _accumulate(first)
+    stats.extend(_accumulate(second))
+    with pytest.raises(ValueError):
+        stats.merge(_accumulate(first))
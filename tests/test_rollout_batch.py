@@ -0,0 +1,42 @@
+"""Trajectories of different lengths pack into one `rollout_batch`."""
+import numpy as np
+import pytest
+import torch
+
+from gns import train
+
+DIM = 3
+NPARTICLES = [12, 7]
+LENGTHS = [29, 10]
+
+
+def _examples():
+    generator = torch.Generator().manual_seed(1)
+    examples = []
+    for nparticles, length in zip(NPARTICLES, LENGTHS):
+        positions = torch.rand(nparticles, length, DIM, generator=generator)
+        particle_types = torch.zeros(nparticles, dtype=torch.long)
+        universe_numbers = torch.randint(9, (nparticles,), generator=generator)
+        examples.append((positions, particle_types, universe_numbers, None,
+                         torch.tensor([nparticles], dtype=torch.int32)))
+    return examples
+
+
+@pytest.mark.parametrize("ground_truth", [False, True])
+def test_mixed_lengths_match_single_rollouts(simulator, ground_truth):
+    examples = _examples()
+    nsteps = min(LENGTHS) - train.INPUT_SEQUENCE_LENGTH
+    with torch.no_grad():
+        batched = train.rollout_batch(simulator, examples, nsteps, ground_truth, progress=False)
+        single = [train.rollout_batch(simulator, [example], nsteps, ground_truth, progress=False)[0]
+                  for example in examples]
+
+    for (output, loss), (expected, expected_loss) in zip(batched, single):
+        np.testing.assert_allclose(output['predicted_rollout'], expected['predicted_rollout'],
+                                   rtol=1e-5, atol=1e-6)
+        if ground_truth:
+            assert output['ground_truth_rollout'].shape[0] == nsteps
+            np.testing.assert_array_equal(output['ground_truth_rollout'], expected['ground_truth_rollout'])
+            torch.testing.assert_close(loss, expected_loss, rtol=1e-4, atol=1e-8)
+        else:
+            assert loss is None
@@ -0,0 +1,82 @@
+"""A rollout resumed from a `RolloutStoreSink` checkpoint is bit-identical to an uninterrupted one."""
+import os
+
+import pytest
+import torch
+
+from gns import rollout_engine
+from gns import rollout_store
+
+DIM = 3
+NPARTICLES = 12
+NSTEPS = 20
+CHUNK_SIZE = 4
+INPUT_SEQUENCE_LENGTH = 2
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _InterruptingSimulator:
+    """Forwards to `simulator` and raises on the `nsteps`-th step."""
+
+    def __init__(self, simulator, nsteps):
+        self.simulator = simulator
+        self.nsteps = nsteps
+
+    def predict_positions(self, *args, **kwargs):
+        self.nsteps -= 1
+        if self.nsteps < 0:
+            raise _Interrupted()
+        return self.simulator.predict_positions(*args, **kwargs)
+
+    def rollout_context(self, *args):
+        return self.simulator.rollout_context(*args)
+
+    def reset_graph_cache(self):
+        self.simulator.reset_graph_cache()
+
+
+def _inputs():
+    generator = torch.Generator().manual_seed(1)
+    initial_positions = torch.rand(NPARTICLES, INPUT_SEQUENCE_LENGTH, DIM, generator=generator)
+    particle_types = torch.zeros(NPARTICLES, dtype=torch.long)
+    universe_numbers = torch.randint(9, (NPARTICLES,), generator=generator)
+    return initial_positions, particle_types, universe_numbers
+
+
+def _rollout(simulator, path, window, start_step=0, resume=False):
+    _, particle_types, universe_numbers = _inputs()
+    sink = rollout_store.RolloutStoreSink([path], [NPARTICLES], chunk_size=CHUNK_SIZE, resume=resume)
+    with torch.no_grad():
+        rollout_engine.rollout(simulator, window, NSTEPS, particle_types, universe_numbers,
+                               sink=sink, progress=False, start_step=start_step)
+    rollout_store.save_rollout(path, {'particle_types': particle_types.numpy()})
+
+
+def _files(path):
+    files = {}
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as f:
+            files[name] = f.read()
+    return files
+
+
+@pytest.mark.parametrize("interrupt_step", [CHUNK_SIZE + 1, 3 * CHUNK_SIZE - 1])
+def test_resumed_rollout_is_bit_identical(tmp_path, simulator, interrupt_step):
+    initial_positions, _, _ = _inputs()
+
+    uninterrupted = str(tmp_path / "uninterrupted")
+    _rollout(simulator, uninterrupted, initial_positions)
+
+    resumed = str(tmp_path / "resumed")
+    with pytest.raises(_Interrupted):
+        _rollout(_InterruptingSimulator(simulator, interrupt_step), resumed, initial_positions)
+    complete, step, window = rollout_store.read_checkpoint(resumed)
+    assert not complete
+    assert step == interrupt_step // CHUNK_SIZE * CHUNK_SIZE
+    _rollout(simulator, resumed, torch.from_numpy(window), start_step=step, resume=True)
+
+    assert rollout_store.read_checkpoint(resumed) == (True, None, None)
+    assert _files(resumed) == _files(uninterrupted)